@@ -0,0 +1,16 @@
+import os
+
+from concurrence.http import WSGIServer
+from concurrence.io.prefork import Prefork
+
+def hello_world(environ, start_response):
+    start_response("200 OK", [])
+    return ["<html>Hello, world from %d!</html>" % os.getpid()]
+
+def main(socket):
+    server = WSGIServer(hello_world)
+    return server.serve(socket)
+
+if __name__ == '__main__':
+    #one worker process per cpu, kill -HUP <pid> for a graceful reload
+    Prefork(('localhost', 8080), main).run()
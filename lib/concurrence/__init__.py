@@ -8,7 +8,7 @@ __version_info__ = tuple([ int(num) for num in __version__.split('.')])
 TIMEOUT_NEVER = -1
 TIMEOUT_CURRENT = -2
 
-from concurrence.core import dispatch, quit, disable_threading, get_version_info
+from concurrence.core import dispatch, quit, call_before_wait, disable_threading, get_version_info
 from concurrence.core import Channel, Tasklet, Message, Deque, FileDescriptorEvent, SignalEvent, TimeoutEvent
 from concurrence.core import TimeoutError, TaskletError, JoinError
 from concurrence.extra import TaskletPool, DeferredQueue, Lock, Semaphore, QueueChannel
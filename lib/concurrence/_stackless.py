@@ -84,6 +84,9 @@ class tasklet(object):
 
         def _func(*_args, **_kwargs):
             try:
+                #switch back to the creator right away, the task will continue from here
+                #when it is scheduled for the first time (see below)
+                greenlet.getcurrent().parent.switch()
                 self.func(*args, **kwargs)
             except TaskletExit:
                 pass #let it pass silently
@@ -104,6 +107,10 @@ class tasklet(object):
 
         self.greenlet = greenlet(_func)
         self.alive = True
+        #a greenlet inherits the python recursion depth of the greenlet that first switches into it.
+        #by starting it here instead of in the scheduler, tasks that are started one after another by the scheduler
+        #(e.g. a batch of new connections) do not each start deeper than the previous one
+        self.greenlet.switch()
         _scheduler.append(self)
         return self
 
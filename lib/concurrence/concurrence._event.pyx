@@ -46,7 +46,8 @@ cdef extern from "event.h":
         int   ev_flags
         void *ev_arg
 
-    void event_init() nogil
+    void *event_init() nogil
+    int event_reinit(void *base) nogil
     char *event_get_version() nogil
     char *event_get_method() nogil
     void event_set(event_t *ev, int fd, short event_type, event_handler handler, void *arg) nogil
@@ -65,6 +66,7 @@ EV_READ         = 0x02
 EV_WRITE        = 0x04
 EV_SIGNAL       = 0x08
 EV_PERSIST      = 0x10
+EV_ET           = 0x20 #edge triggered, libevent 2 only
 
 class EventError(Exception):
     def __init__(self, msg):
@@ -82,8 +84,10 @@ cdef struct __list:
 
 cdef __list* head
 cdef __list* tail
+cdef int count
 head = NULL
 tail = NULL
+count = 0
 
 cdef void __event_handler(int fd, short flags, void* arg) nogil:
     cdef __list *tmp
@@ -93,6 +97,8 @@ cdef void __event_handler(int fd, short flags, void* arg) nogil:
     trig.fd = fd
     global head
     global tail
+    global count
+    count = count + 1
     if head == NULL:
         trig.next = NULL
         head = trig
@@ -130,6 +136,16 @@ cdef class __event:
             if event_add(&self.ev, NULL) == -1:
                 raise EventError("could not add event")
 
+    property flags:
+        """The event flags with which this event was last triggered."""
+        def __get__(self):
+            return self.trig.flags
+
+    property fd:
+        """The file descriptor for which this event was last triggered."""
+        def __get__(self):
+            return self.trig.fd
+
     def pending(self, int event_type):
         """Return 1 if the event is scheduled to run, or else 0."""
         return event_pending(&self.ev, event_type, NULL)
@@ -161,13 +177,30 @@ def has_next():
 
 def next():
     global head
+    global count
     if head == NULL:
         return None
     else:
         triggered = (<__event>head.event, head.flags, head.fd)
         head = head.next
+        count = count - 1
         return triggered
 
+def drain():
+    """Returns a list of all events triggered during the last call to 'loop' in the order they were triggered.
+    The flags and fd of each triggered event are available as its 'flags' and 'fd' attributes."""
+    cdef int i
+    global head
+    global count
+    triggered = [None] * count
+    i = 0
+    while head != NULL:
+        triggered[i] = <__event>head.event
+        head = head.next
+        i = i + 1
+    count = 0
+    return triggered
+
 def loop():
     cdef int result
     global head
@@ -181,6 +214,13 @@ def loop():
 
     return head != NULL
 
+def reinit():
+    """Reinitializes libevent in the child process after a fork. The child will otherwise share the kernel
+    event queue (e.g. epoll) of its parent. Must be called before entering the dispatch loop in the child."""
+    if event_reinit(_base) != 0:
+        raise EventError("error in event_reinit")
+
 #init libevent
-event_init()
+cdef void *_base
+_base = event_init()
 
@@ -9,6 +9,8 @@ import logging
 import weakref
 import collections
 import gc
+import heapq
+import itertools
 
 try:
     import stackless
@@ -63,18 +65,27 @@ class Event(object):
     pass
 
 class FileDescriptorEvent(Event):
-    __slots__ = ['_event', '_channel', '_current_callback']
+    __slots__ = ['_event', '_channel', '_current_callback', '_persistent', '_ready']
 
-    def __init__(self, fd, rw):
+    def __init__(self, fd, rw, persistent = False):
         if rw == 'r':
             event_type = _event.EV_READ
         elif rw == 'w':
             event_type = _event.EV_WRITE
         else:
             assert False, "rw must be one of ['r', 'w']"
-        self._event = _event.event(fd, event_type, self._on_event)
+        if persistent:
+            #the fd is registered once for the lifetime of this event (edge triggered),
+            #readiness that arrives while nobody is waiting is remembered in _ready
+            assert not _event.version().startswith('1.'), "persistent fd events need libevent 2 (edge triggered events)"
+            self._event = _event.event(fd, event_type | _event.EV_PERSIST | _event.EV_ET, self._on_persistent_event)
+            self._event.add()
+        else:
+            self._event = _event.event(fd, event_type, self._on_event)
         self._channel = Channel() #this is were wait will block on
         self._current_callback = None
+        self._persistent = persistent
+        self._ready = False
 
     def _on_event(self, event_type):
         if self._current_callback is None:
@@ -84,6 +95,12 @@ class FileDescriptorEvent(Event):
         else:
             self._current_callback(False)
 
+    def _on_persistent_event(self, event_type):
+        if self._current_callback is not None:
+            self._current_callback(False)
+        elif self._channel is not None: #not closed
+            self._ready = True
+
     def _channel_callback(self, has_timedout):
         if has_timedout:
             self._channel.send_exception(TimeoutError, "timeout on fd event")
@@ -91,6 +108,7 @@ class FileDescriptorEvent(Event):
             self._channel.send(self, TIMEOUT_NEVER)
 
     def notify(self, callback, timeout = TIMEOUT_CURRENT):
+        assert not self._persistent, "notify is not supported on persistent events, use wait"
         self._current_callback = callback
         if timeout == TIMEOUT_NEVER:
             self._event.add() #no timeout
@@ -104,8 +122,23 @@ class FileDescriptorEvent(Event):
             self._event.add(timeout) #specific timeout
 
     def wait(self, timeout = TIMEOUT_CURRENT):
-        self.notify(self._channel_callback, timeout)
-        return self._channel.receive(TIMEOUT_NEVER) #note that we always return from notify based on timeout
+        if self._persistent:
+            if self._ready:
+                self._ready = False
+                return self #became ready while nobody was waiting, no need to block
+            self._current_callback = self._channel_callback
+            try:
+                return self._channel.receive(timeout) #timeout is handled by the channel
+            finally:
+                self._current_callback = None
+        else:
+            self.notify(self._channel_callback, timeout)
+            return self._channel.receive(TIMEOUT_NEVER) #note that we always return from notify based on timeout
+
+    def clear(self):
+        """Forgets any readiness seen so far by a persistent event. Should be called when the fd
+        returned EAGAIN, so that the next wait blocks until the next edge."""
+        self._ready = False
 
     def close(self):
         self._event.delete()
@@ -150,6 +183,83 @@ class TimeoutEvent(Event):
         del self._event
         del self._callback
 
+class _TimeoutQueue(object):
+    """A min-heap of pending tasklet timeouts ordered by deadline (unix timestamp).
+    Blocking operations with a timeout register themselves here instead of allocating a
+    libevent :class:`TimeoutEvent` per call. The dispatcher keeps a single libevent timer
+    set to the earliest deadline (see :func:`arm`)."""
+
+    COMPACT_THRESHOLD = 1024 #rebuild the heap when more than this many (and more than half of the) entries are cancelled
+
+    def __init__(self):
+        self._heap = [] #entries are lists [deadline, seq, tasklet], tasklet is None when cancelled
+        self._seq = itertools.count() #tie breaker, keeps equal deadlines in fifo order
+        self._cancelled = 0
+        self._event = None #libevent timer, created lazily
+        self._armed = None #the deadline the libevent timer is currently set to
+
+    def add(self, deadline, tasklet):
+        """Raises TimeoutError in *tasklet* at *deadline* unless the returned entry is cancelled before that time."""
+        entry = [deadline, self._seq.next(), tasklet]
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def cancel(self, entry):
+        """Cancels the timeout *entry* returned by :func:`add`. Cancelled entries are removed lazily."""
+        if entry[2] is not None:
+            entry[2] = None
+            self._cancelled += 1
+            if self._cancelled > self.COMPACT_THRESHOLD and self._cancelled > (len(self._heap) >> 1):
+                #modify in place, expire might be iterating the heap
+                self._heap[:] = [e for e in self._heap if e[2] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def arm(self):
+        """Sets the libevent timer to the earliest pending deadline. Called by the dispatcher
+        just before it blocks in libevent."""
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if heap and heap[0][0] != self._armed:
+            if self._event is None:
+                self._event = _event.event(-1, _event.EV_TIMEOUT, self._on_event)
+            deadline = heap[0][0]
+            timeout = deadline - time.time()
+            if timeout < 0.0: timeout = 0.0
+            self._event.add(timeout)
+            self._armed = deadline
+        #note that when the heap is empty a stale timer may still fire, expire then simply finds nothing to do
+
+    def _on_event(self, event_type):
+        self._armed = None
+        self.expire()
+
+    def expire(self):
+        """Raises TimeoutError in all tasklets whose deadline has passed."""
+        heap = self._heap
+        now = time.time()
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            tasklet = entry[2]
+            if tasklet is None:
+                self._cancelled -= 1
+            else:
+                entry[2] = None #so that cancel (in the finally of the blocking call) does not count it
+                tasklet.raise_exception(TimeoutError)
+
+    def close(self):
+        if self._event is not None:
+            self._event.delete()
+            self._event = None
+            self._armed = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+_timeouts = _TimeoutQueue()
+
 class Message():
     def __init__(self, reply_channel = None):
         self._reply_channel = reply_channel
@@ -678,18 +788,16 @@ class Channel(object):
                 #tasklet defines the timeout
                 timeout = current_task.timeout
             #
-            if timeout == TIMEOUT_NEVER:
-                #still no timeout
+            if timeout < 0:
+                #still no timeout (any negative timeout means never)
                 return self._channel.receive()
             else:
                 #with timeout
-                def on_timeout():
-                    current_task.raise_exception(TimeoutError)
-                event_timeout = TimeoutEvent(timeout, on_timeout)
+                entry = _timeouts.add(time.time() + timeout, current_task)
                 try:
                     return self._channel.receive()
                 finally:
-                    event_timeout.close()
+                    _timeouts.cancel(entry)
 
     def receive_n(self, n):
         for i in range(n):
@@ -714,18 +822,16 @@ class Channel(object):
             if timeout == TIMEOUT_CURRENT:
                 timeout = current_task.timeout
             #
-            if timeout == TIMEOUT_NEVER:
-                #still no timeout
+            if timeout < 0:
+                #still no timeout (any negative timeout means never)
                 self._channel.send(value)
             else:
                 #with timeout
-                def on_timeout():
-                    current_task.raise_exception(TimeoutError)
-                event_timeout = TimeoutEvent(timeout, on_timeout)
+                entry = _timeouts.add(time.time() + timeout, current_task)
                 try:
                     self._channel.send(value)
                 finally:
-                    event_timeout.close()
+                    _timeouts.cancel(entry)
 
 _running = False #whether we are currently in dispatch, used stop the dispatch (use quit method)
 _exitcode = EXIT_CODE_OK
@@ -737,6 +843,15 @@ def quit(exitcode = EXIT_CODE_OK):
     _exitcode = exitcode
     _running = False
 
+_before_wait = [] #callables to call once when all tasks are blocked, right before the dispatcher waits for IO
+
+def call_before_wait(f):
+    """Makes the dispatcher call *f* once, as soon as all tasks are blocked and right before it waits for IO events.
+    This can be used to batch up work (e.g. flushing of buffers) that was requested by several tasks in the same loop iteration.
+    *f* is not called from a task, so it must not block or use channels. Callbacks registered by *f* are run before
+    the dispatcher waits for IO"""
+    _before_wait.append(f)
+
 #monkey patch sys exit to call our quit in order
 #to properly finish our dispatch loop
 sys._exit = sys.exit
@@ -795,13 +910,26 @@ def _dispatch(f = None):
         #ad infinitum...
         while _running:
             #first let any tasklets run until they have all become blocked on IO
-            try:
-                while stackless.getruncount() > 1:
-                    stackless.schedule()
-            except TaskletExit:
-                pass
-            except:
-                logging.exception("unhandled exception in dispatch schedule")
+            while True:
+                try:
+                    while stackless.getruncount() > 1:
+                        stackless.schedule()
+                except TaskletExit:
+                    pass
+                except:
+                    logging.exception("unhandled exception in dispatch schedule")
+                if not _before_wait:
+                    break
+                #all tasks are blocked, do any work that was deferred till now
+                callbacks = _before_wait[:]
+                del _before_wait[:]
+                for f in callbacks:
+                    try:
+                        f()
+                    except TaskletExit:
+                        raise
+                    except:
+                        logging.exception("unhandled exception in before wait callback")
 
             #now block on IO till any IO is ready.
             #care has been taken to not callback directly into python
@@ -809,6 +937,7 @@ def _dispatch(f = None):
             #make stackless need to use hard-switching, which is slow.
             #so we call 'loop' which blocks until something available.
             try:
+                _timeouts.arm()
                 _event.loop()
             except TaskletExit:
                 raise
@@ -819,10 +948,10 @@ def _dispatch(f = None):
             #call the callback which is available as the 'data' object of the event
             #some callbacks may trigger direct action (for instance timeouts, signals)
             #others might resume a waiting task (socket io).
-            while _event.has_next():
+            #all triggered events are fetched in one call to keep the python/c crossings down
+            for e in _event.drain():
                 try:
-                    e, event_type, fd = _event.next()
-                    e.data(event_type)
+                    e.data(e.flags)
                 except TaskletExit:
                     raise
                 except:
@@ -834,6 +963,7 @@ def _dispatch(f = None):
         del event_interrupt
         event_heartbeat.close()
         del event_heartbeat
+        _timeouts.close()
 
     if DEBUG_LEAK:
         logging.warn("alive objects:")
@@ -237,7 +237,9 @@ cdef class PacketReader:
     def read_length_coded_binary(self):
         return self._read_length_coded_binary()
             
-    cdef _read_bytes_length_coded(self):
+    cdef int _read_length_coded_size(self) except -2:
+        #reads the length of a length coded string and checks that the string is in the packet.
+        #returns -1 for NULL, the position is only updated if the complete string is available
         cdef unsigned int n, w
         cdef Buffer packet
         
@@ -248,7 +250,7 @@ cdef class PacketReader:
         if n >= 251:
             if n == 251:
                 packet._position = packet._position + 1
-                return None
+                return -1
             elif n == 252:
                 if packet._position + 2 > packet._limit: raise  BufferUnderflowError()
                 n = packet._buff[packet._position + 1] | ((packet._buff[packet._position + 2]) << 8)  
@@ -259,12 +261,31 @@ cdef class PacketReader:
         if (n + w) > (packet._limit - packet._position):
             raise BufferUnderflowError()
         packet._position = packet._position + w
+        return n
+
+    cdef _read_bytes_length_coded(self):
+        cdef int n
+        cdef Buffer packet
+
+        n = self._read_length_coded_size()
+        if n == -1:
+            return None
+        packet = self.packet
         s = PyString_FromStringAndSize(<char *>(packet._buff + packet._position), n)
         packet._position = packet._position + n
         return s
         
     def read_bytes_length_coded(self):
         return self._read_bytes_length_coded()
+
+    def read_view_length_coded(self):
+        """like read_bytes_length_coded, but returns a Buffer view on the bytes in the packet instead of a copy.
+        The view is only valid until the next packet is read"""
+        cdef int n
+        n = self._read_length_coded_size()
+        if n == -1:
+            return None
+        return self.packet._read_view(n)
     
     def read_field_type(self):
         cdef int n
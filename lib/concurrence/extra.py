@@ -50,10 +50,13 @@ class TaskletPool(object):
     TRESHOLD = 2.0
     INIT_WORKERS = 2
 
-    def __init__(self):
+    def __init__(self, workers = None):
+        """creates a pool with *workers* (default INIT_WORKERS) initial worker tasks, more are added when the queue stays long"""
+        if workers is None:
+            workers = self.INIT_WORKERS
         self._queue = Deque()
         self._workers = []
-        for i in range(self.INIT_WORKERS):
+        for i in range(workers):
             self._add_worker()
         self._adjuster = Tasklet.interval(1.0, self._adjust, daemon = True)()
         self._queue_len = 0.0
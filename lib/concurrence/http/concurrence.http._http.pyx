@@ -0,0 +1,169 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+"""
+fast http request parser working directly on a concurrence Buffer
+"""
+
+from concurrence.io._io cimport Buffer
+from concurrence.io._io import BufferUnderflowError
+from concurrence.http import HTTPError
+
+cdef extern from "string.h":
+    cdef void *memchr(void *, int, int)
+
+cdef extern from "Python.h":
+    object PyString_FromStringAndSize(char *, int)
+    char *PyString_AS_STRING(object)
+
+cdef int _find_header_end(char *start, char *end):
+    #returns the position right after the empty line ending the header block, or -1 if the block is not complete yet
+    cdef char *p, *nl
+    p = start
+    while p < end:
+        nl = <char *>memchr(p, 10, end - p)
+        if nl == NULL:
+            return -1
+        if nl + 1 < end and nl[1] == 10: # \n\n
+            return nl + 2 - start
+        if nl + 2 < end and nl[1] == 13 and nl[2] == 10: # \n\r\n
+            return nl + 3 - start
+        p = nl + 1
+    return -1
+
+cdef object _strip(char *start, char *end):
+    #returns the string between start and end without leading and trailing whitespace
+    while start < end and (start[0] == 32 or start[0] == 9):
+        start = start + 1
+    while end > start and (end[-1] == 32 or end[-1] == 9 or end[-1] == 13):
+        end = end - 1
+    return PyString_FromStringAndSize(start, end - start)
+
+cdef object _environ_key(char *start, char *end):
+    #converts header name to wsgi environ key, e.g. Content-Type -> HTTP_CONTENT_TYPE
+    cdef int i, n
+    cdef char c
+    cdef char *k
+    while end > start and (end[-1] == 32 or end[-1] == 9):
+        end = end - 1
+    n = end - start
+    key = PyString_FromStringAndSize(NULL, n + 5)
+    k = PyString_AS_STRING(key)
+    k[0] = c'H'
+    k[1] = c'T'
+    k[2] = c'T'
+    k[3] = c'P'
+    k[4] = c'_'
+    for i from 0 <= i < n:
+        c = start[i]
+        if c == c'-':
+            c = c'_'
+        elif c >= c'a' and c <= c'z':
+            c = c - 32
+        k[i + 5] = c
+    return key
+
+cdef object _parse_uri(char *start, char *end, object environ):
+    #sets PATH_INFO and QUERY_STRING from the request uri, compatible with urlparse
+    cdef char *p, *path, *path_end, *query, *query_end
+    path = start
+    if end - start > 2 and start[0] != c'/':
+        #absolute uri, skip scheme and netloc
+        p = <char *>memchr(start, c':', end - start)
+        if p != NULL and p + 2 < end and p[1] == c'/' and p[2] == c'/':
+            path = p + 3
+            while path < end and path[0] != c'/' and path[0] != c'?' and path[0] != c'#':
+                path = path + 1
+    path_end = path
+    while path_end < end and path_end[0] != c'?' and path_end[0] != c'#':
+        path_end = path_end + 1
+    query = query_end = path_end
+    if path_end < end and path_end[0] == c'?':
+        query = path_end + 1
+        query_end = query
+        while query_end < end and query_end[0] != c'#':
+            query_end = query_end + 1
+    #strip ;params from last path segment
+    p = path_end
+    while p > path and p[-1] != c'/':
+        p = p - 1
+    while p < path_end and p[0] != c';':
+        p = p + 1
+    environ['PATH_INFO'] = PyString_FromStringAndSize(path, p - path)
+    environ['QUERY_STRING'] = PyString_FromStringAndSize(query, query_end - query)
+
+def parse_request(Buffer buffer, object environ):
+    """Parses a complete http request header block (request line and headers) from *buffer* into the wsgi
+    *environ* dict (REQUEST_METHOD, PATH_INFO, QUERY_STRING and HTTP_XXX keys).
+    Returns a tuple (method, uri, version) and updates the buffer position to the start of the request body.
+    Raises :exc:`BufferUnderflowError` if the buffer does not contain the complete header block yet,
+    in that case the buffer position is not changed.
+    """
+    cdef char *start, *end, *p, *nl, *line_end, *colon, *t1, *t2
+    cdef int n
+
+    start = <char *>(buffer._buff + buffer._position)
+    end = <char *>(buffer._buff + buffer._limit)
+    #skip empty lines before the request line
+    p = start
+    while p < end and (p[0] == 13 or p[0] == 10):
+        p = p + 1
+
+    n = _find_header_end(p, end)
+    if n == -1:
+        raise BufferUnderflowError()
+    end = p + n
+
+    #request line
+    nl = <char *>memchr(p, 10, end - p)
+    line_end = nl
+    while line_end > p and (line_end[-1] == 13 or line_end[-1] == 32):
+        line_end = line_end - 1
+    t1 = <char *>memchr(p, 32, line_end - p)
+    if t1 == NULL:
+        raise HTTPError('Invalid request line')
+    method = PyString_FromStringAndSize(p, t1 - p)
+    while t1 < line_end and t1[0] == 32:
+        t1 = t1 + 1
+    t2 = <char *>memchr(t1, 32, line_end - t1)
+    if t2 == NULL:
+        raise HTTPError('Invalid request line')
+    uri = PyString_FromStringAndSize(t1, t2 - t1)
+    _parse_uri(t1, t2, environ)
+    while t2 < line_end and t2[0] == 32:
+        t2 = t2 + 1
+    version = PyString_FromStringAndSize(t2, line_end - t2)
+    environ['REQUEST_METHOD'] = method
+
+    #headers
+    last_key = None
+    p = nl + 1
+    while p < end:
+        nl = <char *>memchr(p, 10, end - p)
+        line_end = nl
+        if line_end > p and line_end[-1] == 13:
+            line_end = line_end - 1
+        if line_end == p:
+            break #empty line, end of headers
+        if p[0] == 32 or p[0] == 9:
+            #continuation of previous header (folding)
+            if last_key is None:
+                raise HTTPError('Invalid header continuation line')
+            environ[last_key] = environ[last_key] + ' ' + _strip(p, line_end)
+        else:
+            colon = <char *>memchr(p, c':', line_end - p)
+            if colon == NULL:
+                raise HTTPError('Invalid header line')
+            key = _environ_key(p, colon)
+            value = _strip(colon + 1, line_end)
+            if key in environ:
+                environ[key] = environ[key] + ',' + value #comma-separate multiple headers
+            else:
+                environ[key] = value
+            last_key = key
+        p = nl + 1
+
+    buffer._position = buffer._position + (end - start)
+    return method, uri, version
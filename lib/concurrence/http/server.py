@@ -7,17 +7,21 @@
 
 from __future__ import with_statement
 
+import os
+import time
 import logging
+import itertools
 import urlparse
 import httplib
 import traceback
 import rfc822
 
 from concurrence import Tasklet, Message, Channel, TimeoutError, __version__
-from concurrence.io import Server, BufferedStream
+from concurrence.io import Server, BufferedStream, BufferUnderflowError
 from concurrence.containers import ReorderQueue
 from concurrence.timer import Timeout
 from concurrence.http import HTTPError
+from concurrence.http._http import parse_request
 
 SERVER_ID = "Concurrence-Http/%s" % __version__
 
@@ -25,9 +29,19 @@ CHUNK_SIZE = 1024 * 4
 
 HTTP_READ_TIMEOUT = 300 #default read timeout, if no request was read within this time, the connection is closed by server
 
+_date = (0, None)
+
+def _http_date():
+    """returns the current date formatted for the Date header, formatting is cached per second"""
+    global _date
+    now = int(time.time())
+    if now != _date[0]:
+        _date = (now, rfc822.formatdate(now))
+    return _date[1]
+
 
 class WSGIInputStream(object):
-    def __init__(self, request, reader):
+    def __init__(self, request, reader, serial = False):
         transfer_encoding = request.get_request_header('Transfer-Encoding')
         if transfer_encoding is not None and transfer_encoding == 'chunked':
             assert False, 'chunked post not supported yet'
@@ -40,7 +54,10 @@ class WSGIInputStream(object):
         else:
             self._n = int(content_length)
             self._file = reader.file()
-            self._channel = Channel()
+            if serial:
+                self._channel = None #request is handled by the reader, no need to sync
+            else:
+                self._channel = Channel()
     
     def _read_request_data(self):
         if self._n is not None:
@@ -53,12 +70,19 @@ class WSGIInputStream(object):
             if self._n == 0:
                 self._n = None
                 self._file = None
-                self._channel.send(True) #unblock reader
-                self._channel = None
+                if self._channel is not None:
+                    self._channel.send(True) #unblock reader
+                    self._channel = None
             return data
         else:
             return '' #EOF
         
+    def _skip_request_data(self):
+        #reads and discards any input data that was not read by the handler
+        while self._n > 0:
+            if not self.read(CHUNK_SIZE):
+                raise EOFError("while skipping request data")
+
     def readline(self):
         assert False, 'TODO'
 
@@ -69,6 +93,37 @@ class WSGIInputStream(object):
         assert False, 'TODO'
 
 
+class WSGIFileWrapper(object):
+    """Implementation of wsgi.file_wrapper. If the wrapped *filelike* object has a fileno, the server will
+    send its contents directly from the file to the socket using sendfile(2), otherwise it is iterated in
+    blocks of *block_size* like any other response."""
+    def __init__(self, filelike, block_size = CHUNK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def fileno(self):
+        if hasattr(self.filelike, 'fileno'):
+            return self.filelike.fileno()
+        else:
+            return None
+
+    def tell(self):
+        if hasattr(self.filelike, 'tell'):
+            return self.filelike.tell()
+        else:
+            return 0
+
+    def __iter__(self):
+        while True:
+            block = self.filelike.read(self.block_size)
+            if not block: break
+            yield block
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+
 class WSGIErrorStream(object):
     def write(self, s):
         logging.error(s)
@@ -119,44 +174,122 @@ class WSGIRequest(object):
         return self.environ.get(http_key, None)
 
     def write_response(self, response, writer):
+        try:
+            if isinstance(response, WSGIFileWrapper) and hasattr(writer.stream, 'sendfile') and response.fileno() is not None:
+                self._write_file_response(response, writer)
+            else:
+                self._write_response(response, writer)
+        finally:
+            #as required by wsgi spec
+            if hasattr(response, 'close'):
+                response.close()
+
+    def _write_response(self, response, writer):
         self.state = self.STATE_WRITING_HEADER
-        
-        if self.version == 'HTTP/1.0':
-            chunked = False
-        else:
-            chunked = True
 
-        writer.clear()
-        
-        writer.write_bytes("%s %s\r\n" % (self.version, self.status))        
+        if type(response) == str:
+            response = [response]
+        elif type(response) not in (list, tuple):
+            #the application might only call start_response when the first part is generated, as allowed by wsgi
+            iterator = iter(response)
+            try:
+                response = itertools.chain([iterator.next()], iterator)
+            except StopIteration:
+                response = []
+
+        content_length = None
+        headers = ["%s %s\r\n" % (self.version, self.status)]
         for header_name, header_value in self.response_headers:
             if header_name in self._disallowed_application_headers: continue
-            writer.write_bytes("%s: %s\r\n" % (header_name, header_value))
-        writer.write_bytes("Date: %s\r\n" % rfc822.formatdate())
-        writer.write_bytes("Server: %s\r\n" % SERVER_ID) 
+            if header_name.lower() == 'content-length':
+                content_length = int(header_value)
+            headers.append("%s: %s\r\n" % (header_name, header_value))
+        headers.append("Date: %s\r\nServer: %s\r\n" % (_http_date(), SERVER_ID))
 
+        #a content length given by the application is checked against the body it actually returns
+        check_length = content_length is not None
+
+        #only use chunked encoding if we cannot determine the content length up front,
+        #e.g. for true generators that did not give a content-length header
+        if content_length is None:
+            if type(response) in (list, tuple):
+                content_length = sum([len(part) for part in response])
+                headers.append("Content-Length: %d\r\n" % content_length)
+            elif self.version == 'HTTP/1.0':
+                response = [''.join(response)]
+                content_length = len(response[0])
+                headers.append("Content-Length: %d\r\n" % content_length)
+        chunked = content_length is None
         if chunked:
-            writer.write_bytes("Transfer-Encoding: chunked\r\n")
-        else:
-            response = ''.join(response)
-            writer.write_bytes("Content-length: %d\r\n" % len(response))
-        
-        writer.write_bytes("\r\n")
-    
+            headers.append("Transfer-Encoding: chunked\r\n")
+        headers.append("\r\n")
+
+        writer.write_bytes(''.join(headers))
+
         self.state = self.STATE_WRITING_DATA
-        
+
         if chunked:
             for chunk in response:
-                writer.write_bytes("%x;\r\n" % len(chunk))
-                writer.write_bytes(chunk)
-                writer.write_bytes("\r\n")
-                
+                n = len(chunk)
+                if n == 0:
+                    continue #an empty chunk would end the response
+                elif n < CHUNK_SIZE:
+                    writer.write_bytes("%x\r\n%s\r\n" % (n, chunk))
+                else:
+                    #large chunk, don't copy it
+                    writer.write_bytes("%x\r\n" % n)
+                    writer.write_bytes(chunk)
+                    writer.write_bytes("\r\n")
             writer.write_bytes("0\r\n\r\n")
+        elif check_length:
+            written = 0
+            for part in response:
+                if written + len(part) > content_length:
+                    #never send more than announced, the client would take the rest for the next response
+                    writer.write_bytes(part[:content_length - written])
+                    written += len(part)
+                    break
+                writer.write_bytes(part)
+                written += len(part)
         else:
-            writer.write_bytes(response)
+            for part in response:
+                writer.write_bytes(part)
 
         writer.flush() #TODO use special header to indicate no flush needed
-        
+
+        if check_length and written != content_length:
+            #the client can not tell where this response ends, so the connection must be closed
+            raise HTTPError('response body does not match Content-Length: %d' % content_length)
+
+        self.state = self.STATE_FINISHED
+
+    def _write_file_response(self, response, writer):
+        """writes the headers trough the writer and then the file directly to the socket using sendfile"""
+        self.state = self.STATE_WRITING_HEADER
+
+        fd = response.fileno()
+        offset = response.tell()
+        content_length = None
+        for header_name, header_value in self.response_headers:
+            if header_name.lower() == 'content-length':
+                content_length = int(header_value)
+
+        writer.write_bytes("%s %s\r\n" % (self.version, self.status))
+        for header_name, header_value in self.response_headers:
+            if header_name in self._disallowed_application_headers: continue
+            writer.write_bytes("%s: %s\r\n" % (header_name, header_value))
+        writer.write_bytes("Date: %s\r\nServer: %s\r\n" % (_http_date(), SERVER_ID))
+        if content_length is None:
+            content_length = os.fstat(fd).st_size - offset
+            writer.write_bytes("Content-Length: %d\r\n" % content_length)
+        writer.write_bytes("\r\n")
+        writer.flush(True) #headers must be written before we send the file directly to the socket
+
+        self.state = self.STATE_WRITING_DATA
+
+        if writer.stream.sendfile(fd, offset, content_length) != content_length:
+            raise EOFError("file shorter than content length while writing response")
+
         self.state = self.STATE_FINISHED
     
     def handle_request(self, application):
@@ -171,56 +304,47 @@ class WSGIRequest(object):
     def read_request_data(self):
         self.environ['wsgi.input']._read_request_data()
 
-    def read_request(self, reader):
+    def read_request(self, reader, serial = False, idle_stream = None):
         with Timeout.push(self._server.read_timeout):
-            self._read_request(reader)
+            if idle_stream is not None:
+                #give the buffers of the stream back while waiting, the reader is taken again when data arrives
+                idle_stream.wait_readable()
+                reader = idle_stream.reader
+            self._read_request(reader, serial)
 
-    def _read_request(self, reader):
+    def _read_request(self, reader, serial):
 
         self.state = self.STATE_WAIT_FOR_REQUEST
-        
-        #setup readline iterator        
-        lines = reader.read_lines()
-        
-        #parse status line, this will block to read the first request line
-        line = lines.next().split()
-        
-        self.state = self.STATE_READING_HEADER
-        
-        u = urlparse.urlparse(line[1])
-        
-        self.method = line[0]
+
+        #parse the complete header block at once, this will block until it is read
+        buffer = reader.buffer
+        while True:
+            if buffer.remaining:
+                self.state = self.STATE_READING_HEADER
+                try:
+                    self.method, self.uri, self.version = parse_request(buffer, self.environ)
+                    break
+                except BufferUnderflowError:
+                    if buffer.position == 0 and buffer.remaining == buffer.capacity:
+                        #header block does not fit in read buffer, parse it line by line
+                        self.method, self.uri, self.version = self._parse_request_lines(reader)
+                        break
+            reader._read_more()
+
         if self.method not in ['GET', 'POST']:
             raise HTTPError('Unsupported method: %s' % self.method)
 
         #TODO validate version
-        self.version = line[2]
-        self.uri = line[1]
 
         #build up the WSGI environment
-        self.environ['REQUEST_METHOD'] = line[0]
         self.environ['SCRIPT_NAME'] = '' #TODO
-        self.environ['PATH_INFO'] = u[2]
-        self.environ['QUERY_STRING'] = u[4]
-        
+
         self.environ['wsgi.url_scheme'] = 'http'
         self.environ['wsgi.multiprocess'] = False
         self.environ['wsgi.multithread'] = True
         self.environ['wsgi.run_once'] = False
         self.environ['wsgi.version'] = (1, 0)
-        
-        #rest of request headers
-        for line in lines:
-            if not line: break
-            key, value = line.split(': ')
-            key = key.replace('-', '_').upper()
-            value = value.strip()
-            
-            http_key = 'HTTP_' + key 
-            if http_key in self.environ:
-                self.environ[http_key] += ',' + value # comma-separate multiple headers
-            else:
-                self.environ[http_key] = value
+        self.environ['wsgi.file_wrapper'] = WSGIFileWrapper
 
         #wsgi complience 
         if 'HTTP_CONTENT_LENGTH' in self.environ:
@@ -230,7 +354,7 @@ class WSGIRequest(object):
             self.environ['CONTENT_TYPE'] = self.environ['HTTP_CONTENT_TYPE']
 
         #setup required wsgi streams
-        self.environ['wsgi.input'] = WSGIInputStream(self, reader)
+        self.environ['wsgi.input'] = WSGIInputStream(self, reader, serial)
         self.environ['wsgi.errors'] = WSGIErrorStream()
         
         if not 'HTTP_HOST' in self.environ:
@@ -252,7 +376,50 @@ class WSGIRequest(object):
         self.environ['SERVER_PROTOCOL'] = self.version
         
         self.state = self.STATE_REQUEST_READ
-        
+
+    def _parse_request_lines(self, reader):
+        """line by line python version of :func:`parse_request`, used for header blocks larger than the read buffer"""
+        #setup readline iterator
+        lines = reader.read_lines()
+
+        #parse status line, skipping empty lines before it
+        line = ''
+        while not line:
+            line = lines.next()
+        line = line.split()
+        if len(line) < 3:
+            raise HTTPError('Invalid request line')
+
+        u = urlparse.urlparse(line[1])
+
+        self.environ['REQUEST_METHOD'] = line[0]
+        self.environ['PATH_INFO'] = u[2]
+        self.environ['QUERY_STRING'] = u[4]
+
+        #rest of request headers, accepting the same lines as parse_request
+        http_key = None
+        for header_line in lines:
+            if not header_line: break
+            if header_line[0] in ' \t':
+                #continuation of previous header (folding)
+                if http_key is None:
+                    raise HTTPError('Invalid header continuation line')
+                self.environ[http_key] += ' ' + header_line.strip()
+                continue
+            if ':' not in header_line:
+                raise HTTPError('Invalid header line')
+            key, value = header_line.split(':', 1)
+            key = key.replace('-', '_').upper()
+            value = value.strip()
+
+            http_key = 'HTTP_' + key
+            if http_key in self.environ:
+                self.environ[http_key] += ',' + value # comma-separate multiple headers
+            else:
+                self.environ[http_key] = value
+
+        return line[0], line[1], line[2]
+
 
 class HTTPHandler(object):
     log = logging.getLogger('HTTPHandler')
@@ -277,13 +444,15 @@ class HTTPHandler(object):
             self.log.exception("Exception in writer")
             self.MSG_WRITE_ERROR.send(control)(None, None)
 
-    def read_requests(self, control, stream):
+    def read_request(self, request, stream, serial = False, idle = False):
+        """reads the next request from the stream, returns False if the connection should be closed.
+        If *idle* is True, the stream's buffers are given back to the pool while waiting for the request to arrive"""
         try:
-            while True:
-                request = WSGIRequest(self._server)
-                request.read_request(stream.reader)                
-                self.MSG_REQUEST_READ.send(control)(request, None)
-                request.read_request_data()
+            if idle:
+                request.read_request(None, serial, stream)
+            else:
+                request.read_request(stream.reader, serial)
+            return True
         except EOFError, e:
             if request.state == request.STATE_WAIT_FOR_REQUEST:
                 pass #this is normal at the end of the http KA connection (client closes) 
@@ -294,22 +463,88 @@ class HTTPHandler(object):
             self.log.warn("Timeout in reader")
         except Exception, e:
             self.log.exception("Exception in reader")
+        return False
+
+    def read_requests(self, control, stream):
+        while True:
+            request = WSGIRequest(self._server)
+            if not self.read_request(request, stream):
+                break
+            self.MSG_REQUEST_READ.send(control)(request, None)
+            request.read_request_data()
 
         self.MSG_READ_ERROR.send(control)(None, None)
 
+    def keep_alive(self, request):
+        """returns whether the connection can be used for more requests after the response to *request* was written"""
+        if request.version == 'HTTP/1.0':
+            return False #no keep-alive support in http 1.0
+        elif request.get_response_header('Connection') == 'close':
+            return False #response indicated to close after response
+        elif request.get_request_header('Connection') == 'close':
+            return False #request indicated to close after response
+        else:
+            return True
+
     def handle_request(self, control, request, application):
         response = self._server.handle_request(request, application)
         self.MSG_REQUEST_HANDLED.send(control)(request, response)       
 
     def handle(self, socket, application):
         stream = BufferedStream(socket)
-        #implements http1.1 keep alive handler
+        try:
+            if self._server.serial:
+                self.handle_serial(stream, application)
+            else:
+                self.handle_pipelined(stream, application)
+        finally:
+            #close our side of the socket
+            stream.close()
+
+    def handle_serial(self, stream, application):
+        """Reads, handles and writes requests one after the other in the current task.
+        This is the fast path for the common case of a client doing one request at a time on a keep-alive connection.
+        As soon as the client starts pipelining requests, the rest of the connection is handled
+        by :func:`handle_pipelined`."""
+        idle = False
+        while True:
+            if stream.reader.buffer.remaining:
+                #next request arrived before we finished the previous one
+                return self.handle_pipelined(stream, application)
+            request = WSGIRequest(self._server)
+            if not self.read_request(request, stream, True, idle):
+                return
+            if stream.reader.buffer.remaining and not request.environ['wsgi.input']._n:
+                #next request is already buffered (requests with a body are finished serially first)
+                return self.handle_pipelined(stream, application, request)
+            try:
+                response = self._server.handle_request(request, application)
+                request.write_response(response, stream.writer)
+                request.environ['wsgi.input']._skip_request_data()
+            except Exception, e:
+                self.log.exception("Exception in serial handler")
+                return
+            if not self.keep_alive(request):
+                return
+            #between requests of a keep-alive connection we don't need to hold on to the buffers
+            idle = True
+
+    def handle_pipelined(self, stream, application, request = None):
+        #implements http1.1 keep alive handler with support for pipelining
         #there are several concurrent tasks for each connection; 
         #1 for reading requests, 1 or more for handling requests and 1 for writing responses
         #the current task (the one created to handle the socket connection) is the controller task,
         #e.g. it coordinates the actions of it's children by message passing
         control = Tasklet.current()
 
+        #the responses to a batch of pipelined requests are written out together
+        stream.defer_flush = True
+
+        if request is not None:
+            #continue with request already read by handle_serial
+            self._reque.start(request)
+            Tasklet.new(self.handle_request, name = 'request_handler')(control, request, application)
+
         #writes responses back to the client when they are ready:
         response_writer = Tasklet.new(self.write_responses, name = 'response_writer')(control, stream)
         #reads requests from clients:
@@ -335,12 +570,8 @@ class HTTPHandler(object):
                     self.MSG_WRITE_RESPONSE.send(response_writer)(request, response)
                     
             elif msg.match(self.MSG_RESPONSE_WRITTEN):
-                if request.version == 'HTTP/1.0':
-                    break #no keep-alive support in http 1.0
-                elif request.get_response_header('Connection') == 'close':
-                    break #response indicated to close after response
-                elif request.get_request_header('Connection') == 'close':
-                    break #request indicated to close after response
+                if not self.keep_alive(request):
+                    break
             elif msg.match(self.MSG_READ_ERROR):
                 break #stop and close the connection
             elif msg.match(self.MSG_WRITE_ERROR):
@@ -352,9 +583,6 @@ class HTTPHandler(object):
         #any outstanding request will continue, but will exit by themselves
         response_writer.kill()
         request_reader.kill()
-   
-        #close our side of the socket
-        stream.close()
         
 class WSGIServer(object):
     """A HTTP/1.1 Web server with WSGI application interface.
@@ -372,6 +600,8 @@ class WSGIServer(object):
     
     read_timeout = HTTP_READ_TIMEOUT
 
+    serial = True #handle requests serially until the client starts pipelining, if False always use the pipelined handler
+
     def __init__(self, application, request_log_level = logging.DEBUG):
         """Create a new WSGIServer serving the given *application*. Optionally
         the *request_log_level* can be given. This loglevel is used for logging the requests."""
@@ -5,7 +5,7 @@
 
 
 from concurrence import TIMEOUT_CURRENT
-from _io import Buffer, BufferOverflowError, BufferUnderflowError, BufferInvalidArgumentError, get_errno
+from _io import Buffer, BufferPool, BufferOverflowError, BufferUnderflowError, BufferInvalidArgumentError, get_errno
 
 class IOStream(object):
     """abstract class to indicate that something is a stream and capable
@@ -20,6 +20,10 @@ class IOStream(object):
         or raise error, or timeout"""
         pass
 
+    def wait_readable(self, timeout = TIMEOUT_CURRENT):
+        """should wait until the stream can be read from, or raise timeout. The default implementation returns immediately"""
+        pass
+
 from concurrence.io.socket import Socket, SocketServer
 from concurrence.io.buffered import BufferedReader, BufferedWriter, BufferedStream
 
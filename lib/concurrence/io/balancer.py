@@ -0,0 +1,228 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+"""
+File descriptor passing load balancer. A front process accepts all incoming connections and hands them over
+UNIX domain sockets to a number of forked backend processes. Every connection goes to the backend with the least
+active connections. The backends report their number of active connections back over the same UNIX socket.
+
+This spreads long lived (sticky) connections evenly over the backends, unlike a shared listening socket or
+SO_REUSEPORT, which balance new connections but do not know how many connections each process still has open.
+
+Example::
+
+    Balancer(('0.0.0.0', 8080), WSGIServer(application).handle_connection, workers = 4).run()
+
+The front runs until it receives SIGINT, it then stops the backends by closing their channels
+and waits for them to exit.
+Backends that die are not restarted, the front stops passing connections to them.
+"""
+
+import os
+import struct
+import logging
+import _socket
+
+from concurrence import _event, dispatch, quit, Tasklet, Deque, TIMEOUT_NEVER
+from concurrence.io import Buffer
+from concurrence.io.socket import Socket, SocketServer, DEFAULT_BACKLOG
+
+#backend -> front report: total connections received, connections active
+REPORT = struct.Struct('<II')
+
+class BackendServer(SocketServer):
+    """Serves the connections that the front passes over *channel* (a connected UNIX :class:`Socket`)
+    by calling *handler* for each of them, and reports the number of active connections back to the front."""
+    log = logging.getLogger('BackendServer')
+
+    def __init__(self, channel, handler, socket_family = _socket.AF_INET):
+        SocketServer.__init__(self, channel, handler)
+        self._socket_family = socket_family
+        self._received = 0
+        self._changed = Deque()
+        self._report_task = None
+
+    def _report(self):
+        #wake up reporter, multiple changes before it runs result in a single report
+        if not self._changed:
+            self._changed.append(True)
+
+    def _report_task_loop(self):
+        self._changed.popleft(True, TIMEOUT_NEVER)
+        buffer = Buffer(REPORT.size)
+        buffer.write_bytes(REPORT.pack(self._received, self._connection_count))
+        buffer.flip()
+        while buffer.remaining:
+            self._socket.write(buffer, TIMEOUT_NEVER)
+
+    def _accept_task_loop(self):
+        try:
+            accepted_socket = self._socket.read_socket(Socket, self._socket_family, socket_state = Socket.STATE_CONNECTED, timeout = TIMEOUT_NEVER)
+        except EOFError:
+            self.log.info("front closed channel, stopping backend")
+            quit()
+            raise TaskletExit()
+        Tasklet.new(self._handle_accept, self._handler_task_name)(accepted_socket)
+
+    def _handle_accept(self, accepted_socket):
+        #count as received only here, so that a report never includes a connection as received but not yet as active
+        self._received += 1
+        self._report()
+        try:
+            SocketServer._handle_accept(self, accepted_socket)
+        finally:
+            self._report()
+
+    def serve(self):
+        SocketServer.serve(self)
+        self._report_task = Tasklet.loop(self._report_task_loop, name = 'backend_reporter', daemon = True)()
+
+    def close(self):
+        self._report_task.kill()
+        SocketServer.close(self)
+
+class Backend(object):
+    """The front's view on a backend process"""
+    def __init__(self, pid, channel):
+        self.pid = pid
+        self.channel = channel
+        self.alive = True
+        self.sent = 0 #connections passed by the front
+        self.received = 0 #connections received by the backend, as last reported
+        self.active = 0 #active connections in the backend, as last reported
+
+    @property
+    def load(self):
+        """the number of active connections, including the ones that were passed but are not yet reported"""
+        return self.active + self.sent - self.received
+
+    def __repr__(self):
+        return '<Backend pid: %d, alive: %s, load: %d>' % (self.pid, self.alive, self.load)
+
+class Balancer(object):
+    log = logging.getLogger('Balancer')
+
+    ACCEPT_BATCH = 64
+
+    def __init__(self, endpoint, handler, workers = None, backlog = DEFAULT_BACKLOG):
+        """Creates a balancer listening on *endpoint*. Every connection is passed to one of *workers* backend
+        processes (default the number of online cpu's) where it will be handled by calling *handler* with the socket."""
+        if workers is None:
+            workers = os.sysconf('SC_NPROCESSORS_ONLN')
+        assert workers > 0, "need at least 1 worker"
+        self._endpoint = endpoint
+        self._handler = handler
+        self._workers_count = workers
+        self._backlog = backlog
+        if type(endpoint) == str:
+            self._socket_family = _socket.AF_UNIX
+        else:
+            self._socket_family = _socket.AF_INET
+        self._socket = None
+        self._backends = []
+        self._accept_task = None
+
+    @property
+    def backends(self):
+        return self._backends
+
+    def _spawn(self):
+        front_channel, backend_channel = _socket.socketpair(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid != 0:
+            backend_channel.close()
+            backend = Backend(pid, Socket(front_channel, Socket.STATE_CONNECTED))
+            self._backends.append(backend)
+            return backend
+        #child
+        code = 0
+        try:
+            try:
+                front_channel.close()
+                self._socket.socket.close()
+                for backend in self._backends:
+                    backend.channel.socket.close()
+                _event.reinit()
+                def serve():
+                    BackendServer(Socket(backend_channel, Socket.STATE_CONNECTED), self._handler, self._socket_family).serve()
+                dispatch(serve)
+            except SystemExit, e:
+                code = e.code or 0
+            except:
+                self.log.exception("unhandled exception in backend")
+                code = 1
+        finally:
+            os._exit(code)
+
+    def _select(self):
+        """returns the alive backend with the lowest load"""
+        selected = None
+        for backend in self._backends:
+            if backend.alive and (selected is None or backend.load < selected.load):
+                selected = backend
+        return selected
+
+    def _read_reports(self, backend):
+        buffer = Buffer(1024)
+        try:
+            while True:
+                if backend.channel.read(buffer, TIMEOUT_NEVER) == 0:
+                    raise EOFError()
+                buffer.flip()
+                while buffer.remaining >= REPORT.size:
+                    backend.received, backend.active = REPORT.unpack(buffer.read_bytes(REPORT.size))
+                buffer.compact()
+        except EOFError:
+            self.log.warn("backend %d went away", backend.pid)
+        except TaskletExit:
+            raise
+        except:
+            self.log.exception("while reading reports of backend %d", backend.pid)
+        backend.alive = False
+        backend.channel.close()
+        try:
+            os.waitpid(backend.pid, 0)
+        except OSError:
+            pass
+
+    def _accept_task_loop(self):
+        for accepted_socket in self._socket.accept_many(self.ACCEPT_BATCH):
+            try:
+                backend = self._select()
+                if backend is None:
+                    self.log.error("no backends alive, dropping connection")
+                else:
+                    backend.channel.write_socket(accepted_socket, TIMEOUT_NEVER)
+                    backend.sent += 1
+            finally:
+                #the backend has its own copy now
+                accepted_socket.close()
+
+    def _front(self):
+        for backend in self._backends:
+            Tasklet.new(self._read_reports, name = 'backend_reports', daemon = True)(backend)
+        self._accept_task = Tasklet.loop(self._accept_task_loop, name = 'balancer_acceptor', daemon = True)()
+
+    def run(self):
+        """binds the listening socket, starts the backends and then balances incoming connections until SIGINT"""
+        self._socket = Socket.server(self._endpoint, self._backlog)
+        for i in range(self._workers_count):
+            self._spawn()
+        try:
+            dispatch(self._front)
+        finally:
+            self._stop_backends()
+
+    def _stop_backends(self):
+        #backends stop when their channel is closed
+        for backend in self._backends:
+            if backend.alive:
+                backend.channel.socket.close()
+        for backend in self._backends:
+            if backend.alive:
+                try:
+                    os.waitpid(backend.pid, 0)
+                except OSError:
+                    pass
@@ -4,157 +4,37 @@
 # the New BSD License: http://www.opensource.org/licenses/bsd-license.php
 
 from concurrence import TIMEOUT_CURRENT
-from concurrence.io import IOStream, Buffer, BufferOverflowError, BufferUnderflowError, BufferInvalidArgumentError
-
-
-class BufferedReader(object):
-    def __init__(self, stream, buffer):
-        assert stream is None or isinstance(stream, IOStream)
-        self.stream = stream
-        self.buffer = buffer
-        #assume no reading from underlying stream was done, so make sure buffer reflects this:
-        self.buffer.position = 0
-        self.buffer.limit = 0
-
-    def file(self):
-        return CompatibleFile(self, None)
-
-    def clear(self):
-        self.buffer.clear()
-
-    def _read_more(self):
-        #any partially read data will be put in front, otherwise normal clear:
-        self.buffer.compact()
-        if not self.stream.read(self.buffer, TIMEOUT_CURRENT):
-            raise EOFError("while reading")
-        self.buffer.flip() #prepare to read from buffer
-
-    def read_lines(self):
-        """note that it cant read line accross buffer"""
-        if self.buffer.remaining == 0:
-            self._read_more()
-        while True:
-            try:
-                yield self.buffer.read_line()
-            except BufferUnderflowError:
-                self._read_more()
-
-    def read_line(self):
-        """note that it cant read line accross buffer"""
-        if self.buffer.remaining == 0:
-            self._read_more()
-        while True:
-            try:
-                return self.buffer.read_line()
-            except BufferUnderflowError:
-                self._read_more()
-
-    def read_bytes_available(self):
-        if self.buffer.remaining == 0:
-            self._read_more()
-        return self.buffer.read_bytes(-1)
-
-    def read_bytes(self, n):
-        """read exactly n bytes from stream"""
-        buffer = self.buffer
-        s = []
-        while n > 0:
-            r = buffer.remaining
-            if r > 0:
-                s.append(buffer.read_bytes(min(n, r)))
-                n -= r
-            else:
-                self._read_more()
-
-        return ''.join(s)
-
-    def read_int(self):
-        if self.buffer.remaining == 0:
-            self._read_more()
-        while True:
-            try:
-                return self.buffer.read_int()
-            except BufferUnderflowError:
-                self._read_more()
-
-    def read_short(self):
-        if self.buffer.remaining == 0:
-            self._read_more()
-        while True:
-            try:
-                return self.buffer.read_short()
-            except BufferUnderflowError:
-                self._read_more()
-
-class BufferedWriter(object):
-    def __init__(self, stream, buffer):
-        assert stream is None or isinstance(stream, IOStream)
-        self.stream = stream
-        self.buffer = buffer
+from concurrence.io import IOStream, Buffer, BufferPool, BufferOverflowError, BufferUnderflowError, BufferInvalidArgumentError
+from concurrence.io._io import BufferedReader, BufferedWriter
 
-    def file(self):
-        return CompatibleFile(None, self)
-
-    def clear(self):
-        self.buffer.clear()
-
-    def write_bytes(self, s):
-        assert type(s) == str, "arg must be a str, got: %s" % type(s)
-        try:
-            self.buffer.write_bytes(s)
-        except BufferOverflowError:
-            #we need to send it in parts, flushing as we go
-            while s:
-                r = self.buffer.remaining
-                part, s = s[:r], s[r:]
-                self.buffer.write_bytes(part)
-                self.flush()
-
-    def write_byte(self, ch):
-        assert type(ch) == int, "ch arg must be int"
-        while True:
-            try:
-                self.buffer.write_byte(ch)
-                return
-            except BufferOverflowError:
-                self.flush()
-
-    def write_short(self, i):
-        while True:
-            try:
-                self.buffer.write_short(i)
-                return
-            except BufferOverflowError:
-                self.flush()
-
-    def write_int(self, i):
-        while True:
-            try:
-                self.buffer.write_int(i)
-                return
-            except BufferOverflowError:
-                self.flush()
-
-    def flush(self):
-        self.buffer.flip()
-        while self.buffer.remaining:
-            if not self.stream.write(self.buffer, TIMEOUT_CURRENT):
-                raise EOFError("while writing")
-        self.buffer.clear()
 
 class BufferedStream(object):
+    """Buffers reads and writes on top of *stream*. The read and write buffers are taken from
+    the :attr:`buffer_pool` when first needed, and can be given back to it while the stream is idle using
+    :func:`wait_readable` or when using :func:`get_reader`/:func:`get_writer`."""
 
-    _reader_pool = {} #buffer_size -> [list of readers]
-    _writer_pool = {} #bufffer_size -> [list of writers]
+    buffer_pool = BufferPool()
 
-    __slots__ = ['_stream', '_writer', '_reader', '_read_buffer_size', '_write_buffer_size']
+    __slots__ = ['_stream', '_writer', '_reader', '_read_buffer_size', '_write_buffer_size', '_defer_flush']
 
-    def __init__(self, stream, buffer_size = 1024 * 8, read_buffer_size = 0, write_buffer_size = 0):
+    def __init__(self, stream, buffer_size = 1024 * 8, read_buffer_size = 0, write_buffer_size = 0, defer_flush = False):
+        """If *defer_flush* is True, flushes of the writer are done by the dispatcher (see :attr:`BufferedWriter.defer_flush`)."""
         self._stream = stream
         self._writer = None
         self._reader = None
         self._read_buffer_size = read_buffer_size or buffer_size
         self._write_buffer_size = write_buffer_size or buffer_size
+        self._defer_flush = defer_flush
+
+    def _get_defer_flush(self):
+        return self._defer_flush
+
+    def _set_defer_flush(self, defer_flush):
+        self._defer_flush = defer_flush
+        if self._writer is not None:
+            self._writer.defer_flush = defer_flush
+
+    defer_flush = property(_get_defer_flush, _set_defer_flush)
 
     def flush(self):
         if self._writer:
@@ -163,66 +43,64 @@ class BufferedStream(object):
     @property
     def reader(self):
         if self._reader is None:
-            self._reader = BufferedReader(self._stream, Buffer(self._read_buffer_size))
+            self._reader = BufferedReader(self._stream, self.buffer_pool.get(self._read_buffer_size))
         return self._reader
 
     @property
     def writer(self):
         if self._writer is None:
-            self._writer = BufferedWriter(self._stream, Buffer(self._write_buffer_size))
+            self._writer = BufferedWriter(self._stream, self.buffer_pool.get(self._write_buffer_size))
+            self._writer.defer_flush = self._defer_flush
         return self._writer
 
+    def _release_reader(self):
+        #gives read buffer back to the pool if it does not contain any unread data,
+        #and no views obtained by reader.read_view still reference its bytes
+        if self._reader is not None and not self._reader.buffer.remaining and not self._reader.buffer.shared:
+            self.buffer_pool.release(self._reader.buffer)
+            self._reader = None
+
+    def _release_writer(self):
+        #gives write buffer back to the pool if it does not contain any unflushed data
+        if self._writer is not None and not self._writer.pending and not self._writer.deferred:
+            self.buffer_pool.release(self._writer.buffer)
+            self._writer = None
+
+    def wait_readable(self, timeout = TIMEOUT_CURRENT):
+        """Waits until there is something to read. While waiting the read and write buffers are
+        given back to the pool if they do not contain any data, so that an idle connection does not hold on to them.
+        Any previously obtained :attr:`reader` or :attr:`writer` must not be used after calling this method,
+        get them again from the stream instead. The read buffer is kept as long as views returned by
+        :func:`BufferedReader.read_view` are alive, so their contents remain valid until the next read."""
+        if self._reader is not None and self._reader.buffer.remaining:
+            return
+        self._release_reader()
+        self._release_writer()
+        self._stream.wait_readable(timeout)
+
     class _borrowed_writer(object):
         def __init__(self, stream):
-            buffer_size = stream._write_buffer_size
-            if stream._writer is None:
-                if stream._writer_pool.get(buffer_size, []):
-                    writer = stream._writer_pool[buffer_size].pop()
-                else:
-                    writer = BufferedWriter(None, Buffer(buffer_size))
-            else:
-                writer = stream._writer
-            writer.stream = stream._stream
-            self._writer = writer
             self._stream = stream
+            self._writer = stream.writer
 
         def __enter__(self):
             return self._writer
 
         def __exit__(self, type, value, traceback):
             #TODO!!! handle exception case/exit
-            if self._writer.buffer.position != 0:
-                self._stream._writer = self._writer
-            else:
-                writer_pool = self._stream._writer_pool.setdefault(self._stream._write_buffer_size, [])
-                writer_pool.append(self._writer)
-                self._stream._writer = None
+            self._stream._release_writer()
 
     class _borrowed_reader(object):
         def __init__(self, stream):
-            buffer_size = stream._read_buffer_size
-            if stream._reader is None:
-                if stream._reader_pool.get(buffer_size, []):
-                    reader = stream._reader_pool[buffer_size].pop()
-                else:
-                    reader = BufferedReader(None, Buffer(buffer_size))
-            else:
-                reader = stream._reader
-            reader.stream = stream._stream
-            self._reader = reader
             self._stream = stream
+            self._reader = stream.reader
 
         def __enter__(self):
             return self._reader
 
         def __exit__(self, type, value, traceback):
             #TODO!!! handle exception case/exit
-            if self._reader.buffer.remaining:
-                self._stream._reader = self._reader
-            else:
-                reader_pool = self._stream._reader_pool.setdefault(self._stream._read_buffer_size, [])
-                reader_pool.append(self._reader)
-                self._stream._reader = None
+            self._stream._release_reader()
 
     def get_writer(self):
         return self._borrowed_writer(self)
@@ -231,7 +109,14 @@ class BufferedStream(object):
         return self._borrowed_reader(self)
 
     def close(self):
-        self._stream.close()
+        try:
+            if self._writer is not None and self._writer.deferred:
+                self._writer.flush(True)
+        finally:
+            if self._writer is not None and self._writer.deferred:
+                #could not flush, make sure the dispatcher does not write to the closed fd
+                self._writer.cancel_deferred()
+            self._stream.close()
         del self._stream
         del self._reader
         del self._writer
@@ -6,6 +6,7 @@
 cdef class Buffer:
     cdef unsigned char *_buff
     cdef Buffer _parent
+    cdef int _children #number of buffers (views, duplicates) referencing the memory of this buffer
     cdef readonly int capacity
     cdef int _limit
     cdef int _position
@@ -16,3 +17,6 @@ cdef class Buffer:
     cdef int _write_byte(self, unsigned int b) except -1
 
     cdef object _read_bytes(self, int n)
+    cdef object _read_line(self, int include_separator)
+    cdef _compact(self)
+    cdef Buffer _read_view(self, int n)
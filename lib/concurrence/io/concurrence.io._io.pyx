@@ -5,11 +5,20 @@
 
 import types
 import sys
+import logging
+
+from concurrence import TIMEOUT_CURRENT, call_before_wait, _event
 
 cdef extern from "unistd.h":
    int write(int, void *, int)
    int read(int, void *, int) 
 
+cdef extern from "sys/uio.h":
+    cdef struct iovec:
+        void *iov_base
+        int iov_len
+    int c_writev "writev" (int, iovec *, int)
+
 cdef extern from "string.h":
     cdef void *memmove(void *, void *, int)
     cdef void *memcpy(void *, void *, int)
@@ -21,11 +30,13 @@ cdef extern from "stdlib.h":
 
 cdef extern from "errno.h":
     int errno
+    int EAGAIN
 
 cdef extern from "Python.h":
     object PyString_FromStringAndSize(char *, int)
     object PyString_FromString(char *)
     int PyString_AsStringAndSize(object obj, char **s, Py_ssize_t *len) except -1
+    int PyBuffer_FillInfo(Py_buffer *view, object obj, void *buf, Py_ssize_t len, int readonly, int flags) except -1
 
 cdef extern from "pyerrors.h":    
     object PyErr_SetFromErrno(object)
@@ -33,6 +44,7 @@ cdef extern from "pyerrors.h":
 cdef extern from "io_base.h":
     int sendfd(int, int)
     int recvfd(int)
+    int sendfile_fd(int, int, long long, int)
     
 def error_from_errno(object exc):
     return PyErr_SetFromErrno(exc)
@@ -70,6 +82,7 @@ cdef class Buffer:
             #copy, e.g. we reference the same data as our parent, but have our
             #own position and limit (use .duplicate method to get the copy)
             self._parent = parent #this incs the refcnt on parent
+            parent._children = parent._children + 1
             self._buff = parent._buff
             self._position = parent._position
             self._limit = parent._limit
@@ -84,6 +97,7 @@ cdef class Buffer:
         if self._parent is None:
             free(self._buff)
         else:
+            self._parent._children = self._parent._children - 1
             self._parent = None #releases our refcnt on parent             
         
     def __init__(self, int capacity, Buffer parent = None):
@@ -151,6 +165,11 @@ cdef class Buffer:
         def __get__(self):
             return self._limit - self._position
 
+    property shared:
+        """True while views or duplicates referencing the memory of this buffer exist"""
+        def __get__(self):
+            return self._children > 0
+
     property limit:
         def __get__(self):
             return self._limit
@@ -222,6 +241,9 @@ cdef class Buffer:
         the current :attr:`position` and current :attr:`limit`) will be copied to the start of the buffer. The position of the buffer
         will be right after the copied data.
         """
+        self._compact()
+
+    cdef _compact(self):
         cdef int n
         n = self._limit - self._position 
         if n > 0 and self._position > 0:
@@ -294,6 +316,41 @@ cdef class Buffer:
         else:
             return self._read_bytes(n)
     
+    cdef Buffer _read_view(self, int n):
+        """returns a view on the next n bytes of this buffer and updates position"""
+        cdef Buffer view
+        if n > (self._limit - self._position):
+            raise BufferUnderflowError()
+        view = Buffer.__new__(Buffer, 0, self) #skips __init__, which would clear the view
+        view._limit = self._position + n
+        self._position = self._position + n
+        return view
+
+    def read_view(self, int n = -1):
+        """Like :func:`read_bytes`, but instead of copying the bytes into a string it returns a :class:`Buffer` that
+        references the bytes in this buffer, with position and limit set around them. The view supports the buffer protocol,
+        e.g. it can be passed to memoryview() or socket.send. Its contents are only valid until this buffer is written
+        to or compacted. While the view exists this buffer is :attr:`shared`."""
+        if n == -1:
+            return self._read_view(self._limit - self._position)
+        else:
+            return self._read_view(n)
+
+    def __getbuffer__(self, Py_buffer *info, int flags):
+        #exposes the remaining bytes (position upto limit)
+        PyBuffer_FillInfo(info, self, self._buff + self._position, self._limit - self._position, 1, flags)
+
+    def __getreadbuffer__(self, Py_ssize_t i, void **p):
+        if i != 0:
+            raise SystemError("accessing non-existent buffer segment")
+        p[0] = self._buff + self._position
+        return self._limit - self._position
+
+    def __getsegcount__(self, Py_ssize_t *lenp):
+        if lenp != NULL:
+            lenp[0] = self._limit - self._position
+        return 1
+
     def read_bytes_until(self, int b):
         """Reads bytes until character b is found, or end of buffer is reached in which case it will raise a :exc:`BufferUnderflowError`."""
         cdef int n, maxlen
@@ -311,34 +368,34 @@ cdef class Buffer:
             self._position = self._position + n + 1
             return s
 
-    def read_line(self, int include_separator = 0):
-        """Reads a single line of bytes from the buffer where the end of the line is indicated by either 'LF' or 'CRLF'.
-        The line will be returned as a string not including the line-separator. Optionally *include_separator* can be specified
-        to make the method to also return the line-separator."""
+    cdef object _read_line(self, int include_separator):
+        #returns the next line or None if there is no complete line in the buffer
         cdef int n, maxlen
         cdef char *zpos, *start 
         maxlen = self._limit - self._position
         start = <char *>(self._buff + self._position)
-        zpos = <char *>(memchr(start, 10, maxlen))
         if maxlen == 0:
-            raise BufferUnderflowError()
+            return None
+        zpos = <char *>(memchr(start, 10, maxlen))
         if zpos == NULL:
-            raise BufferUnderflowError()
+            return None
         n = zpos - start
-        if self._buff[self._position + n - 1] == 13: #\r\n
-            if include_separator:
-                s = PyString_FromStringAndSize(start, n + 1)
-                self._position = self._position + n + 1
-            else:
-                s = PyString_FromStringAndSize(start, n - 1)
-                self._position = self._position + n + 1
+        if include_separator:
+            s = PyString_FromStringAndSize(start, n + 1)
+        elif n > 0 and start[n - 1] == 13: #\r\n
+            s = PyString_FromStringAndSize(start, n - 1)
         else: #\n
-            if include_separator:
-                s = PyString_FromStringAndSize(start, n + 1)
-                self._position = self._position + n + 1
-            else:
-                s = PyString_FromStringAndSize(start, n)
-                self._position = self._position + n + 1                                    
+            s = PyString_FromStringAndSize(start, n)
+        self._position = self._position + n + 1
+        return s
+
+    def read_line(self, int include_separator = 0):
+        """Reads a single line of bytes from the buffer where the end of the line is indicated by either 'LF' or 'CRLF'.
+        The line will be returned as a string not including the line-separator. Optionally *include_separator* can be specified
+        to make the method to also return the line-separator."""
+        s = self._read_line(include_separator)
+        if s is None:
+            raise BufferUnderflowError()
         return s
     
     def write_bytes(self, s):
@@ -356,7 +413,14 @@ cdef class Buffer:
 
     def write_buffer(self, Buffer other):
         """writes available bytes from other buffer to this buffer"""
-        self.write_bytes(other.read_bytes(-1)) #TODO use copy
+        cdef int n
+        n = other._limit - other._position
+        if n > (self._limit - self._position):
+            raise BufferOverflowError()
+        memcpy(self._buff + self._position, other._buff + other._position, n)
+        self._position = self._position + n
+        other._position = other._position + n
+        return n
                 
     cdef int _write_byte(self, unsigned int b) except -1:
         """writes a single byte to the buffer and updates position"""
@@ -437,11 +501,622 @@ cdef class Buffer:
     def __str__(self):
         return repr(self)
     
+#bytes per slab, a slab holds as many buffers of a size class as fit (at least 1)
+DEF SLAB_SIZE = 65536
+
+cdef class BufferPool
+
+cdef class _Slab(Buffer):
+    """a block of memory that is carved up in buffers of 1 size class"""
+    cdef BufferPool _pool
+    cdef int _carved #number of buffers carved from this slab
+    cdef int _released #number of those that are in the free list of the pool
+
+    def __dealloc__(self):
+        #called when the last buffer carved from this slab is gone
+        if self._pool is not None:
+            self._pool._bytes = self._pool._bytes - self.capacity
+
+cdef class BufferPool:
+    """A pool of reusable buffers. Buffers are handed out in fixed size classes and carved out of larger
+    slabs of memory. Buffers given back using :func:`release` are kept for reuse, until the memory held by the pool
+    would exceed *max_bytes*, in which case the least recently released slabs of which all buffers were released
+    are trimmed. When the pool is full
+    and nothing can be trimmed, or a buffer larger than the largest size class is requested, a normal unpooled buffer is returned.
+    """
+    cdef list _sizes #sorted size classes
+    cdef dict _free #size -> list of (release stamp, buffer), most recently released last
+    cdef dict _carve #size -> [slab, offset] of slab being carved, the pool keeps a reference to it
+    cdef readonly long max_bytes
+    cdef long _bytes #bytes held by slabs
+    cdef long _free_bytes #bytes held by released buffers
+    cdef long _stamp
+    cdef long _hits, _misses, _overflows, _trimmed
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024, sizes = (1024, 2048, 4096, 8192, 16384, 32768, 65536)):
+        self._sizes = sorted(sizes)
+        self._free = {}
+        self._carve = {}
+        for size in self._sizes:
+            self._free[size] = []
+            self._carve[size] = None
+        self.max_bytes = max_bytes
+
+    cdef int _size_class(self, int size):
+        cdef int c
+        for c in self._sizes:
+            if c >= size:
+                return c
+        return -1
+
+    cdef Buffer _new(self, int size):
+        #carves a new buffer of size class *size* from the current slab (creating a new one if needed)
+        cdef _Slab slab
+        cdef Buffer buffer
+        cdef int offset
+        carve = self._carve[size]
+        if carve is None:
+            slab = _Slab(max(1, SLAB_SIZE / size) * size)
+            slab._pool = self
+            self._bytes = self._bytes + slab.capacity
+            offset = 0
+        else:
+            slab, offset = carve
+        slab._carved = slab._carved + 1
+        buffer = Buffer(0, slab)
+        buffer._buff = slab._buff + offset
+        buffer.capacity = size
+        buffer.clear()
+        offset = offset + size
+        if offset + size <= slab.capacity:
+            self._carve[size] = [slab, offset]
+        else:
+            self._carve[size] = None
+        return buffer
+
+    def get(self, int size):
+        """Returns a cleared buffer with a capacity of at least *size* bytes"""
+        cdef int c
+        cdef Buffer buffer
+        cdef list free
+        c = self._size_class(size)
+        if c == -1:
+            self._overflows = self._overflows + 1
+            return Buffer(size)
+        free = self._free[c]
+        if free:
+            self._hits = self._hits + 1
+            buffer = free.pop()[1]
+            (<_Slab>buffer._parent)._released = (<_Slab>buffer._parent)._released - 1
+            self._free_bytes = self._free_bytes - c
+            buffer.clear()
+            return buffer
+        self._misses = self._misses + 1
+        if self._carve[c] is None and self._bytes + c > self.max_bytes:
+            #need a new slab, but the pool is full
+            self.trim(self._bytes + c - self.max_bytes)
+            if self._bytes + c > self.max_bytes:
+                self._overflows = self._overflows + 1
+                return Buffer(c)
+        return self._new(c)
+
+    def release(self, Buffer buffer):
+        """Gives *buffer* back to the pool. The caller must not use the buffer afterwards.
+        Buffers that were not handed out by this pool are ignored."""
+        cdef _Slab slab
+        if not isinstance(buffer._parent, _Slab):
+            return
+        slab = buffer._parent
+        if slab._pool is not self:
+            return
+        slab._released = slab._released + 1
+        self._stamp = self._stamp + 1
+        (<list>self._free[buffer.capacity]).append((self._stamp, buffer))
+        self._free_bytes = self._free_bytes + buffer.capacity
+
+    def trim(self, long n = -1):
+        """Frees slabs of which all buffers were released, least recently released first, until at least *n* bytes
+        were freed (all of them if *n* is -1). Released buffers of slabs that still have buffers in use are kept,
+        dropping them would not free any memory. Returns the number of bytes freed."""
+        cdef long trimmed, oldest_stamp
+        cdef int size, oldest_size
+        cdef _Slab slab, oldest
+        trimmed = 0
+        while n == -1 or trimmed < n:
+            #find the least recently released buffer whose slab is completely free
+            oldest = None
+            oldest_stamp = 0
+            oldest_size = 0
+            for size in self._sizes:
+                for stamp, buffer in self._free[size]:
+                    slab = <_Slab>(<Buffer>buffer)._parent
+                    if slab._released == slab._carved:
+                        if oldest is None or stamp < oldest_stamp:
+                            oldest = slab
+                            oldest_stamp = stamp
+                            oldest_size = size
+                        break #the rest of this list was released later
+            if oldest is None:
+                break
+            #drop all of its buffers, the slab is freed as soon as they are gone
+            self._free[oldest_size] = [entry for entry in self._free[oldest_size] if (<Buffer>entry[1])._parent is not oldest]
+            self._free_bytes = self._free_bytes - oldest._released * oldest_size
+            carve = self._carve[oldest_size]
+            if carve is not None and carve[0] is oldest:
+                self._carve[oldest_size] = None
+            trimmed = trimmed + oldest.capacity
+        self._trimmed = self._trimmed + trimmed
+        return trimmed
+
+    def statistics(self):
+        """Returns a dict with the pool counters: hits (buffers reused), misses (buffers created),
+        overflows (unpooled buffers returned), trimmed (bytes trimmed), bytes (memory held by slabs)
+        and free_bytes (memory held by released buffers)"""
+        return {'hits': self._hits, 'misses': self._misses, 'overflows': self._overflows, 'trimmed': self._trimmed,
+                'bytes': self._bytes, 'free_bytes': self._free_bytes}
+
+#max number of parts written by a single writev call
+DEF WRITEV_MAX = 1024
+
+def writev(int fd, object parts, int offset = 0):
+    """Writes the list of *parts* to the filedescriptor *fd* using a single writev(2) call, skipping the first
+    *offset* bytes. A part is either a string or a :class:`Buffer`, of a buffer the bytes between
+    its :attr:`position` and :attr:`limit` are written (the position of the buffer is not updated).
+    Returns a tuple (bytes_written, bytes_remaining). If *bytes_written* is negative, an IO Error was encountered.
+    """
+    cdef int b, remaining, err
+    b = _writev(fd, parts, offset, &remaining, &err)
+    return b, remaining
+
+cdef int _writev(int fd, object parts, int offset, int *remaining_out, int *err_out) except? -2:
+    #does the work for writev, *err_out* is set to errno right after the writev call
+    cdef iovec iov[WRITEV_MAX]
+    cdef int n_iov, remaining, b
+    cdef char *p
+    cdef Py_ssize_t n
+    cdef Buffer buffer
+    n_iov = 0
+    remaining = 0
+    for part in parts:
+        if isinstance(part, Buffer):
+            buffer = part
+            p = <char *>(buffer._buff + buffer._position)
+            n = buffer._limit - buffer._position
+        else:
+            PyString_AsStringAndSize(part, &p, &n)
+        if offset >= n:
+            offset = offset - n
+            continue
+        p = p + offset
+        n = n - offset
+        offset = 0
+        remaining = remaining + n
+        if n_iov < WRITEV_MAX:
+            iov[n_iov].iov_base = p
+            iov[n_iov].iov_len = n
+            n_iov = n_iov + 1
+    err_out[0] = 0
+    if n_iov == 0:
+        remaining_out[0] = 0
+        return 0
+    b = c_writev(fd, iov, n_iov)
+    if b < 0: err_out[0] = errno
+    if b > 0: remaining = remaining - b
+    remaining_out[0] = remaining
+    return b
+
+def sendfile(int out_fd, int in_fd, long long offset, int count):
+    """Sends at most *count* bytes, starting at *offset*, of the file *in_fd* to *out_fd* using sendfile(2)
+    (emulated with pread/write on platforms other than linux). Returns the number of bytes sent, 0 at end of file
+    or negative if an IO Error was encountered."""
+    return sendfile_fd(out_fd, in_fd, offset, count)
+
 def msgsendfd(dst_fd, fd):
+    """sends file descriptor *fd* over the UNIX socket *dst_fd*. returns -1 on error (check errno)"""
     return sendfd(dst_fd, fd)
 
 def msgrecvfd(src_fd):
+    """receives a file descriptor from the UNIX socket *src_fd*. returns the new fd, -1 on error (check errno)
+    or -2 when the other side closed the socket"""
     return recvfd(src_fd)
 
 
 
+
+cdef class BufferedReader:
+    """Reads from *stream* using *buffer*. The buffer is only refilled from the stream when the data that is asked for
+    is not in the buffer yet."""
+
+    cdef public object stream
+    cdef public Buffer buffer
+    cdef public int max_line_length #lines longer than the buffer are collected in segments, up to this length
+
+    def __init__(self, stream, Buffer buffer, int max_line_length = 1024 * 64):
+        self.stream = stream
+        self.buffer = buffer
+        self.max_line_length = max_line_length
+        #assume no reading from underlying stream was done, so make sure buffer reflects this:
+        self.buffer._position = 0
+        self.buffer._limit = 0
+
+    def file(self):
+        from concurrence.io.buffered import CompatibleFile
+        return CompatibleFile(self, None)
+
+    def clear(self):
+        self.buffer.clear()
+
+    cdef int _fill(self) except -1:
+        cdef Buffer buffer
+        buffer = self.buffer
+        #any partially read data will be put in front, otherwise normal clear:
+        buffer._compact()
+        if not self.stream.read(buffer, TIMEOUT_CURRENT):
+            raise EOFError("while reading")
+        #prepare to read from buffer
+        buffer._limit = buffer._position
+        buffer._position = 0
+        return 0
+
+    def _read_more(self):
+        self._fill()
+
+    cdef object _read_long_line(self, int include_separator):
+        #the line does not fit in the buffer, collect it in segments. only the newest segment
+        #needs to be searched for the separator, as the previous ones were full buffers without one
+        cdef Buffer buffer
+        cdef int n
+        buffer = self.buffer
+        segments = []
+        n = 0
+        while True:
+            segment = buffer._read_line(1)
+            if segment is not None:
+                n = n + len(segment)
+                segments.append(segment)
+                break
+            n = n + buffer._remaining()
+            segments.append(buffer._read_bytes(buffer._remaining()))
+            if n > self.max_line_length:
+                raise BufferOverflowError("line longer than max_line_length: %d" % self.max_line_length)
+            self._fill()
+        if n > self.max_line_length:
+            raise BufferOverflowError("line longer than max_line_length: %d" % self.max_line_length)
+        line = ''.join(segments)
+        if include_separator:
+            return line
+        elif line.endswith('\r\n'): #the \r may have been at the end of the previous segment
+            return line[:-2]
+        else:
+            return line[:-1]
+
+    def read_lines(self):
+        while True:
+            yield self.read_line()
+
+    def read_line(self, int include_separator = 0):
+        """Reads a line, not including the line separator unless *include_separator* is True. Lines that do not fit in
+        the buffer are read in segments, if a line is longer than :attr:`max_line_length` a :exc:`BufferOverflowError` is raised."""
+        cdef Buffer buffer
+        buffer = self.buffer
+        while True:
+            line = buffer._read_line(include_separator)
+            if line is not None:
+                return line
+            if buffer._position == 0 and buffer._limit == buffer.capacity:
+                return self._read_long_line(include_separator)
+            self._fill()
+
+    def read_bytes_available(self):
+        if self.buffer._remaining() == 0:
+            self._fill()
+        return self.buffer._read_bytes(self.buffer._remaining())
+
+    cdef Buffer _read_large(self, int n):
+        #does not fit in our buffer, read the rest directly from the stream into a buffer of the right size
+        cdef Buffer result
+        result = Buffer(n)
+        result.write_buffer(self.buffer)
+        while result._remaining():
+            if not self.stream.read(result, TIMEOUT_CURRENT):
+                raise EOFError("while reading")
+        result._limit = result._position
+        result._position = 0
+        return result
+
+    def read_bytes(self, int n):
+        """read exactly n bytes from stream"""
+        cdef Buffer buffer
+        buffer = self.buffer
+        if n <= buffer.capacity:
+            while buffer._remaining() < n:
+                self._fill()
+            return buffer._read_bytes(n)
+        else:
+            return self._read_large(n)._read_bytes(n)
+
+    def read_view(self, int n):
+        """Like :func:`read_bytes` but returns a :class:`Buffer` view on the bytes instead of a copy
+        (see :func:`Buffer.read_view`). The view is only valid until the next read from this reader."""
+        cdef Buffer buffer
+        buffer = self.buffer
+        if n <= buffer.capacity:
+            while buffer._remaining() < n:
+                self._fill()
+            return buffer._read_view(n)
+        else:
+            return self._read_large(n)
+
+    def read_int(self):
+        """reads a 32 bit little-endian integer"""
+        cdef Buffer buffer
+        cdef unsigned char *p
+        buffer = self.buffer
+        while buffer._remaining() < 4:
+            self._fill()
+        p = buffer._buff + buffer._position
+        buffer._position = buffer._position + 4
+        return (<unsigned int>p[0]) | (<unsigned int>p[1] << 8) | (<unsigned int>p[2] << 16) | (<unsigned int>p[3] << 24)
+
+    def read_short(self):
+        """reads a 16 bit little-endian integer"""
+        cdef Buffer buffer
+        cdef unsigned char *p
+        buffer = self.buffer
+        while buffer._remaining() < 2:
+            self._fill()
+        p = buffer._buff + buffer._position
+        buffer._position = buffer._position + 2
+        return p[0] | (p[1] << 8)
+
+cdef list _deferred_writers = [] #writers waiting for the dispatcher to flush them
+
+_log = logging.getLogger('BufferedWriter')
+
+def _flush_deferred():
+    global _deferred_writers
+    cdef BufferedWriter writer
+    writers = _deferred_writers
+    _deferred_writers = []
+    for writer in writers:
+        if writer._dirty: #not cancelled
+            writer._dirty = 0
+            try:
+                writer._flush_nowait()
+            except:
+                #the other writers must still be flushed, the data of this one is left for its next flush
+                _log.exception("in deferred flush")
+
+cdef class BufferedWriter:
+    """Writes to *stream* using *buffer*. The stream is only written to when the buffer is flushed, or when
+    the data does not fit in the buffer.
+    If :attr:`defer_flush` is set, :func:`flush` does not write to the stream itself, instead all writers that were flushed
+    are written out by the dispatcher once all tasks are blocked, using a single non-blocking writev call per writer.
+    This coalesces the flushes done by several tasks (or requests) within one loop iteration into one system call.
+    If the data can not be written at once, the rest is written when the stream becomes writable again.
+    Deferred flushing needs a stream with a *fd* (e.g. a :class:`Socket`), other streams are always flushed right away.
+    A :func:`flush` with *force* must be done before the stream is closed."""
+
+    cdef public object stream
+    cdef public Buffer buffer
+    cdef public int defer_flush
+    #if the stream supports writev, strings that do not fit in the buffer are queued by reference
+    #instead of being copied, they are sent together with the buffered data on the next flush
+    cdef list _queue
+    cdef int _mark #start of the part of buffer that is not yet queued (or already written by a deferred flush)
+    cdef int _dirty #in the list of writers to flush by the dispatcher
+    cdef object _wait_event #event waiting for the stream to become writable again after a partial deferred flush
+
+    def __init__(self, stream, Buffer buffer):
+        self.stream = stream
+        self.buffer = buffer
+        self._queue = []
+        self._mark = 0
+
+    def file(self):
+        from concurrence.io.buffered import CompatibleFile
+        return CompatibleFile(None, self)
+
+    def clear(self):
+        self.buffer.clear()
+        del self._queue[:]
+        self._mark = 0
+
+    property pending:
+        """True if there is data waiting to be flushed"""
+        def __get__(self):
+            return self.buffer._position > self._mark or len(self._queue) != 0
+
+    property deferred:
+        """True if a deferred flush is outstanding"""
+        def __get__(self):
+            return self._dirty or self._wait_event is not None
+    def _queue_bytes(self, s):
+        cdef Buffer buffer, segment
+        buffer = self.buffer
+        if buffer._position > self._mark:
+            #queue what was buffered so far as a view on the buffer, so that the order of the data is kept
+            segment = Buffer.__new__(Buffer, 0, buffer)
+            segment._position = self._mark
+            segment._limit = buffer._position
+            self._queue.append(segment)
+            self._mark = buffer._position
+        self._queue.append(s)
+
+    cdef int _reserve(self, int n) except -1:
+        #makes sure there is room for n bytes, flushing if needed
+        if self.buffer._position + n > self.buffer._limit:
+            self._flush()
+            if n > self.buffer._limit:
+                raise BufferOverflowError()
+        return 0
+
+    def write_bytes(self, s):
+        cdef char *b
+        cdef Py_ssize_t n
+        cdef Buffer buffer
+        assert type(s) == str, "arg must be a str, got: %s" % type(s)
+        buffer = self.buffer
+        PyString_AsStringAndSize(s, &b, &n)
+        if n <= buffer._limit - buffer._position:
+            memcpy(buffer._buff + buffer._position, b, n)
+            buffer._position = buffer._position + n
+        elif hasattr(self.stream, 'writev'):
+            self._queue_bytes(s)
+        else:
+            #we need to send it in parts, flushing as we go
+            while s:
+                r = buffer._remaining()
+                part, s = s[:r], s[r:]
+                buffer.write_bytes(part)
+                self._flush()
+
+    def write_buffer(self, Buffer buffer):
+        """writes the remaining bytes of *buffer* (e.g. a view obtained with :func:`BufferedReader.read_view`).
+        Like with :func:`write_bytes`, if it does not fit it is queued by reference, so it must not be changed before the next flush."""
+        if buffer._remaining() <= self.buffer._remaining():
+            self.buffer.write_buffer(buffer)
+        elif hasattr(self.stream, 'writev'):
+            self._queue_bytes(buffer)
+        else:
+            self.write_bytes(buffer._read_bytes(buffer._remaining()))
+
+    def write_byte(self, unsigned int ch):
+        cdef Buffer buffer
+        self._reserve(1)
+        buffer = self.buffer
+        buffer._buff[buffer._position] = ch
+        buffer._position = buffer._position + 1
+
+    def write_short(self, unsigned int i):
+        """writes a 16 bit little-endian integer"""
+        cdef Buffer buffer
+        self._reserve(2)
+        buffer = self.buffer
+        buffer._buff[buffer._position + 0] = (i >> 0) & 0xFF
+        buffer._buff[buffer._position + 1] = (i >> 8) & 0xFF
+        buffer._position = buffer._position + 2
+
+    def write_int(self, unsigned int i):
+        """writes a 32 bit little-endian integer"""
+        cdef Buffer buffer
+        self._reserve(4)
+        buffer = self.buffer
+        buffer._buff[buffer._position + 0] = (i >> 0) & 0xFF
+        buffer._buff[buffer._position + 1] = (i >> 8) & 0xFF
+        buffer._buff[buffer._position + 2] = (i >> 16) & 0xFF
+        buffer._buff[buffer._position + 3] = (i >> 24) & 0xFF
+        buffer._position = buffer._position + 4
+
+    cdef int _flush(self) except -1:
+        cdef Buffer buffer
+        buffer = self.buffer
+        #this flush writes all pending data, while it blocks the dispatcher must not write it again
+        self._undefer()
+        if self._queue:
+            buffer._limit = buffer._position
+            buffer._position = self._mark
+            self._queue.append(buffer)
+            try:
+                self.stream.writev(self._queue, TIMEOUT_CURRENT)
+            finally:
+                self.clear()
+            return 0
+        buffer._limit = buffer._position
+        buffer._position = self._mark
+        while buffer._remaining():
+            if not self.stream.write(buffer, TIMEOUT_CURRENT):
+                raise EOFError("while writing")
+        buffer._position = 0
+        buffer._limit = buffer.capacity
+        self._mark = 0
+        return 0
+
+    def flush(self, int force = 0):
+        """writes out any pending data. If :attr:`defer_flush` is set, this is left to the dispatcher unless *force* is True"""
+        if self.defer_flush and not force and hasattr(self.stream, 'fd'):
+            self._defer()
+        else:
+            self._flush()
+
+    cdef _defer(self):
+        if self._dirty or self._wait_event is not None:
+            return #already scheduled, or the writable event will schedule us
+        self._dirty = 1
+        if not _deferred_writers:
+            call_before_wait(_flush_deferred)
+        _deferred_writers.append(self)
+
+    cdef _consume(self, int n):
+        #drops the first n pending bytes, after they were written by a partial deferred flush
+        cdef Buffer part, segment
+        cdef int l
+        while self._queue and n > 0:
+            if isinstance(self._queue[0], Buffer):
+                part = self._queue[0]
+                l = part._remaining()
+                if n < l:
+                    segment = Buffer.__new__(Buffer, 0, part)
+                    segment._position = part._position + n
+                    segment._limit = part._limit
+                    self._queue[0] = segment
+            else:
+                l = len(self._queue[0])
+                if n < l:
+                    self._queue[0] = self._queue[0][n:]
+            if n < l:
+                return
+            n = n - l
+            del self._queue[0]
+        self._mark = self._mark + n
+
+    cdef _flush_nowait(self):
+        #called by the dispatcher, outside of any task, so it must not block
+        cdef Buffer buffer, segment
+        cdef int written, remaining, err
+        buffer = self.buffer
+        if not (buffer._position > self._mark or self._queue):
+            return
+        if self.stream.is_closed():
+            #the stream was closed without flushing, its fd might already be reused by another connection
+            self.cancel_deferred()
+            return
+        parts = list(self._queue)
+        if buffer._position > self._mark:
+            segment = Buffer.__new__(Buffer, 0, buffer)
+            segment._position = self._mark
+            segment._limit = buffer._position
+            parts.append(segment)
+        fd = self.stream.fd
+        written = _writev(fd, parts, 0, &remaining, &err)
+        if written < 0:
+            if err != EAGAIN:
+                #leave the data, the owner of the stream will find the same error on its next read or write
+                return
+        elif remaining == 0:
+            self.clear()
+            return
+        else:
+            self._consume(written)
+        #send buffer is full, continue when the stream becomes writable
+        self._wait_event = _event.event(fd, _event.EV_WRITE, self._on_writable)
+        self._wait_event.add()
+
+    def _on_writable(self, flags):
+        self._wait_event = None
+        self._defer()
+
+    cdef _undefer(self):
+        #takes this writer out of the list of writers to flush by the dispatcher
+        if self._wait_event is not None:
+            self._wait_event.delete()
+            self._wait_event = None
+        if self._dirty:
+            self._dirty = 0
+            if self in _deferred_writers:
+                _deferred_writers.remove(self)
+
+    def cancel_deferred(self):
+        """drops an outstanding deferred flush, the pending data is discarded. Called when the stream is closed"""
+        self._undefer()
+        self.clear()
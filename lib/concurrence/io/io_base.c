@@ -4,11 +4,16 @@
 #include <stdlib.h>
 #include <unistd.h>
 #include <string.h>
+#include <errno.h>
 
 #include <sys/types.h>
 #include <sys/socket.h>
 #include <sys/un.h>
 
+#ifdef __linux__
+#include <sys/sendfile.h>
+#endif
+
 int sendfd(int dst_fd, int fd)
 {
 	int file_descriptors[1] = { fd };
@@ -53,13 +58,36 @@ int recvfd(int src_fd)
 	  .msg_iovlen = 1,
 	};
 
-	//TODO check return val
-	recvmsg(src_fd, &message, 0);
+	int n = recvmsg(src_fd, &message, 0);
+	if(n < 0) {
+		return -1; //error, errno is set
+	}
+	if(n == 0) {
+		return -2; //eof
+	}
 
 	struct cmsghdr *cmessage = CMSG_FIRSTHDR(&message);
+	if(cmessage == NULL || cmessage->cmsg_type != SCM_RIGHTS) {
+		errno = EBADMSG;
+		return -1; //message without file descriptor
+	}
 	memcpy(file_descriptors, CMSG_DATA(cmessage), sizeof file_descriptors);
 
 	return file_descriptors[0];
 }
 
-
+int sendfile_fd(int out_fd, int in_fd, long long offset, int count)
+{
+#ifdef __linux__
+	off_t off = offset;
+	return sendfile(out_fd, in_fd, &off, count);
+#else
+	//emulate using pread/write
+	char buffer[16384];
+	int n = pread(in_fd, buffer, count < sizeof buffer ? count : sizeof buffer, offset);
+	if(n <= 0) {
+		return n;
+	}
+	return write(out_fd, buffer, n);
+#endif
+}
@@ -1,2 +1,3 @@
 extern int sendfd(int dst_fd, int fd);
 extern int recvfd(int src_fd);
+extern int sendfile_fd(int out_fd, int in_fd, long long offset, int count);
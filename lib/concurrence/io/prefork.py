@@ -0,0 +1,180 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+"""
+Pre-forking process supervisor. Binds a listening socket once and forks a number of worker
+processes that each run their own concurrence dispatch loop, accepting connections from the shared socket.
+
+Example::
+
+    def main(socket):
+        server = WSGIServer(application)
+        return server.serve(socket)
+
+    Prefork(('0.0.0.0', 8080), main, workers = 4).run()
+
+The supervisor (parent) process does not run a dispatch loop itself. It restarts workers that die unexpectedly,
+does a graceful reload on SIGHUP (starts a fresh set of workers, then lets the old ones finish their
+current connections) and a graceful stop on SIGTERM or SIGINT.
+
+With a single shared listening socket all workers are woken up for every incoming connection and all but one
+of them find nothing to accept. With *reuse_port* each worker instead binds its own listening socket using
+SO_REUSEPORT and the kernel distributes the incoming connections between them. Note that connections still
+waiting in the backlog of a worker that stops are reset by the kernel.
+"""
+
+import os
+import time
+import signal
+import errno
+import logging
+
+from concurrence import _event, dispatch, quit, Tasklet, SignalEvent
+from concurrence.io.socket import Socket, DEFAULT_BACKLOG
+
+class Prefork(object):
+    log = logging.getLogger('Prefork')
+
+    RESPAWN_DELAY = 1.0 #delay before respawning a worker that died right after it was started
+
+    def __init__(self, endpoint, main, workers = None, backlog = DEFAULT_BACKLOG, graceful_timeout = 10.0, reuse_port = False):
+        """Creates a prefork supervisor for the given *endpoint* (a (host, port) tuple or a path for a UNIX socket).
+        Each worker process calls *main* with the shared listening :class:`Socket` inside its dispatch loop.
+        *main* should start serving on it and return the server (e.g. the :class:`SocketServer` returned
+        by WSGIServer.serve), so that the worker can stop accepting and wait for its connections to finish on shutdown.
+        The number of *workers* defaults to the number of online cpu's. Stopping workers that still have
+        open connections after *graceful_timeout* seconds are terminated. If *reuse_port* is True
+        every worker binds its own SO_REUSEPORT listening socket instead of sharing the one of the parent."""
+        if workers is None:
+            workers = os.sysconf('SC_NPROCESSORS_ONLN')
+        assert workers > 0, "need at least 1 worker"
+        assert not reuse_port or isinstance(endpoint, tuple), "reuse_port needs a tcp endpoint"
+        self._endpoint = endpoint
+        self._main = main
+        self._workers_count = workers
+        self._backlog = backlog
+        self._graceful_timeout = graceful_timeout
+        self._reuse_port = reuse_port
+        self._socket = None
+        self._workers = {} #pid -> start time
+        self._retired = set() #pids of workers that were asked to stop
+        self._reload = False
+        self._stop = False
+
+    @property
+    def socket(self):
+        """the shared listening socket, or in a worker using *reuse_port* the worker's own socket"""
+        return self._socket
+
+    @property
+    def workers(self):
+        """the pids of the current worker processes"""
+        return self._workers.keys()
+
+    def _stop_worker(self, server):
+        #stop accepting, wait for current connections to finish, then end the dispatch loop
+        deadline = time.time() + self._graceful_timeout
+        if server is not None:
+            server.close()
+            while server.connection_count > 0 and time.time() < deadline:
+                Tasklet.sleep(0.1)
+        quit()
+
+    def _worker(self):
+        if self._reuse_port:
+            self._socket = Socket.server(self._endpoint, self._backlog, reuse_port = True)
+        server = self._main(self._socket)
+        def stop():
+            Tasklet.new(self._stop_worker)(server)
+        #keep a reference to the signal event for the lifetime of the worker
+        self._stop_event = SignalEvent(signal.SIGTERM, stop, persist = False)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid != 0:
+            self._workers[pid] = time.time()
+            return pid
+        #child
+        code = 0
+        try:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_DFL)
+                _event.reinit()
+                dispatch(self._worker)
+            except SystemExit, e:
+                code = e.code or 0
+            except:
+                self.log.exception("unhandled exception in worker")
+                code = 1
+        finally:
+            os._exit(code)
+
+    def _kill(self, pid, signo = signal.SIGTERM):
+        try:
+            os.kill(pid, signo)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self._retired:
+                self._retired.remove(pid)
+            elif pid in self._workers:
+                started = self._workers.pop(pid)
+                if not self._stop:
+                    self.log.warn("worker %d died unexpectedly (status %d), respawning", pid, status)
+                    if time.time() - started < 1.0:
+                        time.sleep(self.RESPAWN_DELAY)
+                    self._spawn()
+
+    def _on_reload(self, signo, frame):
+        self._reload = True
+
+    def _on_stop(self, signo, frame):
+        self._stop = True
+
+    def run(self):
+        """binds the listening socket, starts the workers and supervises them until stopped"""
+        if self._reuse_port:
+            #check that the address can be bound before starting any workers
+            Socket.server(self._endpoint, self._backlog, reuse_port = True).close()
+        else:
+            self._socket = Socket.server(self._endpoint, self._backlog)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for i in range(self._workers_count):
+            self._spawn()
+        stopping = False
+        while self._workers or self._retired:
+            if self._stop and not stopping:
+                stopping = True
+                for pid in self._workers.keys():
+                    self._kill(pid)
+            elif self._reload and not stopping:
+                self._reload = False
+                old = self._workers.keys()
+                for i in range(self._workers_count):
+                    self._spawn()
+                for pid in old:
+                    del self._workers[pid]
+                    self._retired.add(pid)
+                    self._kill(pid)
+            self._reap()
+            time.sleep(0.2)
+        if self._socket is not None:
+            self._socket.close()
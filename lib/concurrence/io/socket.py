@@ -7,6 +7,7 @@ import logging
 import _socket
 import types
 import os
+import sys
 
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, ENOTCONN, ESHUTDOWN, EINTR, EISCONN, ENOENT, EAGAIN
 
@@ -14,16 +15,22 @@ import _io
 
 from concurrence import Tasklet, FileDescriptorEvent, TIMEOUT_CURRENT
 from concurrence.io import IOStream
+from concurrence.statistic import Statistic
 
 DEFAULT_BACKLOG = 512
-XMOD = 8
+
+#linux sends at most this many bytes per sendfile(2) call, larger counts are sent in several calls
+MAX_SENDFILE_COUNT = 0x7ffff000
+
+#older pythons do not define SO_REUSEPORT, but linux >= 3.9 supports it
+SO_REUSEPORT = getattr(_socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
 
 _interceptor = None
 
 class Socket(IOStream):
     log = logging.getLogger('Socket')
 
-    __slots__ = ['socket', 'fd', '_readable', '_writable', 'state']
+    __slots__ = ['socket', 'fd', '_readable', '_writable', '_persistent_events', '_likely_readable', '_likely_writable', 'state']
 
     STATE_INIT = 0
     STATE_LISTENING = 1
@@ -32,10 +39,18 @@ class Socket(IOStream):
     STATE_CLOSING = 4
     STATE_CLOSED = 5
 
-    _x = 0
-
-    def __init__(self, socket, state = STATE_INIT):
-        """don't call directly pls use one of the provided classmethod to create a socket"""
+    #readiness statistics over all sockets, see :func:`statistics`
+    _read_eagain = Statistic(0) #optimistic reads that returned EAGAIN (wasted syscall)
+    _read_wait_avoided = Statistic(0) #optimistic reads that did not need to wait
+    _read_wait = Statistic(0) #reads that waited for readability
+    _write_eagain = Statistic(0)
+    _write_wait_avoided = Statistic(0)
+    _write_wait = Statistic(0)
+
+    def __init__(self, socket, state = STATE_INIT, persistent_events = False):
+        """don't call directly pls use one of the provided classmethod to create a socket.
+        If *persistent_events* is True, the socket's fd stays registered with libevent for the lifetime
+        of the socket instead of being re-registered every time a read or write needs to wait."""
         self.socket = socket
 
         if _socket.AF_INET == socket.family:
@@ -53,41 +68,58 @@ class Socket(IOStream):
         self.fd = self.socket.fileno()
         self._readable = None #will be created lazily
         self._writable = None #will be created lazily
+        self._persistent_events = persistent_events
+        #per socket readiness hints, updated after every read/write. we only try a read or write without waiting
+        #for the fd first when it is likely to succeed
+        self._likely_readable = True
+        self._likely_writable = True
         self.state = state
 
+    @classmethod
+    def statistics(cls):
+        """Returns the readiness statistics over all sockets. Use :func:`Statistic.updateall` on the result
+        to get the rates per second."""
+        return {'read': {'eagain': cls._read_eagain, 'wait_avoided': cls._read_wait_avoided, 'wait': cls._read_wait},
+                'write': {'eagain': cls._write_eagain, 'wait_avoided': cls._write_wait_avoided, 'wait': cls._write_wait}}
+
     @classmethod
     def set_interceptor(cls, interceptor):
         global _interceptor
         _interceptor = interceptor
 
     @classmethod
-    def from_address(cls, addr):
+    def from_address(cls, addr, persistent_events = False):
         """Creates a new socket from the given address. If the addr is a tuple (host, port)
         a normal tcp socket is assumed. if addr is a string, a UNIX Domain socket is assumed"""
         if _interceptor is not None:
             return _interceptor(addr)
         elif type(addr) == types.StringType:
-            return cls(_socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM))
+            return cls(_socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM), persistent_events = persistent_events)
         else:
-            return cls(_socket.socket(_socket.AF_INET, _socket.SOCK_STREAM))
+            return cls(_socket.socket(_socket.AF_INET, _socket.SOCK_STREAM), persistent_events = persistent_events)
 
     @classmethod
     def new(cls):
         return cls(_socket.socket(_socket.AF_INET, _socket.SOCK_STREAM))
 
     @classmethod
-    def server(cls, addr, backlog = DEFAULT_BACKLOG, reuse_address = True):
-        s = cls.from_address(addr)
+    def server(cls, addr, backlog = DEFAULT_BACKLOG, reuse_address = True, persistent_events = False, reuse_port = False):
+        """creates a new listening socket. sockets accepted from it will use the same *persistent_events* setting.
+        If *reuse_port* is True, the SO_REUSEPORT option is set so that multiple processes can each bind their own
+        listening socket to the same address, and the kernel will distribute incoming connections between them."""
+        s = cls.from_address(addr, persistent_events)
         s.set_reuse_address(reuse_address)
+        if reuse_port:
+            s.set_reuse_port(reuse_port)
         s.bind(addr)
         s.listen(backlog)
         return s
 
     @classmethod
-    def connect(cls, addr, timeout = TIMEOUT_CURRENT):
+    def connect(cls, addr, timeout = TIMEOUT_CURRENT, persistent_events = False):
         """creates a new socket and connects it to the given address.
         returns the connected socket"""
-        socket = cls.from_address(addr)
+        socket = cls.from_address(addr, persistent_events)
         socket._connect(addr, timeout)
         return socket
 
@@ -97,7 +129,7 @@ class Socket(IOStream):
 
     def _get_readable(self):
         if self._readable is None:
-            self._readable = FileDescriptorEvent(self.fd, 'r')
+            self._readable = FileDescriptorEvent(self.fd, 'r', self._persistent_events)
         return self._readable
 
     def _set_readable(self, readable):
@@ -107,7 +139,7 @@ class Socket(IOStream):
 
     def _get_writable(self):
         if self._writable is None:
-            self._writable = FileDescriptorEvent(self.fd, 'w')
+            self._writable = FileDescriptorEvent(self.fd, 'w', self._persistent_events)
         return self._writable
 
     def _set_writable(self, writable):
@@ -121,6 +153,11 @@ class Socket(IOStream):
     def set_reuse_address(self, reuse_address):
         self.socket.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, int(reuse_address))
 
+    def set_reuse_port(self, reuse_port):
+        if SO_REUSEPORT is None:
+            raise NotImplementedError("SO_REUSEPORT is not supported on this platform")
+        self.socket.setsockopt(_socket.SOL_SOCKET, SO_REUSEPORT, int(reuse_port))
+
     def set_send_buffer_size(self, n):
         self.socket.setsockopt(_socket.SOL_SOCKET, _socket.SO_SNDBUF, n)
 
@@ -138,10 +175,14 @@ class Socket(IOStream):
         """waits on a listening socket, returns a new socket_class instance
         for the incoming connection"""
         assert self.state == self.STATE_LISTENING, "make sure socket is listening before calling accept"
+        #a persistent (edge triggered) event reports pending connections only once, so in that case we
+        #only wait after accept found the backlog drained
+        wait = not self._persistent_events
         while True:
             #we need a loop because sometimes we become readable and still not a valid
             #connection was accepted, in which case we return here and wait some more.
-            self.readable.wait()
+            if wait:
+                self.readable.wait()
             try:
                 s, _ = self.socket.accept()
             except _socket.error, (errno, _):
@@ -149,11 +190,40 @@ class Socket(IOStream):
                     #this can happen when more than one process received readability on the same socket (forked/cloned/dupped)
                     #in that case 1 process will do the accept, the others receive this error, and should continue waiting for
                     #readability
+                    self.readable.clear()
+                    wait = True
                     continue
                 else:
                     raise
 
-            return self.__class__(s, self.STATE_CONNECTED)
+            return self.__class__(s, self.STATE_CONNECTED, self._persistent_events)
+
+    def accept_many(self, max_count = 64):
+        """waits on a listening socket, then accepts up to *max_count* pending connections without waiting again
+        (until the backlog is drained). Returns a list of new socket_class instances for the accepted connections"""
+        assert self.state == self.STATE_LISTENING, "make sure socket is listening before calling accept"
+        accepted = []
+        wait = not self._persistent_events #see accept
+        while True:
+            if wait:
+                self.readable.wait()
+            while len(accepted) < max_count:
+                try:
+                    s, _ = self.socket.accept()
+                except _socket.error, (errno, _):
+                    if errno in [EAGAIN, EWOULDBLOCK]:
+                        #backlog drained (or another process got the connection first)
+                        self.readable.clear()
+                        wait = True
+                        break
+                    elif accepted:
+                        #return what we have, the error will show up again on the next call
+                        break
+                    else:
+                        raise
+                accepted.append(self.__class__(s, self.STATE_CONNECTED, self._persistent_events))
+            if accepted:
+                return accepted
 
     def accept_iter(self):
         while True:
@@ -193,22 +263,31 @@ class Socket(IOStream):
         This method returns the total number of bytes written. This method could possible write 0 bytes"""
         assert self.state == self.STATE_CONNECTED, "socket must be connected in order to write to it"
 
-        Socket._x += 1
-        if Socket._x % XMOD == 0:
-            assume_writable = False
-
-        #by default assume that we can write to the socket without blocking
-        if assume_writable:
-            bytes_written, _ = buffer.send(self.fd) #write to fd from buffer
+        #assume that we can write to the socket without blocking, unless the last write to this
+        #socket found the socket send buffer to be full
+        if assume_writable and self._likely_writable:
+            bytes_written, remaining = buffer.send(self.fd) #write to fd from buffer
             if bytes_written < 0 and _io.get_errno() == EAGAIN:
                 #nope, need to wait before sending our data
+                Socket._write_eagain += 1
                 assume_writable = False
+                self.writable.clear()
+            else:
+                Socket._write_wait_avoided += 1
             #else if error != EAGAIN, assume_writable will stay True, and we fall trough and raise error below
+        else:
+            assume_writable = False
 
         #if we cannot assume write-ability we will wait until data can be written again
-        if not assume_writable:
+        while not assume_writable:
+            Socket._write_wait += 1
             self.writable.wait(timeout = timeout)
-            bytes_written, _ = buffer.send(self.fd) #write to fd from buffer
+            bytes_written, remaining = buffer.send(self.fd) #write to fd from buffer
+            #a persistent event might have reported stale write-ability, in that case wait again
+            assume_writable = not (bytes_written < 0 and _io.get_errno() == EAGAIN)
+
+        #if we could not write everything, the send buffer is full and the next write will probably need to wait
+        self._likely_writable = bytes_written >= 0 and remaining == 0
 
         #print 'bw', bytes_written, buffer.capacity
         #
@@ -217,28 +296,100 @@ class Socket(IOStream):
         else:
             return bytes_written
 
+    def writev(self, parts, timeout = TIMEOUT_CURRENT):
+        """Writes all given *parts* (strings or :class:`Buffer` objects) to this socket, using as few writev(2) system calls
+        as possible, e.g. without copying the parts into a single buffer first. Of buffers the bytes between their position and
+        limit are written, their position is not updated. Returns the total number of bytes written."""
+        assert self.state == self.STATE_CONNECTED, "socket must be connected in order to write to it"
+
+        offset = 0
+        if self._likely_writable:
+            bytes_written, remaining = _io.writev(self.fd, parts, offset)
+            if bytes_written < 0 and _io.get_errno() == EAGAIN:
+                Socket._write_eagain += 1
+                self.writable.clear()
+            elif bytes_written < 0:
+                raise _io.error_from_errno(IOError)
+            else:
+                Socket._write_wait_avoided += 1
+                offset += bytes_written
+                if remaining == 0:
+                    return offset
+
+        #send buffer is full, write the rest as soon as we become writable again
+        while True:
+            Socket._write_wait += 1
+            self.writable.wait(timeout = timeout)
+            bytes_written, remaining = _io.writev(self.fd, parts, offset)
+            if bytes_written < 0 and _io.get_errno() == EAGAIN:
+                continue #stale write-ability, wait again
+            elif bytes_written < 0:
+                raise _io.error_from_errno(IOError)
+            offset += bytes_written
+            if remaining == 0:
+                self._likely_writable = True
+                return offset
+
+    def sendfile(self, fd, offset, count, timeout = TIMEOUT_CURRENT):
+        """Sends *count* bytes starting at *offset* of the file with filedescriptor *fd* to this socket
+        using sendfile(2), e.g. without copying the file contents trough user space.
+        Returns the total number of bytes sent, which is less than *count* only if the end of the file was reached."""
+        assert self.state == self.STATE_CONNECTED, "socket must be connected in order to write to it"
+
+        sent = 0
+        assume_writable = self._likely_writable
+        while sent < count:
+            if not assume_writable:
+                Socket._write_wait += 1
+                self.writable.wait(timeout = timeout)
+            bytes_sent = _io.sendfile(self.fd, fd, offset + sent, min(count - sent, MAX_SENDFILE_COUNT))
+            if bytes_sent < 0 and _io.get_errno() == EAGAIN:
+                Socket._write_eagain += 1
+                assume_writable = False
+                self.writable.clear()
+            elif bytes_sent < 0:
+                raise _io.error_from_errno(IOError)
+            elif bytes_sent == 0:
+                break #end of file
+            else:
+                sent += bytes_sent
+                #partial send, the socket send buffer is probably full
+                assume_writable = sent == count
+
+        self._likely_writable = assume_writable
+        return sent
+
     def read(self, buffer, timeout = TIMEOUT_CURRENT, assume_readable = True):
         """Reads as many bytes as possible the socket into the given buffer.
         The buffer position is updated according to the number of bytes read from the socket.
         This method could possible read 0 bytes. The method returns the total number of bytes read"""
         assert self.state == self.STATE_CONNECTED, "socket must be connected in order to read from it"
 
-        Socket._x += 1
-        if Socket._x % XMOD == 0:
-            assume_readable = False
-
-        #by default assume that we can read from the socket without blocking
-        if assume_readable:
-            bytes_read, _ = buffer.recv(self.fd) #read from fd to
+        #assume that we can read from the socket without blocking, unless the last read from this
+        #socket drained it (e.g. it did not fill the buffer) or returned EAGAIN
+        if assume_readable and self._likely_readable:
+            bytes_read, remaining = buffer.recv(self.fd) #read from fd to
             if bytes_read < 0 and _io.get_errno() == EAGAIN:
                 #nope, need to wait before reading our data
+                Socket._read_eagain += 1
                 assume_readable = False
+                self.readable.clear()
+            else:
+                Socket._read_wait_avoided += 1
             #else if error != EAGAIN, assume_readable will stay True, and we fall trough and raise error below
+        else:
+            assume_readable = False
 
         #if we cannot assume readability we will wait until data can be read again
-        if not assume_readable:
+        while not assume_readable:
+            Socket._read_wait += 1
             self.readable.wait(timeout = timeout)
-            bytes_read, _ = buffer.recv(self.fd) #read from fd to
+            bytes_read, remaining = buffer.recv(self.fd) #read from fd to
+            #a persistent event might have reported stale readability, in that case wait again
+            assume_readable = not (bytes_read < 0 and _io.get_errno() == EAGAIN)
+
+        #if the read filled up the buffer there is probably more data pending
+        self._likely_readable = bytes_read > 0 and remaining == 0
 
         #print 'br', bytes_read, buffer.capacity
         #
@@ -247,16 +398,36 @@ class Socket(IOStream):
         else:
             return bytes_read
 
+    def wait_readable(self, timeout = TIMEOUT_CURRENT):
+        """waits until data can be read from this socket"""
+        self.readable.wait(timeout = timeout)
+        self._likely_readable = True
+
     def write_socket(self, socket, timeout = TIMEOUT_CURRENT):
         """writes a socket trough this socket"""
-        self.writable.wait(timeout = timeout)
-        _io.msgsendfd(self.fd, socket.fd)
+        while True:
+            if _io.msgsendfd(self.fd, socket.fd) >= 0:
+                return
+            if _io.get_errno() != EAGAIN:
+                raise _io.error_from_errno(IOError)
+            self.writable.wait(timeout = timeout)
 
     def read_socket(self, socket_class = None, socket_family =  _socket.AF_INET, socket_type = _socket.SOCK_STREAM, socket_state = STATE_INIT, timeout = TIMEOUT_CURRENT):
         """reads a socket from this socket"""
-        self.readable.wait(timeout = timeout)
-        fd = _io.msgrecvfd(self.fd)
-        return (socket_class or self.__class__).from_file_descriptor(fd, socket_family, socket_type, socket_state)
+        while True:
+            self.readable.wait(timeout = timeout)
+            fd = _io.msgrecvfd(self.fd)
+            if fd >= 0:
+                break
+            elif fd == -2:
+                raise EOFError("while reading socket")
+            elif _io.get_errno() != EAGAIN:
+                raise _io.error_from_errno(IOError)
+        try:
+            return (socket_class or self.__class__).from_file_descriptor(fd, socket_family, socket_type, socket_state)
+        finally:
+            #from_file_descriptor dupped the fd
+            os.close(fd)
 
     def is_closed(self):
         return self.state == self.STATE_CLOSED
@@ -277,7 +448,15 @@ class Socket(IOStream):
 class SocketServer(object):
     log = logging.getLogger('SocketServer')
 
-    def __init__(self, endpoint, handler = None):
+    ACCEPT_BATCH = 64
+
+    def __init__(self, endpoint, handler = None, reuse_port = False, accept_batch = ACCEPT_BATCH, handler_pool = None):
+        """Creates a server for *endpoint* (an address or a listening :class:`Socket`) calling *handler* for each
+        accepted connection. If *reuse_port* is True the listening socket is created with SO_REUSEPORT, so that
+        every worker process can bind its own socket to the same address (see :mod:`concurrence.io.prefork`).
+        Every time the listening socket becomes readable up to *accept_batch* pending connections are accepted.
+        By default each connection is handled in a new task, if a *handler_pool* (e.g. a :class:`TaskletPool`) is given
+        the connections are handed to it using its defer method instead."""
         self._addr = None
         self._socket = None
         if isinstance(endpoint, Socket):
@@ -286,16 +465,26 @@ class SocketServer(object):
             self._addr = endpoint
         self._handler = handler
         self._reuseaddress = True
+        self._reuseport = reuse_port
+        self._accept_batch = accept_batch
+        self._handler_pool = handler_pool
         self._handler_task_name = 'socket_handler'
         self._accept_task = None
         self._accept_task_name = 'socket_acceptor'
+        self._connection_count = 0
 
     @property
     def socket(self):
         return self._socket
 
+    @property
+    def connection_count(self):
+        """the number of accepted connections currently being handled"""
+        return self._connection_count
+
     def _handle_accept(self, accepted_socket):
         result = None
+        self._connection_count += 1
         try:
             result = self._handler(accepted_socket)
         except TaskletExit:
@@ -303,6 +492,7 @@ class SocketServer(object):
         except:
             self.log.exception("unhandled exception in socket handler")
         finally:
+            self._connection_count -= 1
             if result is None and not accepted_socket.is_closed():
                 try:
                     accepted_socket.close()
@@ -317,11 +507,16 @@ class SocketServer(object):
                 assert False, "address must be set or accepting socket must be explicitly set"
             self._socket = Socket.from_address(self._addr)
             self._socket.set_reuse_address(self._reuseaddress)
+            if self._reuseport:
+                self._socket.set_reuse_port(self._reuseport)
         return self._socket
 
     def _accept_task_loop(self):
-        accepted_socket = self._socket.accept()
-        Tasklet.new(self._handle_accept, self._handler_task_name)(accepted_socket)
+        for accepted_socket in self._socket.accept_many(self._accept_batch):
+            if self._handler_pool is None:
+                Tasklet.new(self._handle_accept, self._handler_task_name)(accepted_socket)
+            else:
+                self._handler_pool.defer(self._handle_accept, accepted_socket)
 
     def bind(self):
         """creates socket if needed, and binds it"""
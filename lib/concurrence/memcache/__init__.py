@@ -53,7 +53,8 @@ MemcacheResult.DELETED = MemcacheResult._intern("DELETED")
 MemcacheResult.ERROR = MemcacheResult._intern("ERROR")
 MemcacheResult.TIMEOUT = MemcacheResult._intern("TIMEOUT")
 
-from concurrence.memcache.client import Memcache, MemcacheConnection, MemcacheConnectionManager
+from concurrence.memcache.client import Memcache, MemcacheConnection, MemcacheConnectionManager, MemcacheServer
 from concurrence.memcache.behaviour import MemcacheBehaviour
 from concurrence.memcache.protocol import MemcacheProtocol
 from concurrence.memcache.codec import MemcacheCodec
+from concurrence.memcache.localcache import MemcacheLocalCache
@@ -1,6 +1,14 @@
-from concurrence.memcache import MemcacheError, ketama
+from concurrence.memcache import MemcacheError
+from concurrence.memcache._ketama import Continuum
 
 class MemcacheBehaviour(object):
+    def key_to_addr_many(self, keys):
+        """maps all *keys* to their server, returns a dict address -> [keys]"""
+        grouped_addrs = {}
+        for key in keys:
+            grouped_addrs.setdefault(self.key_to_addr(key), []).append(key)
+        return grouped_addrs
+
     @classmethod
     def create(cls, type_):
         if isinstance(type_, MemcacheBehaviour):
@@ -27,9 +35,12 @@ class MemcacheKetamaBehaviour(MemcacheBehaviour):
         self._continuum = None
 
     def set_servers(self, servers):
-        self._continuum = ketama.build_continuum(servers)
+        self._continuum = Continuum(servers)
 
     def key_to_addr(self, key):
-        return ketama.get_server(key, self._continuum)
+        return self._continuum.key_to_addr(key)
+
+    def key_to_addr_many(self, keys):
+        return self._continuum.key_to_addr_many(keys)
 
 
@@ -4,14 +4,17 @@
 # the New BSD License: http://www.opensource.org/licenses/bsd-license.php
 from __future__ import with_statement
 
+import sys
 import logging
+import weakref
 
 from concurrence import Tasklet, TaskletPool, Channel, DeferredQueue, QueueChannel, TIMEOUT_CURRENT, TimeoutError
 from concurrence.io import Socket, BufferedStream
+from concurrence.statistic import Statistic, StatisticMinMax
 
 from concurrence.memcache import MemcacheError, MemcacheResult
 from concurrence.memcache.codec import MemcacheCodec
-from concurrence.memcache.behaviour import MemcacheBehaviour
+from concurrence.memcache.behaviour import MemcacheBehaviour, MemcacheKetamaBehaviour
 from concurrence.memcache.protocol import MemcacheProtocol
 
 #TODO:
@@ -23,17 +26,13 @@ from concurrence.memcache.protocol import MemcacheProtocol
 #gzip support
 #close unused connections
 #proper buffer sizes
-#norepy e.g. no server response to set commands, what is the fastest fill rate agains a single memcached server?
 #stats cmd (+item + item size stats
 
 #what to do with partial multi get failure accross multiple servers?, e.g. return partial keys?
 
 #bundling of multiple requests in 1 flush (autoflush on/off)
-#todo detect timeouts on write/read, and mark host as dead
-#keep some time before retrying host
 #close down node no recv ERROR?
 #UPD support
-#binary support
 #how to handle timouts in the pipelined case?
 #TODO validate keys!, they are 'txt' not random bins!, e.g. some chars not allowed, which ones?
 #CLAMP timestamps at 2**31-1
@@ -43,6 +42,18 @@ class ResultChannel(QueueChannel):
     def __init__(self):
         super(ResultChannel, self).__init__(preference = 1)
 
+_MISSING = object() #marks a key that is not in the local cache
+
+class _GetFanOut(object):
+    #passes the result of a coalesced get to all tasks that asked for one of its keys
+    def __init__(self, pending):
+        self._pending = pending #key -> [result channels]
+
+    def send(self, result):
+        for result_channels in self._pending.itervalues():
+            for result_channel in result_channels:
+                result_channel.send(result)
+
 class CommandBatch(object):
     def __init__(self, target):
         self._cmds = []
@@ -124,11 +135,13 @@ class MemcacheConnection(object):
 
     _tasklet_pool = MemcacheTaskletPool()
 
-    def __init__(self, address, protocol = "text", codec = "default"):
+    def __init__(self, address, protocol = "text", codec = "default", server = None):
 
         self._address = address
+        self._server = server or MemcacheServer(address)
 
         self._stream = None
+        self._outstanding = StatisticMinMax() #commands whose results are not read yet
         self._read_queue = DeferredQueue(self._tasklet_pool.defer)
         self._write_queue = DeferredQueue(self._tasklet_pool.defer)
 
@@ -136,38 +149,65 @@ class MemcacheConnection(object):
         self._protocol.set_codec(MemcacheCodec.create(codec))
 
     def connect(self):
-        self._stream = BufferedStream(Socket.connect(self._address))
+        #commands flushed by several tasks in the same loop iteration are sent together
+        self._stream = BufferedStream(Socket.connect(self._address), defer_flush = True)
 
     def is_connected(self):
         return self._stream is not None
 
+    @property
+    def outstanding(self):
+        """the number of commands written or waiting to be written of which the results are not read yet"""
+        return self._outstanding.count
+
     def _defer_commands(self, cmds, result_channel):
-        def _read_results():
+        """writes *cmds* and sends their results to *result_channel*. If *result_channel* is None the
+        commands must have been written with noreply, they are only written and no results are read"""
+        def _read_results(stream):
             protocol = self._protocol
-            with self._stream.get_reader() as reader:
-                for cmd, args, error_value in cmds:
-                    try:
+            n = 0 #number of results read
+            try:
+                with stream.get_reader() as reader:
+                    for cmd, args, error_value in cmds:
                         result = protocol.read(cmd, reader)
+                        n += 1
                         result_channel.send(result)
-                    except TaskletExit:
-                        raise
-                    except:
-                        self.log.exception("read error in defer_commands")
-                        result_channel.send((MemcacheResult.ERROR, error_value))
+                if self._server.failures:
+                    self._server.succeeded()
+            except TaskletExit:
+                raise
+            except:
+                #we don't know where we are in the stream anymore
+                self.log.exception("read error in defer_commands")
+                self._close_stream(stream)
+                if isinstance(sys.exc_info()[1], (EOFError, IOError, TimeoutError)):
+                    self._server.failed()
+                for _, _, error_value in cmds[n:]:
+                    result_channel.send((MemcacheResult.ERROR, error_value))
+            finally:
+                self._outstanding -= len(cmds)
         #end _read_commands
         def _write_commands():
             protocol = self._protocol
             try:
+                if not self._server.alive:
+                    #don't wait for a connect timeout, the server is probed in the background
+                    raise MemcacheError("server %s:%s is dead" % self._address)
                 if not self.is_connected():
                     self.connect()
             except TaskletExit:
                 raise
             except:
-                self.log.exception("connect error in defer_commands")
-                for _, _, error_value in cmds:
-                    result_channel.send((MemcacheResult.ERROR, error_value))
+                if self._server.alive:
+                    self.log.exception("connect error in defer_commands")
+                    self._server.failed()
+                if result_channel is not None:
+                    self._outstanding -= len(cmds)
+                    for _, _, error_value in cmds:
+                        result_channel.send((MemcacheResult.ERROR, error_value))
                 return
-            with self._stream.get_writer() as writer:
+            stream = self._stream
+            with stream.get_writer() as writer:
                 for cmd, args, error_value in cmds:
                     try:
                         protocol.write(cmd, writer, args)
@@ -175,16 +215,28 @@ class MemcacheConnection(object):
                         raise
                     except:
                         self.log.exception("write error in defer_commands")
-                        result_channel.send((MemcacheResult.ERROR, error_value))
+                        if result_channel is not None:
+                            result_channel.send((MemcacheResult.ERROR, error_value))
                 writer.flush()
-            self._read_queue.defer(_read_results)
+            if result_channel is not None:
+                self._read_queue.defer(_read_results, stream)
         #end _write_commands
+        if result_channel is not None:
+            self._outstanding += len(cmds)
         self._write_queue.defer(_write_commands)
 
     def _defer_command(self, cmd, args, result_channel, error_value = None):
         self._defer_commands([(cmd, args, error_value)], result_channel)
 
-    def _do_command(self, cmd, args, error_value = None):
+    def _defer_written(self, f, *args):
+        #calls f once the commands deferred before it have been written
+        self._write_queue.defer(f, *args)
+
+    def _do_command(self, cmd, args, error_value = None, noreply = False):
+        if noreply:
+            #fire and forget
+            self._defer_command(cmd, args + (True, ), None)
+            return None, error_value
         result_channel = ResultChannel()
         self._defer_command(cmd, args, result_channel, error_value)
         try:
@@ -192,10 +244,20 @@ class MemcacheConnection(object):
         except TimeoutError:
             return MemcacheResult.TIMEOUT, error_value
 
+    def _close_stream(self, stream):
+        if stream is self._stream:
+            self.close()
+
     def close(self):
         if self.is_connected():
-            self._stream.close()
+            stream = self._stream
             self._stream = None
+            try:
+                stream.close()
+            except TaskletExit:
+                raise
+            except:
+                self.log.exception("while closing connection")
 
     def __setitem__(self, key, data):
         self.set(key, data)
@@ -203,23 +265,23 @@ class MemcacheConnection(object):
     def __getitem__(self, key):
         return self.get(key)
 
-    def delete(self, key, expiration = 0):
-        return self._do_command("delete", (key, expiration))[0]
+    def delete(self, key, expiration = 0, noreply = False):
+        return self._do_command("delete", (key, expiration), None, noreply)[0]
 
-    def set(self, key, data, expiration = 0, flags = 0):
-        return self._do_command("set", (key, data, expiration, flags))[0]
+    def set(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_command("set", (key, data, expiration, flags), None, noreply)[0]
 
-    def add(self, key, data, expiration = 0, flags = 0):
-        return self._do_command("add", (key, data, expiration, flags))[0]
+    def add(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_command("add", (key, data, expiration, flags), None, noreply)[0]
 
-    def replace(self, key, data, expiration = 0, flags = 0):
-        return self._do_command("replace", (key, data, expiration, flags))[0]
+    def replace(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_command("replace", (key, data, expiration, flags), None, noreply)[0]
 
-    def append(self, key, data, expiration = 0, flags = 0):
-        return self._do_command("append", (key, data, expiration, flags))[0]
+    def append(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_command("append", (key, data, expiration, flags), None, noreply)[0]
 
-    def prepend(self, key, data, expiration = 0, flags = 0):
-        return self._do_command("prepend", (key, data, expiration, flags))[0]
+    def prepend(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_command("prepend", (key, data, expiration, flags), None, noreply)[0]
 
     def cas(self, key, data, cas_unique, expiration = 0, flags = 0):
         return self._do_command("cas", (key, data, expiration, flags, cas_unique))[0]
@@ -249,29 +311,176 @@ class MemcacheConnection(object):
     def gets_multi(self, keys):
         return self._do_command("gets", (keys, ))
 
+    def _do_commands(self, cmd, args_list, noreply):
+        #writes cmd for all args in one go, returns the results in order
+        if noreply:
+            self._defer_commands([(cmd, args + (True, ), None) for args in args_list], None)
+            return None
+        result_channel = ResultChannel()
+        self._defer_commands([(cmd, args, None) for args in args_list], result_channel)
+        try:
+            return [result for result, _ in result_channel.receive_n(len(args_list))]
+        except TimeoutError:
+            return [MemcacheResult.TIMEOUT] * len(args_list)
+
+    def set_multi(self, mapping, expiration = 0, flags = 0, noreply = False):
+        """stores all key/value pairs of *mapping*. Returns a dict key -> result, or None if *noreply*"""
+        keys = mapping.keys()
+        results = self._do_commands("set", [(key, mapping[key], expiration, flags) for key in keys], noreply)
+        if results is not None:
+            return dict(zip(keys, results))
+
+    def delete_multi(self, keys, expiration = 0, noreply = False):
+        """deletes all *keys*. Returns a dict key -> result, or None if *noreply*"""
+        results = self._do_commands("delete", [(key, expiration) for key in keys], noreply)
+        if results is not None:
+            return dict(zip(keys, results))
+
     def version(self):
         return self._do_command("version", ())
 
     def batch(self):
         return CommandBatch(self)
 
-class MemcacheConnectionManager(object):
-    _instance = None #TODO when we support multiple protocols, we need to have 1 instance per protocol
+    def __statistics__(self):
+        return {'outstanding': self._outstanding}
+
+class MemcacheServer(object):
+    """Keeps track of the health of a memcached server, shared by all connections to it"""
+    def __init__(self, address, manager = None):
+        self.address = address
+        self.alive = True
+        self.failures = 0 #consecutive failures
+        self.retry_delay = 0.0 #delay before the next probe of a dead server
+        self._manager = manager
+        self._failed_statistic = Statistic(0)
+        self._dead_statistic = Statistic(0)
+
+    def failed(self):
+        """records a failed connect, read or timeout"""
+        self.failures += 1
+        self._failed_statistic += 1
+        if self._manager is not None and self.alive and self.failures >= self._manager.max_failures:
+            self._manager._server_dead(self)
+
+    def succeeded(self):
+        self.failures = 0
+
+    def __statistics__(self):
+        return {'alive': self.alive,
+                'failures': self.failures,
+                'retry_delay': self.retry_delay,
+                'failed': self._failed_statistic,
+                'dead': self._dead_statistic}
 
-    def __init__(self):
-        self._connections = {} #address -> connection
+class MemcacheConnectionManager(object):
+    log = logging.getLogger("MemcacheConnectionManager")
+
+    _instance = None
+
+    def __init__(self, max_failures = 2, retry_delay = 1.0, max_retry_delay = 30.0, connect_timeout = 2.0,
+                 connections_per_server = 1, queue_threshold = 8):
+        """Up to *connections_per_server* connections are made to each server (for each protocol). A command is written
+        to the connection with the fewest outstanding reads, another connection is made when that one has
+        *queue_threshold* or more commands outstanding, so that large values do not hold up all other commands.
+        Note that with more than 1 connection, commands written with noreply are not ordered with respect to
+        commands that follow them.
+
+        A server is marked dead after *max_failures* consecutive failures (connect errors, read errors or timeouts).
+        Commands for a dead server fail immediately with MemcacheResult.ERROR instead of waiting for a connect timeout.
+        A dead server is probed in the background by connecting to it, first after *retry_delay* seconds and then
+        with a delay that doubles up till *max_retry_delay*. It is marked alive again as soon as a connect succeeds"""
+        self.max_failures = max_failures
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.connect_timeout = connect_timeout
+        self.connections_per_server = connections_per_server
+        self.queue_threshold = queue_threshold
+        self._connections = {} #(address, protocol class) -> [connections]
+        self._servers = {} #address -> server
+        self._listeners = weakref.WeakKeyDictionary() #clients to notify when a server goes down or comes back
 
     def get_connection(self, address, protocol):
-        """gets a connection to memcached servers at given address using given protocol."""
-        if not address in self._connections:
-            self._connections[address] = MemcacheConnection(address, protocol)
-        return self._connections[address]
+        """gets the least loaded connection to the memcached server at given address using given protocol."""
+        #clients using a different protocol can not share a connection
+        protocol = MemcacheProtocol.create(protocol)
+        key = (address, protocol.__class__)
+        connections = self._connections.get(key)
+        if connections is None:
+            connections = self._connections[key] = []
+        connection = None
+        for _connection in connections:
+            if connection is None or _connection.outstanding < connection.outstanding:
+                connection = _connection
+        if connection is None or (connection.outstanding >= self.queue_threshold and len(connections) < self.connections_per_server):
+            connection = MemcacheConnection(address, protocol, server = self.get_server(address))
+            connections.append(connection)
+        return connection
+
+    def get_server(self, address):
+        """returns the :class:`MemcacheServer` keeping track of the health of the server at *address*"""
+        if not address in self._servers:
+            self._servers[address] = MemcacheServer(address, self)
+        return self._servers[address]
+
+    def is_alive(self, address):
+        return address not in self._servers or self._servers[address].alive
+
+    def _add_listener(self, listener):
+        #listener._server_state_changed(address, alive) is called when a server dies or comes back
+        self._listeners[listener] = True
+
+    def _notify(self, server):
+        for listener in self._listeners.keys():
+            try:
+                listener._server_state_changed(server.address, server.alive)
+            except TaskletExit:
+                raise
+            except:
+                self.log.exception("while notifying server state change")
+
+    def _server_dead(self, server):
+        self.log.warn("marking memcached server %s:%s dead after %d failures", server.address[0], server.address[1], server.failures)
+        server.alive = False
+        server.retry_delay = self.retry_delay
+        server._dead_statistic += 1
+        for (address, _), connections in self._connections.items():
+            if address == server.address:
+                for connection in connections:
+                    connection.close()
+        Tasklet.new(self._probe, name = 'memcache_probe', daemon = True)(server)
+        self._notify(server)
+
+    def _probe(self, server):
+        while True:
+            Tasklet.sleep(server.retry_delay)
+            try:
+                Socket.connect(server.address, self.connect_timeout).close()
+                break
+            except TaskletExit:
+                raise
+            except:
+                server.retry_delay = min(server.retry_delay * 2, self.max_retry_delay)
+        self.log.warn("memcached server %s:%s is back", server.address[0], server.address[1])
+        server.alive = True
+        server.failures = 0
+        server.retry_delay = 0.0
+        self._notify(server)
 
     def close_all(self):
-        for connection in self._connections.values():
-            connection.close()
+        for connections in self._connections.values():
+            for connection in connections:
+                connection.close()
         self._connections = {}
 
+    def __statistics__(self):
+        servers = dict([('%s:%s' % address, server.__statistics__()) for address, server in self._servers.items()])
+        for statistics in servers.values():
+            statistics['connections'] = []
+        for (address, _), connections in self._connections.items():
+            servers['%s:%s' % address]['connections'].extend([connection.__statistics__() for connection in connections])
+        return {'servers': servers}
+
     @classmethod
     def create(cls, type_):
         if isinstance(type_, MemcacheConnectionManager):
@@ -284,7 +493,19 @@ class MemcacheConnectionManager(object):
             raise MemcacheError("connection manager: %s" % type_)
 
 class Memcache(object):
-    def __init__(self, servers = None, codec = "default", behaviour = "ketama", protocol = "text", connection_manager = "default"):
+    def __init__(self, servers = None, codec = "default", behaviour = "ketama", protocol = "text", connection_manager = "default",
+                 eject_dead_servers = False, coalesce_gets = False, coalesce_window = 0.0, local_cache = None):
+        """If *eject_dead_servers* is True, servers that are marked dead by the connection manager are removed from the
+        ketama continuum, so that their keys go to the other servers until they come back.
+
+        If *coalesce_gets* is True, single key gets (get, getr, gets) done by different tasks for the same server are
+        written as one multi get. The first get waits *coalesce_window* seconds (0.0 means a single iteration of the
+        dispatcher) for other tasks to add their keys, identical keys are only fetched once.
+
+        If a :class:`MemcacheLocalCache` is given as *local_cache*, values fetched by get and get_multi are kept in it
+        and later gets for those keys are served from it, without asking memcached. Keys are invalidated in the local
+        cache by the commands of this client that change them (both when they are written and when they are done),
+        but not by changes made by other clients."""
 
         self.read_timeout = 10
         self.write_timeout = 10
@@ -297,6 +518,19 @@ class Memcache(object):
 
         self._behaviour = MemcacheBehaviour.create(behaviour)
         self._key_to_addr = self._behaviour.key_to_addr
+        self._key_to_addr_many = self._behaviour.key_to_addr_many
+
+        self._local_cache = local_cache
+
+        self._coalesce_gets = coalesce_gets
+        self._coalesce_window = coalesce_window
+        self._pending_gets = {} #(address, cmd) -> {key: [result channels]}
+
+        self._servers = None
+        self._eject_dead_servers = eject_dead_servers
+        if eject_dead_servers:
+            assert isinstance(self._behaviour, MemcacheKetamaBehaviour), "ejection of dead servers needs ketama behaviour"
+            self._connection_manager._add_listener(self)
 
         self.set_servers(servers)
 
@@ -304,20 +538,78 @@ class Memcache(object):
         return self._connection_manager.get_connection(addr, self._protocol)
 
     def _get(self, cmd, key, default):
-        result_channel = ResultChannel()
-        connection = self.connection_for_key(key)
-        connection._defer_command(cmd, [[key]], result_channel, {})
-        result, values = result_channel.receive()
+        local_cache = self._local_cache
+        if local_cache is not None and cmd == "get":
+            value = local_cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return MemcacheResult.OK, value
+            generation = local_cache.generation
+            #the size of the encoded value is read along, so that the local cache does not have to encode it again
+            result, values = self._fetch("get_sized", key)
+            if key in values:
+                value, size = values[key]
+                local_cache.put(key, value, generation, size = size)
+                return result, value
+            return result, default
+        result, values = self._fetch(cmd, key)
         return result, values.get(key, default)
 
+    def _fetch(self, cmd, key):
+        if self._coalesce_gets:
+            return self._coalesced_get(cmd, key)
+        else:
+            result_channel = ResultChannel()
+            connection = self.connection_for_key(key)
+            connection._defer_command(cmd, [[key]], result_channel, {})
+            return result_channel.receive()
+
+    def _coalesced_get(self, cmd, key):
+        address = self._key_to_addr(key)
+        result_channel = ResultChannel()
+        pending = self._pending_gets.get((address, cmd))
+        if pending is not None:
+            #the task that started this get will write it
+            if key in pending:
+                pending[key].append(result_channel)
+            else:
+                pending[key] = [result_channel]
+        else:
+            pending = self._pending_gets[(address, cmd)] = {key: [result_channel]}
+            try:
+                Tasklet.sleep(self._coalesce_window) #other tasks add their keys meanwhile
+            finally:
+                del self._pending_gets[(address, cmd)]
+                self._get_connection(address)._defer_command(cmd, [pending.keys()], _GetFanOut(pending), {})
+        return result_channel.receive()
+
     def _get_multi(self, cmd, keys):
 
+        local_cache = self._local_cache
+        if local_cache is not None and cmd == "get":
+            #only fetch the keys that are not cached
+            cached_values = {}
+            missing_keys = []
+            for key in keys:
+                value = local_cache.get(key, _MISSING)
+                if value is _MISSING:
+                    missing_keys.append(key)
+                else:
+                    cached_values[key] = value
+            if not missing_keys:
+                return MemcacheResult.OK, cached_values
+            generation = local_cache.generation
+            result, values = self._get_multi_servers("get_sized", missing_keys)
+            for key, (value, size) in values.iteritems():
+                local_cache.put(key, value, generation, size = size)
+                cached_values[key] = value
+            return result, cached_values
+        else:
+            return self._get_multi_servers(cmd, keys)
+
+    def _get_multi_servers(self, cmd, keys):
 
         #group keys by address (address->[keys]):
-        grouped_addrs = {}
-        for key in keys:
-            addr = self._key_to_addr(key)
-            grouped_addrs.setdefault(addr, []).append(key)
+        grouped_addrs = self._key_to_addr_many(keys)
 
         #n is the number of servers we need to 'get' from
         n = len(grouped_addrs)
@@ -340,7 +632,46 @@ class Memcache(object):
 
     def set_servers(self, servers = None):
         if servers is not None:
-            self._behaviour.set_servers(servers)
+            self._servers = servers
+            self._update_servers()
+
+    def _update_servers(self):
+        servers = self._servers
+        if self._eject_dead_servers:
+            alive = [server for server in servers if self._connection_manager.is_alive(server[0])]
+            if alive: #if all servers are dead, we keep them all
+                servers = alive
+        self._behaviour.set_servers(servers)
+
+    def _server_state_changed(self, address, alive):
+        if self._servers is not None and address in [server[0] for server in self._servers]:
+            self._update_servers()
+
+    def __statistics__(self):
+        statistics = self._connection_manager.__statistics__()
+        if self._local_cache is not None:
+            statistics = dict(statistics, local_cache = self._local_cache.__statistics__())
+        return statistics
+
+    def _invalidate_keys(self, keys):
+        for key in keys:
+            self._local_cache.invalidate(key)
+
+    def _do_write(self, cmd, key, args, noreply = False):
+        #the key is invalidated in the local cache before the write, and again when it is done (or written if noreply),
+        #so that a get that was answered before the write is not put in the local cache afterwards
+        connection = self.connection_for_key(key)
+        local_cache = self._local_cache
+        if local_cache is None:
+            return connection._do_command(cmd, args, None, noreply)
+        local_cache.invalidate(key)
+        try:
+            return connection._do_command(cmd, args, None, noreply)
+        finally:
+            if noreply:
+                connection._defer_written(local_cache.invalidate, key)
+            else:
+                local_cache.invalidate(key)
 
     def connection_for_key(self, key):
         return self._get_connection(self._key_to_addr(key))
@@ -351,32 +682,32 @@ class Memcache(object):
     def __setitem__(self, key, data):
         self.set(key, data)
 
-    def delete(self, key, expiration = 0):
-        return self.connection_for_key(key)._do_command("delete", (key, expiration))[0]
+    def delete(self, key, expiration = 0, noreply = False):
+        return self._do_write("delete", key, (key, expiration), noreply)[0]
 
-    def set(self, key, data, expiration = 0, flags = 0):
-        return self.connection_for_key(key)._do_command("set", (key, data, expiration, flags))[0]
+    def set(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_write("set", key, (key, data, expiration, flags), noreply)[0]
 
-    def add(self, key, data, expiration = 0, flags = 0):
-        return self.connection_for_key(key)._do_command("add", (key, data, expiration, flags))[0]
+    def add(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_write("add", key, (key, data, expiration, flags), noreply)[0]
 
-    def replace(self, key, data, expiration = 0, flags = 0):
-        return self.connection_for_key(key)._do_command("replace", (key, data, expiration, flags))[0]
+    def replace(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_write("replace", key, (key, data, expiration, flags), noreply)[0]
 
-    def append(self, key, data, expiration = 0, flags = 0):
-        return self.connection_for_key(key)._do_command("append", (key, data, expiration, flags))[0]
+    def append(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_write("append", key, (key, data, expiration, flags), noreply)[0]
 
-    def prepend(self, key, data, expiration = 0, flags = 0):
-        return self.connection_for_key(key)._do_command("prepend", (key, data, expiration, flags))[0]
+    def prepend(self, key, data, expiration = 0, flags = 0, noreply = False):
+        return self._do_write("prepend", key, (key, data, expiration, flags), noreply)[0]
 
     def cas(self, key, data, cas_unique, expiration = 0, flags = 0):
-        return self.connection_for_key(key)._do_command("cas", (key, data, expiration, flags, cas_unique))[0]
+        return self._do_write("cas", key, (key, data, expiration, flags, cas_unique))[0]
 
     def incr(self, key, increment):
-        return self.connection_for_key(key)._do_command("incr", (key, increment))
+        return self._do_write("incr", key, (key, increment))
 
     def decr(self, key, increment):
-        return self.connection_for_key(key)._do_command("decr", (key, increment))
+        return self._do_write("decr", key, (key, increment))
 
     def get(self, key, default = None):
         return self._get("get", key, default)[1]
@@ -394,3 +725,43 @@ class Memcache(object):
     def gets_multi(self, keys):
         return self._get_multi("gets", keys)
 
+    def _do_multi(self, cmd, keys, args_func, noreply):
+        #writes cmd for the keys of each server in one go, the servers are written to concurrently.
+        #like _do_write, the keys are invalidated in the local cache before and after writing
+        local_cache = self._local_cache
+        if local_cache is not None:
+            keys = list(keys)
+            self._invalidate_keys(keys)
+        pending = []
+        for address, _keys in self._key_to_addr_many(keys).iteritems():
+            connection = self._get_connection(address)
+            if noreply:
+                connection._defer_commands([(cmd, args_func(key) + (True, ), None) for key in _keys], None)
+                if local_cache is not None:
+                    connection._defer_written(self._invalidate_keys, _keys)
+            else:
+                result_channel = ResultChannel()
+                connection._defer_commands([(cmd, args_func(key), None) for key in _keys], result_channel)
+                pending.append((_keys, result_channel))
+        if noreply:
+            return None
+        try:
+            results = {}
+            for _keys, result_channel in pending:
+                for key, (result, _) in zip(_keys, result_channel.receive_n(len(_keys))):
+                    results[key] = result
+            return results
+        finally:
+            if local_cache is not None:
+                self._invalidate_keys(keys)
+
+    def set_multi(self, mapping, expiration = 0, flags = 0, noreply = False):
+        """stores all key/value pairs of *mapping*, the commands for each server are written in one go.
+        Returns a dict key -> result, or None if *noreply*, in that case nothing is read back from the servers,
+        which gives the highest fill rate"""
+        return self._do_multi("set", mapping.iterkeys(), lambda key: (key, mapping[key], expiration, flags), noreply)
+
+    def delete_multi(self, keys, expiration = 0, noreply = False):
+        """deletes all *keys*, the commands for each server are written in one go.
+        Returns a dict key -> result, or None if *noreply*"""
+        return self._do_multi("delete", keys, lambda key: (key, expiration), noreply)
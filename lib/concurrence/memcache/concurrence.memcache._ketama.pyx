@@ -0,0 +1,150 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+"""
+compiled ketama continuum, compatible with libketama and the pure python implementation in concurrence.memcache.ketama
+"""
+
+import math
+
+from concurrence.memcache import MemcacheError
+
+cdef extern from "stdlib.h":
+    ctypedef void const_void "const void"
+    ctypedef int (*cmp_func)(const_void *, const_void *)
+    cdef void *malloc(int)
+    cdef void free(void *)
+    cdef void qsort(void *, int, int, cmp_func)
+
+cdef extern from "Python.h":
+    int PyString_AsStringAndSize(object, char **, Py_ssize_t *) except -1
+
+cdef extern from "md5.h":
+    cdef void md5_digest(unsigned char *data, unsigned int length, unsigned char digest[16])
+
+cdef struct point:
+    unsigned int value
+    int server #index in Continuum.servers
+
+cdef int _point_cmp(const_void *a, const_void *b):
+    cdef unsigned int x, y
+    x = (<point *>a).value
+    y = (<point *>b).value
+    if x < y:
+        return -1
+    elif x > y:
+        return 1
+    else:
+        return 0
+
+cdef unsigned int _digest_point(unsigned char *digest, int h):
+    #the h-th little endian 32 bit number of the digest
+    return digest[h * 4] | (digest[h * 4 + 1] << 8) | (digest[h * 4 + 2] << 16) | (<unsigned int>digest[h * 4 + 3] << 24)
+
+cdef unsigned int _hash(object key) except? 0:
+    cdef char *s
+    cdef Py_ssize_t n
+    cdef unsigned char digest[16]
+    if type(key) is not str:
+        key = str(key)
+    PyString_AsStringAndSize(key, &s, &n)
+    md5_digest(<unsigned char *>s, n, digest)
+    return _digest_point(digest, 0)
+
+def hashi(key):
+    """the point of *key* on the continuum"""
+    return _hash(key)
+
+cdef class Continuum:
+    """The continuum of the given list of servers, each item in the list is a tuple ((ip_addr, port), weight).
+    The points are kept in a sorted array, each with the index of its server in :attr:`servers`"""
+    cdef point *_points
+    cdef int _count
+    cdef readonly object servers #addresses of the servers
+
+    def __cinit__(self, servers):
+        self._points = NULL
+        self._count = 0
+
+    def __init__(self, servers):
+        cdef int i, k, h, server_count, memory
+        cdef char *s
+        cdef Py_ssize_t n
+        cdef unsigned char digest[16]
+        cdef point *p
+
+        self.servers = [server[0] for server in servers]
+        server_count = len(servers)
+        memory = sum([server[1] for server in servers]) #total weight of servers (a.k.a. memory)
+        #number of hashes per server, 40 per server on average, 4 points per hash
+        ks = [int(math.floor(float(server[1]) / memory * 40.0 * server_count)) for server in servers]
+        self._points = <point *>malloc(sizeof(point) * (4 * sum(ks) + 1))
+        if self._points == NULL:
+            raise MemoryError()
+        p = self._points
+        for i from 0 <= i < server_count:
+            address = servers[i][0]
+            for k from 0 <= k < ks[i]:
+                ss = "%s:%s-%d" % (address[0], address[1], k)
+                PyString_AsStringAndSize(ss, &s, &n)
+                md5_digest(<unsigned char *>s, n, digest)
+                for h from 0 <= h < 4:
+                    p.value = _digest_point(digest, h)
+                    p.server = i
+                    p = p + 1
+        self._count = p - self._points
+        qsort(self._points, self._count, sizeof(point), _point_cmp)
+        for i from 1 <= i < self._count:
+            assert self._points[i - 1].value != self._points[i].value, "point collission while building continuum"
+
+    def __dealloc__(self):
+        if self._points != NULL:
+            free(self._points)
+
+    def __len__(self):
+        return self._count
+
+    cdef int _server(self, unsigned int value) except -1:
+        #index of the server of the first point >= value, wrapping around at the end of the continuum
+        cdef int lo, hi, mid
+        if self._count == 0:
+            raise MemcacheError("no servers")
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self._points[mid].value < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._count:
+            lo = 0
+        return self._points[lo].server
+
+    def key_to_addr(self, key):
+        """maps given key to the address of its server"""
+        return self.servers[self._server(_hash(key))]
+
+    def key_to_addr_many(self, keys):
+        """maps all *keys* to their server, returns a dict address -> [keys]"""
+        cdef int i, server_count
+        server_count = len(self.servers)
+        grouped = [None] * server_count
+        for key in keys:
+            i = self._server(_hash(key))
+            _keys = grouped[i]
+            if _keys is None:
+                grouped[i] = [key]
+            else:
+                _keys.append(key)
+        result = {}
+        for i from 0 <= i < server_count:
+            if grouped[i] is not None:
+                address = self.servers[i]
+                if address in result: #same server listed twice
+                    result[address].extend(grouped[i])
+                else:
+                    result[address] = grouped[i]
+        return result
@@ -12,8 +12,12 @@
 #
 #the test server_list below was taken from the libketama distribution and 1 million keys were mapped with
 #both this implementation and the libketama to test this implementations compatibility
+#
+#the memcache client uses the compiled version of the continuum in concurrence.memcache._ketama,
+#this module is kept as the reference implementation it is tested against
 
 import math
+import time
 import hashlib
 import bisect
 import unittest
@@ -83,6 +87,48 @@ class TestKetama(unittest.TestCase):
         self.assertEquals((1423001712, ('10.0.1.6', 11211)), (hashi('65422'), get_server('65422', continuum)))
         self.assertEquals((3809055594, ('10.0.1.6', 11211)), (hashi('74912'), get_server('74912', continuum)))
 
+    def testCompiledKetama(self):
+        from concurrence.memcache._ketama import Continuum, hashi as _hashi
+
+        continuum = build_continuum(self.test_servers)
+        _continuum = Continuum(self.test_servers)
+        self.assertEquals(len(continuum), len(_continuum))
+
+        self.assertEquals((3769287096, ('10.0.1.7', 11211)), (_hashi('12936'), _continuum.key_to_addr('12936')))
+        self.assertEquals((435768809, ('10.0.1.5', 11211)), (_hashi('27804'), _continuum.key_to_addr('27804')))
+        self.assertEquals((1996655674, ('10.0.1.2', 11211)), (_hashi('37045'), _continuum.key_to_addr('37045')))
+        self.assertEquals((2954822664, ('10.0.1.1', 11211)), (_hashi('50829'), _continuum.key_to_addr('50829')))
+        self.assertEquals((1423001712, ('10.0.1.6', 11211)), (_hashi('65422'), _continuum.key_to_addr('65422')))
+        self.assertEquals((3809055594, ('10.0.1.6', 11211)), (_hashi('74912'), _continuum.key_to_addr('74912')))
+
+        #md5 padding depends on the length of the key
+        for n in range(200):
+            key = ''.join([chr(i % 256) for i in range(n)])
+            self.assertEquals(hashi(key), _hashi(key))
+
+        keys = ['key%d' % i for i in range(10000)] + range(100)
+        grouped = _continuum.key_to_addr_many(keys)
+        self.assertEquals(len(keys), sum([len(_keys) for _keys in grouped.values()]))
+        for addr, _keys in grouped.items():
+            for key in _keys:
+                self.assertEquals(addr, get_server(key, continuum))
+                self.assertEquals(addr, _continuum.key_to_addr(key))
+
+        N = 100000
+        keys = ['key%d' % i for i in range(N)]
+        start = time.time()
+        for key in keys:
+            get_server(key, continuum)
+        print 'python ketama keys/sec', N / (time.time() - start)
+        start = time.time()
+        for key in keys:
+            _continuum.key_to_addr(key)
+        print 'compiled ketama keys/sec', N / (time.time() - start)
+        start = time.time()
+        for i in range(0, N, 100):
+            _continuum.key_to_addr_many(keys[i:i+100])
+        print 'compiled ketama key_to_addr_many (100) keys/sec', N / (time.time() - start)
+
 if __name__ == '__main__':
     unittest.main()
 
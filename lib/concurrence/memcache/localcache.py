@@ -0,0 +1,118 @@
+# Copyright (C) 2009, Hyves (Startphone Ltd.)
+#
+# This module is part of the Concurrence Framework and is released under
+# the New BSD License: http://www.opensource.org/licenses/bsd-license.php
+
+import time
+
+from concurrence.containers.dequedict import DequeDict
+from concurrence.statistic import Statistic
+from concurrence.memcache.codec import MemcacheCodec
+
+class MemcacheLocalCache(object):
+    """An in-process cache of memcache values (see the *local_cache* argument of :class:`Memcache`).
+    Values are kept for *ttl* seconds (unless given otherwise when they are put) and the least recently used values
+    are evicted when the total size of the cached keys and values gets above *max_size* bytes. The size of a value
+    is the length of its encoding by *codec*. Cached values are shared by all callers, so they should not be modified.
+    The last *max_invalidated* invalidated keys are remembered, so that values fetched before they were invalidated are
+    not put in the cache afterwards"""
+
+    def __init__(self, max_size = 1024 * 1024, ttl = 1.0, codec = "default", max_invalidated = 1024):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_invalidated = max_invalidated
+        self.size = 0
+        self.generation = 0 #incremented on every invalidate
+
+        self._invalidated = DequeDict() #key -> generation it was last invalidated at, most recent first
+        self._horizon = 0 #highest generation of the invalidations that are no longer remembered
+
+        self._codec = MemcacheCodec.create(codec)
+        self._entries = DequeDict() #key -> (value, size, expires), most recently used first
+
+        self._hit_statistic = Statistic(0)
+        self._miss_statistic = Statistic(0)
+        self._eviction_statistic = Statistic(0)
+        self._expired_statistic = Statistic(0)
+
+    def get(self, key, default = None):
+        """returns the cached value for *key*, or *default* if it is not cached or has expired"""
+        entries = self._entries
+        if key in entries:
+            value, _, expires = entries[key]
+            if expires > time.time():
+                entries.movehead(key)
+                self._hit_statistic += 1
+                return value
+            self._remove(key)
+            self._expired_statistic += 1
+        self._miss_statistic += 1
+        return default
+
+    def put(self, key, value, generation = None, ttl = None, size = None):
+        """caches *value* for *key*. If *generation* is given, the value is only cached if *key* was not invalidated since
+        :attr:`generation` had that value, e.g. while the value was being fetched from memcached.
+        *size* is the length of the encoded value if it is known already, e.g. as read from memcached"""
+        if generation is not None and self._invalidated_at(key) > generation:
+            return
+        if key in self._entries:
+            self._remove(key)
+        if size is None:
+            if type(value) is str:
+                size = len(value) #codecs store a str as is
+            else:
+                size = len(self._codec.encode(value, 0)[0])
+        size += len(key)
+        if size > self.max_size:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        self._entries.appendleft(key, (value, size, time.time() + ttl))
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, _size, _) = self._entries.pop()
+            self.size -= _size
+            self._eviction_statistic += 1
+
+    def invalidate(self, key):
+        """removes *key* from the cache, and makes sure no value for it that was fetched before is put afterwards"""
+        self.generation += 1
+        invalidated = self._invalidated
+        if key in invalidated:
+            del invalidated[key]
+        invalidated.appendleft(key, self.generation)
+        if len(invalidated) > self.max_invalidated:
+            _, self._horizon = invalidated.pop()
+        if key in self._entries:
+            self._remove(key)
+
+    def _invalidated_at(self, key):
+        #the generation key was last invalidated at, keys that are not remembered anymore could have been invalidated upto the horizon
+        if key in self._invalidated:
+            return self._invalidated[key]
+        return self._horizon
+
+    def _remove(self, key):
+        self.size -= self._entries[key][1]
+        del self._entries[key]
+
+    def clear(self):
+        self.generation += 1
+        self._horizon = self.generation
+        self._invalidated = DequeDict()
+        self._entries = DequeDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __statistics__(self):
+        return {'hits': self._hit_statistic,
+                'misses': self._miss_statistic,
+                'evictions': self._eviction_statistic,
+                'expired': self._expired_statistic,
+                'entries': len(self._entries),
+                'size': self.size}
@@ -0,0 +1,109 @@
+#include "md5.h"
+
+#include <string.h>
+#include <stdint.h>
+
+/* straightforward md5 (rfc 1321), only what is needed for ketama hashing: a digest of a complete string */
+
+static const uint32_t K[64] = {
+    0xd76aa478, 0xe8c7b756, 0x242070db, 0xc1bdceee,
+    0xf57c0faf, 0x4787c62a, 0xa8304613, 0xfd469501,
+    0x698098d8, 0x8b44f7af, 0xffff5bb1, 0x895cd7be,
+    0x6b901122, 0xfd987193, 0xa679438e, 0x49b40821,
+    0xf61e2562, 0xc040b340, 0x265e5a51, 0xe9b6c7aa,
+    0xd62f105d, 0x02441453, 0xd8a1e681, 0xe7d3fbc8,
+    0x21e1cde6, 0xc33707d6, 0xf4d50d87, 0x455a14ed,
+    0xa9e3e905, 0xfcefa3f8, 0x676f02d9, 0x8d2a4c8a,
+    0xfffa3942, 0x8771f681, 0x6d9d6122, 0xfde5380c,
+    0xa4beea44, 0x4bdecfa9, 0xf6bb4b60, 0xbebfbc70,
+    0x289b7ec6, 0xeaa127fa, 0xd4ef3085, 0x04881d05,
+    0xd9d4d039, 0xe6db99e5, 0x1fa27cf8, 0xc4ac5665,
+    0xf4292244, 0x432aff97, 0xab9423a7, 0xfc93a039,
+    0x655b59c3, 0x8f0ccc92, 0xffeff47d, 0x85845dd1,
+    0x6fa87e4f, 0xfe2ce6e0, 0xa3014314, 0x4e0811a1,
+    0xf7537e82, 0xbd3af235, 0x2ad7d2bb, 0xeb86d391,
+};
+
+static const unsigned char S[64] = {
+    7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22,
+    5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20,
+    4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23,
+    6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21,
+};
+
+static void md5_block(uint32_t state[4], const unsigned char *block)
+{
+	uint32_t m[16];
+	uint32_t a, b, c, d, f, t;
+	int i, g;
+
+	for (i = 0; i < 16; i++) {
+		m[i] = (uint32_t)block[i * 4] | ((uint32_t)block[i * 4 + 1] << 8) |
+			((uint32_t)block[i * 4 + 2] << 16) | ((uint32_t)block[i * 4 + 3] << 24);
+	}
+
+	a = state[0];
+	b = state[1];
+	c = state[2];
+	d = state[3];
+
+	for (i = 0; i < 64; i++) {
+		if (i < 16) {
+			f = (b & c) | (~b & d);
+			g = i;
+		} else if (i < 32) {
+			f = (d & b) | (~d & c);
+			g = (5 * i + 1) & 15;
+		} else if (i < 48) {
+			f = b ^ c ^ d;
+			g = (3 * i + 5) & 15;
+		} else {
+			f = c ^ (b | ~d);
+			g = (7 * i) & 15;
+		}
+		t = a + f + K[i] + m[g];
+		a = d;
+		d = c;
+		c = b;
+		b = b + ((t << S[i]) | (t >> (32 - S[i])));
+	}
+
+	state[0] += a;
+	state[1] += b;
+	state[2] += c;
+	state[3] += d;
+}
+
+void md5_digest(const unsigned char *data, unsigned int length, unsigned char digest[16])
+{
+	uint32_t state[4] = { 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476 };
+	unsigned char tail[128];
+	unsigned int rest, n, i;
+	uint64_t bits;
+
+	for (n = 0; n + 64 <= length; n += 64) {
+		md5_block(state, data + n);
+	}
+
+	/* padding: 0x80, zeros, then the message length in bits (little endian) in the last 8 bytes */
+	rest = length - n;
+	memcpy(tail, data + n, rest);
+	tail[rest] = 0x80;
+	n = (rest < 56) ? 64 : 128;
+	memset(tail + rest + 1, 0, n - rest - 1);
+	bits = (uint64_t)length << 3;
+	for (i = 0; i < 8; i++) {
+		tail[n - 8 + i] = (unsigned char)(bits >> (8 * i));
+	}
+	md5_block(state, tail);
+	if (n == 128) {
+		md5_block(state, tail + 64);
+	}
+
+	for (i = 0; i < 4; i++) {
+		digest[i * 4] = (unsigned char)state[i];
+		digest[i * 4 + 1] = (unsigned char)(state[i] >> 8);
+		digest[i * 4 + 2] = (unsigned char)(state[i] >> 16);
+		digest[i * 4 + 3] = (unsigned char)(state[i] >> 24);
+	}
+}
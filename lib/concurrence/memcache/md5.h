@@ -0,0 +1 @@
+extern void md5_digest(const unsigned char *data, unsigned int length, unsigned char digest[16]);
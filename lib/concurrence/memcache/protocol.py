@@ -1,18 +1,10 @@
+import struct
+import logging
+
 from concurrence.memcache import MemcacheError, MemcacheResult
 from concurrence.memcache.codec import MemcacheCodec
 
 class MemcacheProtocol(object):
-    @classmethod
-    def create(cls, type_):
-
-        if isinstance(type_, MemcacheProtocol):
-            return type_
-        elif type_ == 'text':
-            return MemcacheTextProtocol()
-        else:
-            raise MemcacheError("unknown protocol: %s" % type_)
-
-class MemcacheTextProtocol(MemcacheProtocol):
     def __init__(self, codec = "default"):
         self.set_codec(codec)
         self._rcache = {}
@@ -33,6 +25,19 @@ class MemcacheTextProtocol(MemcacheProtocol):
     def write(self, cmd, writer, args):
         return self._wcache[cmd](writer, *args)
 
+    @classmethod
+    def create(cls, type_):
+
+        if isinstance(type_, MemcacheProtocol):
+            return type_
+        elif type_ == 'text':
+            return MemcacheTextProtocol()
+        elif type_ == 'binary':
+            return MemcacheBinaryProtocol()
+        else:
+            raise MemcacheError("unknown protocol: %s" % type_)
+
+class MemcacheTextProtocol(MemcacheProtocol):
     def _read_result(self, reader, value = None):
         response_line = reader.read_line()
         return MemcacheResult.get(response_line), value
@@ -47,9 +52,12 @@ class MemcacheTextProtocol(MemcacheProtocol):
         else:
             return MemcacheResult.get(response_line), None
 
-    def _write_storage(self, writer, cmd, key, value, expiration, flags):
+    def _write_storage(self, writer, cmd, key, value, expiration, flags, noreply = False):
         encoded_value, flags = self._codec.encode(value, flags)
-        writer.write_bytes("%s %s %d %d %d\r\n%s\r\n" % (cmd, key, flags, expiration, len(encoded_value), encoded_value))
+        if noreply:
+            writer.write_bytes("%s %s %d %d %d noreply\r\n%s\r\n" % (cmd, key, flags, expiration, len(encoded_value), encoded_value))
+        else:
+            writer.write_bytes("%s %s %d %d %d\r\n%s\r\n" % (cmd, key, flags, expiration, len(encoded_value), encoded_value))
 
     def write_cas(self, writer, key, value, expiration, flags, cas_unique):
         encoded_value, flags = self._codec.encode(value, flags)
@@ -86,7 +94,12 @@ class MemcacheTextProtocol(MemcacheProtocol):
     def write_gets(self, writer, keys):
         writer.write_bytes("gets %s\r\n" % " ".join(keys))
 
-    def read_get(self, reader, with_cas_unique = False):
+    def read_get(self, reader, with_cas_unique = False, views = False, with_size = False):
+        """reads the response of a get. If *views* is True the values are not decoded, instead for each key a
+        tuple (flags, view) is returned, where view is a :class:`Buffer` referencing the encoded value in the read buffer
+        (see :func:`BufferedReader.read_view`), e.g. so that it can be forwarded without being copied.
+        The views are only valid until the next read from *reader*, so all of them must fit in its buffer.
+        If *with_size* is True a tuple (value, size) is returned for each key, where size is the length of the encoded value"""
         result = {}
         while True:
             response_line = reader.read_line()
@@ -97,12 +110,17 @@ class MemcacheTextProtocol(MemcacheProtocol):
                 n = int(response_fields[3])
                 if with_cas_unique:
                     cas_unique = int(response_fields[4])
-                encoded_value = reader.read_bytes(n)
+                if views:
+                    value = (flags, reader.read_view(n))
+                else:
+                    value = self._codec.decode(flags, reader.read_bytes(n))
+                if with_size:
+                    value = (value, n)
                 reader.read_line() #\r\n
                 if with_cas_unique:
-                    result[key] = (self._codec.decode(flags, encoded_value), cas_unique)
+                    result[key] = (value, cas_unique)
                 else:
-                    result[key] = self._codec.decode(flags, encoded_value)
+                    result[key] = value
             elif response_line == 'END':
                 return MemcacheResult.OK, result
             else:
@@ -111,38 +129,289 @@ class MemcacheTextProtocol(MemcacheProtocol):
     def read_gets(self, reader):
         return self.read_get(reader, with_cas_unique = True)
 
-    def write_delete(self, writer, key, expiration):
-        writer.write_bytes("delete %s %d\r\n" % (key, expiration))
+    def write_get_sized(self, writer, keys):
+        self.write_get(writer, keys)
+
+    def read_get_sized(self, reader):
+        return self.read_get(reader, with_size = True)
+
+    def write_delete(self, writer, key, expiration, noreply = False):
+        if noreply:
+            writer.write_bytes("delete %s %d noreply\r\n" % (key, expiration))
+        else:
+            writer.write_bytes("delete %s %d\r\n" % (key, expiration))
 
     def read_delete(self, reader):
         return self._read_result(reader)
 
-    def write_set(self, writer, key, value, expiration, flags):
-        return self._write_storage(writer, "set", key, value, expiration, flags)
+    def write_set(self, writer, key, value, expiration, flags, noreply = False):
+        return self._write_storage(writer, "set", key, value, expiration, flags, noreply)
 
     def read_set(self, reader):
         return self._read_result(reader)
 
-    def write_add(self, writer, key, value, expiration, flags):
-        return self._write_storage(writer, "add", key, value, expiration, flags)
+    def write_add(self, writer, key, value, expiration, flags, noreply = False):
+        return self._write_storage(writer, "add", key, value, expiration, flags, noreply)
 
     def read_add(self, reader):
         return self._read_result(reader)
 
-    def write_replace(self, writer, key, value, expiration, flags):
-        return self._write_storage(writer, "replace", key, value, expiration, flags)
+    def write_replace(self, writer, key, value, expiration, flags, noreply = False):
+        return self._write_storage(writer, "replace", key, value, expiration, flags, noreply)
 
     def read_replace(self, reader):
         return self._read_result(reader)
 
-    def write_append(self, writer, key, value, expiration, flags):
-        return self._write_storage(writer, "append", key, value, expiration, flags)
+    def write_append(self, writer, key, value, expiration, flags, noreply = False):
+        return self._write_storage(writer, "append", key, value, expiration, flags, noreply)
 
     def read_append(self, reader):
         return self._read_result(reader)
 
-    def write_prepend(self, writer, key, value, expiration, flags):
-        return self._write_storage(writer, "prepend", key, value, expiration, flags)
+    def write_prepend(self, writer, key, value, expiration, flags, noreply = False):
+        return self._write_storage(writer, "prepend", key, value, expiration, flags, noreply)
 
     def read_prepend(self, reader):
         return self._read_result(reader)
+
+#binary protocol, see http://code.google.com/p/memcached/wiki/MemcacheBinaryProtocol
+#all numbers are big endian, the Buffer int methods are little endian (mysql), so the fixed
+#width parts are packed and unpacked with a struct, one call per header
+HEADER = struct.Struct('!BBHBBHIIQ') #magic, opcode, key length, extras length, data type, status (vbucket in requests), body length, opaque, cas
+HEADER_SIZE = HEADER.size
+STORAGE_EXTRAS = struct.Struct('!II') #flags, expiration
+INCDEC_EXTRAS = struct.Struct('!QQI') #delta, initial value, expiration
+FLAGS = struct.Struct('!I')
+COUNTER = struct.Struct('!Q')
+EXPIRATION = struct.Struct('!I')
+
+MAGIC_REQUEST = 0x80
+MAGIC_RESPONSE = 0x81
+
+OP_GET = 0x00
+OP_SET = 0x01
+OP_ADD = 0x02
+OP_REPLACE = 0x03
+OP_DELETE = 0x04
+OP_INCREMENT = 0x05
+OP_DECREMENT = 0x06
+OP_NOOP = 0x0a
+OP_VERSION = 0x0b
+OP_GETKQ = 0x0d
+OP_APPEND = 0x0e
+OP_PREPEND = 0x0f
+OP_SETQ = 0x11
+OP_ADDQ = 0x12
+OP_REPLACEQ = 0x13
+OP_DELETEQ = 0x14
+OP_APPENDQ = 0x19
+OP_PREPENDQ = 0x1a
+
+#quiet variant of each command, the server only responds to these when there is an error
+QUIET = {OP_SET: OP_SETQ, OP_ADD: OP_ADDQ, OP_REPLACE: OP_REPLACEQ, OP_DELETE: OP_DELETEQ,
+         OP_APPEND: OP_APPENDQ, OP_PREPEND: OP_PREPENDQ}
+QUIET_OPCODES = frozenset(QUIET.values())
+
+STATUS_NO_ERROR = 0x00
+STATUS_KEY_NOT_FOUND = 0x01
+STATUS_KEY_EXISTS = 0x02
+STATUS_VALUE_TOO_LARGE = 0x03
+STATUS_INVALID_ARGUMENTS = 0x04
+STATUS_ITEM_NOT_STORED = 0x05
+STATUS_NON_NUMERIC = 0x06
+STATUS_UNKNOWN_COMMAND = 0x81
+STATUS_OUT_OF_MEMORY = 0x82
+
+NO_CREATE = 0xFFFFFFFF #incr/decr expiration meaning: do not create a missing counter
+
+class MemcacheBinaryProtocol(MemcacheProtocol):
+    """Implements the memcached binary protocol with the same commands and results as :class:`MemcacheTextProtocol`.
+    Multi gets are written as a pipeline of quiet getkq commands ended by a noop, so misses cost no response.
+    Storage commands and delete written with *noreply* use the quiet commands (setq etc.), these do not get a response
+    unless they fail. The error responses of quiet commands are logged and skipped by the next read"""
+    log = logging.getLogger("MemcacheBinaryProtocol")
+
+    def _write_command(self, writer, opcode, key = '', extras = '', value = '', cas = 0):
+        writer.write_bytes(HEADER.pack(MAGIC_REQUEST, opcode, len(key), len(extras), 0, 0,
+                                       len(extras) + len(key) + len(value), 0, cas) + extras + key)
+        if value:
+            writer.write_bytes(value)
+
+    def _read_response(self, reader):
+        """reads the next response, returns (opcode, status, extras, key, value, cas)"""
+        while True:
+            magic, opcode, key_length, extras_length, _, status, body_length, _, cas = HEADER.unpack(reader.read_bytes(HEADER_SIZE))
+            if magic != MAGIC_RESPONSE:
+                raise MemcacheError("invalid response magic: %d" % magic)
+            if body_length:
+                body = reader.read_bytes(body_length)
+            else:
+                body = ''
+            if opcode in QUIET_OPCODES:
+                #error response of an earlier quiet command, nobody is waiting for it
+                self.log.warn("quiet command 0x%02x failed, status: 0x%02x, %s", opcode, status, body[extras_length + key_length:])
+                continue
+            n = extras_length + key_length
+            return opcode, status, body[:extras_length], body[extras_length:n], body[n:], cas
+
+    def _error(self, status, value):
+        if status == STATUS_UNKNOWN_COMMAND:
+            return MemcacheResult.ERROR
+        elif status in (STATUS_INVALID_ARGUMENTS, STATUS_NON_NUMERIC):
+            return MemcacheResult("CLIENT_ERROR", value)
+        elif status in (STATUS_VALUE_TOO_LARGE, STATUS_OUT_OF_MEMORY):
+            return MemcacheResult("SERVER_ERROR", value)
+        else:
+            raise MemcacheError("unknown response status: 0x%02x" % status)
+
+    def write_version(self, writer):
+        self._write_command(writer, OP_VERSION)
+
+    def read_version(self, reader):
+        _, status, _, _, value, _ = self._read_response(reader)
+        if status == STATUS_NO_ERROR:
+            return MemcacheResult.OK, value
+        else:
+            return self._error(status, value), None
+
+    def _write_storage(self, writer, opcode, key, value, expiration, flags, cas_unique = 0, noreply = False):
+        encoded_value, flags = self._codec.encode(value, flags)
+        if noreply:
+            opcode = QUIET[opcode]
+        self._write_command(writer, opcode, key, STORAGE_EXTRAS.pack(flags, expiration), encoded_value, cas_unique)
+
+    def _read_storage(self, reader, cas = False):
+        _, status, _, _, value, _ = self._read_response(reader)
+        if status == STATUS_NO_ERROR:
+            return MemcacheResult.STORED, None
+        elif status == STATUS_KEY_NOT_FOUND:
+            #text protocol answers NOT_STORED for replace/append/prepend of a missing key
+            return (MemcacheResult.NOT_FOUND if cas else MemcacheResult.NOT_STORED), None
+        elif status == STATUS_KEY_EXISTS:
+            return (MemcacheResult.EXISTS if cas else MemcacheResult.NOT_STORED), None
+        elif status == STATUS_ITEM_NOT_STORED:
+            return MemcacheResult.NOT_STORED, None
+        else:
+            return self._error(status, value), None
+
+    def write_cas(self, writer, key, value, expiration, flags, cas_unique):
+        self._write_storage(writer, OP_SET, key, value, expiration, flags, cas_unique)
+
+    def read_cas(self, reader):
+        return self._read_storage(reader, True)
+
+    def _write_incdec(self, writer, opcode, key, value):
+        self._write_command(writer, opcode, key, INCDEC_EXTRAS.pack(int(value), 0, NO_CREATE))
+
+    def _read_incdec(self, reader):
+        _, status, _, _, value, _ = self._read_response(reader)
+        if status == STATUS_NO_ERROR:
+            return MemcacheResult.OK, COUNTER.unpack(value)[0]
+        elif status == STATUS_KEY_NOT_FOUND:
+            return MemcacheResult.NOT_FOUND, None
+        else:
+            return self._error(status, value), None
+
+    def write_incr(self, writer, key, value):
+        self._write_incdec(writer, OP_INCREMENT, key, value)
+
+    def read_incr(self, reader):
+        return self._read_incdec(reader)
+
+    def write_decr(self, writer, key, value):
+        self._write_incdec(writer, OP_DECREMENT, key, value)
+
+    def read_decr(self, reader):
+        return self._read_incdec(reader)
+
+    def write_get(self, writer, keys):
+        #misses are not answered, the noop marks the end of the results
+        for key in keys:
+            self._write_command(writer, OP_GETKQ, key)
+        self._write_command(writer, OP_NOOP)
+
+    def write_gets(self, writer, keys):
+        self.write_get(writer, keys)
+
+    def read_get(self, reader, with_cas_unique = False, with_size = False):
+        result = {}
+        error = None
+        while True:
+            opcode, status, extras, key, value, cas = self._read_response(reader)
+            if opcode == OP_NOOP:
+                if error is None:
+                    return MemcacheResult.OK, result
+                else:
+                    return error, {}
+            elif status == STATUS_NO_ERROR:
+                if with_size:
+                    value = (self._codec.decode(FLAGS.unpack(extras)[0], value), len(value))
+                else:
+                    value = self._codec.decode(FLAGS.unpack(extras)[0], value)
+                if with_cas_unique:
+                    result[key] = (value, cas)
+                else:
+                    result[key] = value
+            elif status != STATUS_KEY_NOT_FOUND:
+                error = self._error(status, value)
+
+    def read_gets(self, reader):
+        return self.read_get(reader, with_cas_unique = True)
+
+    def write_get_sized(self, writer, keys):
+        self.write_get(writer, keys)
+
+    def read_get_sized(self, reader):
+        return self.read_get(reader, with_size = True)
+
+    def write_delete(self, writer, key, expiration, noreply = False):
+        #memcached only accepts a delete without expiration
+        if expiration:
+            extras = EXPIRATION.pack(expiration)
+        else:
+            extras = ''
+        self._write_command(writer, OP_DELETEQ if noreply else OP_DELETE, key, extras)
+
+    def read_delete(self, reader):
+        _, status, _, _, value, _ = self._read_response(reader)
+        if status == STATUS_NO_ERROR:
+            return MemcacheResult.DELETED, None
+        elif status == STATUS_KEY_NOT_FOUND:
+            return MemcacheResult.NOT_FOUND, None
+        else:
+            return self._error(status, value), None
+
+    def write_set(self, writer, key, value, expiration, flags, noreply = False):
+        self._write_storage(writer, OP_SET, key, value, expiration, flags, noreply = noreply)
+
+    def read_set(self, reader):
+        return self._read_storage(reader)
+
+    def write_add(self, writer, key, value, expiration, flags, noreply = False):
+        self._write_storage(writer, OP_ADD, key, value, expiration, flags, noreply = noreply)
+
+    def read_add(self, reader):
+        return self._read_storage(reader)
+
+    def write_replace(self, writer, key, value, expiration, flags, noreply = False):
+        self._write_storage(writer, OP_REPLACE, key, value, expiration, flags, noreply = noreply)
+
+    def read_replace(self, reader):
+        return self._read_storage(reader)
+
+    def _write_concat(self, writer, opcode, key, value, noreply):
+        #append/prepend have no extras
+        encoded_value, _ = self._codec.encode(value, 0)
+        self._write_command(writer, QUIET[opcode] if noreply else opcode, key, '', encoded_value)
+
+    def write_append(self, writer, key, value, expiration, flags, noreply = False):
+        self._write_concat(writer, OP_APPEND, key, value, noreply)
+
+    def read_append(self, reader):
+        return self._read_storage(reader)
+
+    def write_prepend(self, writer, key, value, expiration, flags, noreply = False):
+        self._write_concat(writer, OP_PREPEND, key, value, noreply)
+
+    def read_prepend(self, reader):
+        return self._read_storage(reader)
@@ -7,6 +7,7 @@ import logging
 import httplib
 import os
 import mimetypes
+import rfc822
 
 class WSGISimpleResponse(object):
     def __init__(self, status_code = httplib.OK, response = None, content_type = 'text/html', headers = []):
@@ -31,10 +32,18 @@ class WSGISimpleMessage(WSGISimpleResponse):
         WSGISimpleResponse.__init__(self, httplib.OK, msg)
 
 class WSGISimpleStatic(WSGISimpleResponse):
+    """Serves the static files found under *root* at the url *prefix*.
+    By default the contents of all files are loaded into memory at startup. If *preload* is False, only an index of
+    the file metadata (size, modification time, content type and etag) is kept, and the file contents are sent
+    using the servers wsgi.file_wrapper (e.g. using sendfile(2) by the concurrence WSGIServer).
+    Files are assumed not to change while being served."""
     log = logging.getLogger('WSGISimpleStatic')
 
-    def __init__(self, root, prefix):
+    BLOCK_SIZE = 1024 * 16
+
+    def __init__(self, root, prefix, preload = True):
         self._map = {}
+        self._preload = preload
         self._load(root)
         self._root = root
         self._prefix = prefix
@@ -51,28 +60,54 @@ class WSGISimpleStatic(WSGISimpleResponse):
             assert False, "unknown path type (not a file or dir)"
 
     def _load_file(self, root, path):
-        f = open(path)
-        content = f.read()
-        f.close()
         content_type, _ = mimetypes.guess_type(path, False)
         if content_type is None:
             content_type = 'binary/octet-stream'
             self.log.debug("unknown content type for path %s", path)
 
-        content_length = len(content)
-        path = path[len(root):]
-        self.log.debug("preloading %s => %d, %s", path, content_length, content_type)
-        self._map[path] = (content, content_type, content_length)
+        if self._preload:
+            f = open(path)
+            content = f.read()
+            f.close()
+            content_length = len(content)
+            self.log.debug("preloading %s => %d, %s", path[len(root):], content_length, content_type)
+            self._map[path[len(root):]] = (content, content_type, content_length)
+        else:
+            st = os.stat(path)
+            headers = [('Content-Type', content_type),
+                       ('Content-Length', str(st.st_size)),
+                       ('Last-Modified', rfc822.formatdate(st.st_mtime)),
+                       ('ETag', '"%x-%x"' % (int(st.st_mtime), st.st_size))]
+            self.log.debug("indexing %s => %d, %s", path[len(root):], st.st_size, content_type)
+            self._map[path[len(root):]] = (path, headers)
+
+    def _read_file(self, f):
+        try:
+            while True:
+                block = f.read(self.BLOCK_SIZE)
+                if not block: break
+                yield block
+        finally:
+            f.close()
 
     def __call__(self, environ, start_response):
         path_info = environ['PATH_INFO'][len(self._prefix):]
-        if path_info in self._map:
-            content, content_length, content_type = self._map[path_info]
-            response_line = "%d %s" % (200, httplib.responses[200])
-            start_response(response_line, [('Content-Type', content_type), ('Content-Length', content_length)])
+        if path_info not in self._map:
+            return self._not_found(environ, start_response)
+        response_line = "%d %s" % (200, httplib.responses[200])
+        if self._preload:
+            content, content_type, content_length = self._map[path_info]
+            start_response(response_line, [('Content-Type', content_type), ('Content-Length', str(content_length))])
             return [content]
         else:
-            return self._not_found(environ, start_response)
+            path, headers = self._map[path_info]
+            f = open(path, 'rb')
+            start_response(response_line, headers[:])
+            file_wrapper = environ.get('wsgi.file_wrapper', None)
+            if file_wrapper is not None:
+                return file_wrapper(f, self.BLOCK_SIZE)
+            else:
+                return self._read_file(f)
 
 class WSGISimpleRouter(object):
     """a simple router middleware to dispatch to applications based on uri-path"""
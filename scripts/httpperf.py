@@ -33,11 +33,13 @@ class HttpPerf(object):
         self.lastTime = None
         self.options = options
         self.dispenser = Channel()
+        self.latencies = []
         
-    def session_response_reader(self, cnn, pipeline_tokens):
+    def session_response_reader(self, cnn, pipeline_tokens, sent_times):
         #TODO use tasklet.loop, must be extended such that you can stop the loop by returning something (or StopIteration?)
         while True:
             response = cnn.receive()
+            self.latencies.append(time.time() - sent_times.popleft())
 
             #read status
             self.count('status', response.status)
@@ -65,6 +67,7 @@ class HttpPerf(object):
         cnn = None
 
         pipeline_tokens = Deque()
+        sent_times = Deque()
 
         for _ in range(self.options.pipeline): # can append take iterator?, or list?
             pipeline_tokens.append(True)
@@ -73,7 +76,7 @@ class HttpPerf(object):
             cnn = HTTPConnection()
             cnn.connect((host, port))
 
-            Tasklet.new(self.session_response_reader)(cnn, pipeline_tokens)
+            Tasklet.new(self.session_response_reader)(cnn, pipeline_tokens, sent_times)
             
             requests = 0 #no requests in this session
             while True:
@@ -87,6 +90,7 @@ class HttpPerf(object):
                 pipeline_tokens.popleft(True)
 
                 #do the request
+                sent_times.append(time.time())
                 cnn.send(cnn.get(path))
                 #print response
                   
@@ -153,6 +157,13 @@ class HttpPerf(object):
         self.lastRequest = self.request
         self.lastReqSec = reqSec
         
+    def show_latencies(self):
+        if not self.latencies: return
+        latencies = sorted(self.latencies)
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))] * 1000.0
+        print >> sys.stderr, "latency ms: p50 %.2f, p90 %.2f, p99 %.2f, max %.2f" % (percentile(50), percentile(90), percentile(99), latencies[-1] * 1000.0)
+
     def dispense(self):
         if self.options.count == -1: 
             #run forever
@@ -178,6 +189,8 @@ class HttpPerf(object):
         
         #start up sessions, and wait till they are finished
         Tasklet.join_all([Tasklet.new(self.sessions)() for _ in range(self.options.sessions)])
+
+        self.show_latencies()
         
         quit()
            
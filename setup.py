@@ -31,9 +31,13 @@ setup(
   ext_modules=[
     Extension("concurrence._event", ["lib/concurrence/concurrence._event.pyx"], include_dirs = libevent_include_dirs, library_dirs = libevent_library_dirs, libraries = ["event"]),
     Extension("concurrence.io._io", ["lib/concurrence/io/concurrence.io._io.pyx", "lib/concurrence/io/io_base.c"]),
+    Extension("concurrence.http._http", ["lib/concurrence/http/concurrence.http._http.pyx"],
+              include_dirs=['lib/concurrence/io']
+              ),
     Extension("concurrence.database.mysql._mysql", ["lib/concurrence/database/mysql/concurrence.database.mysql._mysql.pyx"], 
               include_dirs=['lib/concurrence/io']
               ),
+    Extension("concurrence.memcache._ketama", ["lib/concurrence/memcache/concurrence.memcache._ketama.pyx", "lib/concurrence/memcache/md5.c"]),
     ],
   cmdclass = {'build_ext': build_ext},
     classifiers = [
@@ -0,0 +1,83 @@
+import os
+import sys
+import signal
+import subprocess
+
+from concurrence import unittest, Tasklet
+from concurrence.core import EXIT_CODE_SIGINT
+from concurrence.io import Socket, Buffer
+from concurrence.io.balancer import Balancer
+
+SERVER_PORT = 8084
+WORKERS = 2
+
+def handler(socket):
+    #sends the pid of the backend, then keeps the connection open until the client closes it
+    buffer = Buffer(64)
+    buffer.write_bytes('%d\n' % os.getpid())
+    buffer.flip()
+    socket.write(buffer)
+    while True:
+        buffer.clear()
+        if socket.read(buffer) == 0:
+            break
+
+class TestBalancer(unittest.TestCase):
+    def setUp(self):
+        self.process = subprocess.Popen([sys.executable, __file__, 'serve'])
+        Tasklet.sleep(1.0)
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def _connect(self):
+        socket = Socket.connect(('localhost', SERVER_PORT))
+        buffer = Buffer(64)
+        while True:
+            if socket.read(buffer) == 0:
+                raise EOFError()
+            buffer.flip()
+            try:
+                return socket, int(buffer.read_line())
+            except:
+                buffer.position = buffer.limit
+
+    def testBalancer(self):
+        connections = [self._connect() for i in range(10)]
+        pids = [pid for _, pid in connections]
+        self.assertEquals(WORKERS, len(set(pids)))
+        self.assertFalse(self.process.pid in pids)
+        #least connections balancing spreads the long lived connections evenly
+        for pid in set(pids):
+            self.assertEquals(10 / WORKERS, pids.count(pid))
+
+        #close some connections of one backend, new connections should go there
+        pid = pids[0]
+        closed = [socket for socket, p in connections if p == pid][:3]
+        for socket in closed:
+            socket.close()
+        Tasklet.sleep(0.5)
+        more = [self._connect() for i in range(3)]
+        self.assertEquals([pid] * 3, [p for _, p in more])
+
+        #stopping the front stops the backends
+        os.kill(self.process.pid, signal.SIGINT)
+        for i in range(50):
+            if self.process.poll() is not None:
+                break
+            Tasklet.sleep(0.1)
+        self.assertEquals(EXIT_CODE_SIGINT, self.process.poll())
+        for socket, p in connections + more:
+            if socket not in closed:
+                socket.close()
+        Tasklet.sleep(0.5)
+        for p in set(pids):
+            self.assertRaises(OSError, os.kill, p, 0)
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['serve']:
+        Balancer(('localhost', SERVER_PORT), handler, workers = WORKERS).run()
+    else:
+        unittest.main(timeout = 60.0)
@@ -1,5 +1,5 @@
 from concurrence import unittest
-from concurrence.io.buffered import Buffer, BufferUnderflowError, BufferInvalidArgumentError
+from concurrence.io.buffered import Buffer, BufferPool, BufferUnderflowError, BufferInvalidArgumentError
 
 class TestBuffer(unittest.TestCase):
     def testDuplicate(self):
@@ -279,23 +279,165 @@ class TestBuffer(unittest.TestCase):
         self.assertEquals(2, c[20])
         self.assertEquals(3, c[1023])
 
-
-
-
-
-
+    def testReadView(self):
+        b = Buffer(16)
+        b.write_bytes('hello world!')
+        b.flip()
+        view = b.read_view(5)
+        self.assertEquals(5, b.position)
+        self.assertEquals(0, view.position)
+        self.assertEquals(5, view.limit)
+        self.assertEquals('hello', memoryview(view).tobytes())
+        view = b.read_view()
+        self.assertEquals(12, b.position)
+        self.assertEquals(' world!', str(buffer(view)))
+        self.assertEquals(' world!', memoryview(view).tobytes())
+        #view references the bytes of the buffer
+        b[6] = ord('W')
+        self.assertEquals(' World!', view.read_bytes(-1))
+        try:
+            b.read_view(1)
+            self.fail("expected BufferUnderflowError")
+        except BufferUnderflowError:
+            pass
+        #view keeps the memory alive
+        b.clear()
+        b.write_bytes('alive')
+        b.flip()
+        view = b.read_view()
+        del b
+        self.assertEquals('alive', memoryview(view).tobytes())
+
+    def testReadViewPerformance(self):
+        N = 100000
+        for size in [64, 4096]:
+            b = Buffer(size)
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    b.position = 0
+                    b.read_bytes(size)
+            print 'read_bytes(%d) /sec' % size, tmr.sec(N)
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    b.position = 0
+                    b.read_view(size)
+            print 'read_view(%d) /sec' % size, tmr.sec(N)
+
+class TestBufferPool(unittest.TestCase):
+    def testGetRelease(self):
+        pool = BufferPool(sizes = (1024, 8192))
+        b = pool.get(1000)
+        self.assertEquals(1024, b.capacity)
+        self.assertEquals(0, b.position)
+        self.assertEquals(1024, b.limit)
+        b.write_bytes('hello')
+        self.assertEquals(8192, pool.get(1025).capacity)
+        #larger than largest size class, not pooled
+        self.assertEquals(10000, pool.get(10000).capacity)
+        pool.release(b)
+        #buffers not from this pool are ignored
+        pool.release(Buffer(1024))
+        pool.release(b.duplicate())
+        self.assertEquals(1024, pool.statistics()['free_bytes'])
+        #released buffer is handed out again, cleared
+        c = pool.get(1024)
+        self.assertTrue(b is c)
+        self.assertEquals(0, c.position)
+        self.assertEquals(1024, c.limit)
+        self.assertEquals('hello', c.read_bytes(5))
+        stats = pool.statistics()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(2, stats['misses'])
+        self.assertEquals(1, stats['overflows'])
+        self.assertEquals(0, stats['free_bytes'])
+
+    def testSlabs(self):
+        pool = BufferPool(sizes = (1024,))
+        buffers = [pool.get(1024) for i in range(100)]
+        #buffers are carved from 64K slabs
+        self.assertEquals(2 * 65536, pool.statistics()['bytes'])
+        #buffers do not overlap
+        for i, b in enumerate(buffers):
+            b.write_int(i)
+        for i, b in enumerate(buffers):
+            self.assertEquals(i, b[0])
+        #slab memory is freed once all of its buffers are gone
+        del b
+        del buffers[:64]
+        self.assertEquals(65536, pool.statistics()['bytes'])
+        del buffers
+        #except for the slab that the pool is still carving buffers from
+        self.assertEquals(65536, pool.statistics()['bytes'])
+
+    def testCapAndTrim(self):
+        pool = BufferPool(max_bytes = 4 * 65536, sizes = (65536,))
+        buffers = [pool.get(65536) for i in range(4)]
+        #pool is full, so an unpooled buffer is returned
+        b = pool.get(65536)
+        self.assertEquals(1, pool.statistics()['overflows'])
+        pool.release(b)
+        self.assertEquals(0, pool.statistics()['free_bytes'])
+        #released buffers are trimmed least recently released first when room is needed
+        for b in buffers:
+            pool.release(b)
+        del b
+        self.assertEquals(4 * 65536, pool.statistics()['free_bytes'])
+        first = buffers[0]
+        del buffers
+        self.assertEquals(65536, pool.trim(1))
+        self.assertEquals(3 * 65536, pool.statistics()['free_bytes'])
+        #first one is still referenced by us
+        self.assertEquals(4 * 65536, pool.statistics()['bytes'])
+        del first
+        self.assertEquals(3 * 65536, pool.statistics()['bytes'])
+        self.assertEquals(3 * 65536, pool.trim())
+        stats = pool.statistics()
+        self.assertEquals(0, stats['bytes'])
+        self.assertEquals(4 * 65536, stats['trimmed'])
+
+    def testTrimPartialSlabs(self):
+        #4 buffers of 16K per 64K slab
+        pool = BufferPool(max_bytes = 128 * 1024, sizes = (1024, 16384))
+        buffers = [pool.get(16384) for i in range(8)]
+        self.assertEquals(128 * 1024, pool.statistics()['bytes'])
+        #release every other buffer, no slab is completely free
+        for b in buffers[::2]:
+            pool.release(b)
+        del b
+        in_use = buffers[1::2]
+        del buffers
+        #pool is full, nothing can be trimmed, the released buffers are kept for reuse
+        self.assertEquals(1024, pool.get(1024).capacity)
+        stats = pool.statistics()
+        self.assertEquals(0, stats['trimmed'])
+        self.assertEquals(128 * 1024, stats['bytes'])
+        self.assertEquals(1, stats['overflows'])
+        self.assertEquals(4 * 16384, stats['free_bytes'])
+        in_use.append(pool.get(16384))
+        self.assertEquals(1, pool.statistics()['hits'])
+        #once all buffers of a slab are released it is freed by trimming
+        for b in in_use:
+            pool.release(b)
+        del b
+        del in_use
+        self.assertEquals(65536, pool.trim(1))
+        self.assertEquals(65536, pool.statistics()['bytes'])
+        pool.trim()
+        self.assertEquals(0, pool.statistics()['bytes'])
+        self.assertEquals(0, pool.statistics()['free_bytes'])
+
+    def testPerformance(self):
+        N = 100000
+        for size in [1024, 16384]:
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    b = Buffer(size)
+            print 'Buffer(%d) /sec' % size, tmr.sec(N)
+            pool = BufferPool()
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    pool.release(pool.get(size))
+            print 'BufferPool.get/release(%d) /sec' % size, tmr.sec(N)
 
 if __name__ == '__main__':
     unittest.main(timeout = 10)
-
-
-
-
-
-
-
-
-
-
-
-
@@ -1,6 +1,8 @@
-from concurrence import unittest
-from concurrence.io import IOStream
-from concurrence.io.buffered import Buffer, BufferedReader
+import _socket
+
+from concurrence import unittest, Tasklet
+from concurrence.io import IOStream, Socket
+from concurrence.io.buffered import Buffer, BufferPool, BufferOverflowError, BufferedReader, BufferedWriter, BufferedStream
 
 class TestStream(IOStream):
     def __init__(self, s, chunk_size = 4):
@@ -20,7 +22,331 @@ class TestStream(IOStream):
 
         return n
 
+class TestWriteStream(IOStream):
+    def __init__(self):
+        self.parts = []
+
+    def write(self, buffer, timeout = -1.0):
+        s = buffer.read_bytes(-1)
+        self.parts.append(s)
+        return len(s)
+
+    def writev(self, parts, timeout = -1.0):
+        self.parts.extend([p if type(p) == str else p.read_bytes(-1) for p in parts])
+        return len(self.data())
+
+    def data(self):
+        return ''.join(self.parts)
+
 class TestBuffered(unittest.TestCase):
+    def testWriterQueuesByReference(self):
+        stream = TestWriteStream()
+        writer = BufferedWriter(stream, Buffer(16))
+        large1 = 'a' * 100
+        large2 = 'b' * 100
+        writer.write_bytes('head')
+        writer.write_bytes(large1)
+        writer.write_bytes('mid')
+        writer.write_byte(ord('!'))
+        writer.write_bytes(large2)
+        writer.write_bytes('tail')
+        self.assertTrue(writer.pending)
+        writer.flush()
+        self.assertFalse(writer.pending)
+        #large strings are passed to writev by reference and are not copied
+        self.assertTrue(large1 is stream.parts[1])
+        self.assertTrue(large2 is stream.parts[3])
+        self.assertEquals('head' + large1 + 'mid!' + large2 + 'tail', stream.data())
+
+        #normal flush after that
+        stream.parts = []
+        writer.write_bytes('hello')
+        writer.flush()
+        self.assertEquals(['hello'], stream.parts)
+
+
+    def testStreamReleasesIdleBuffers(self):
+        a, b = _socket.socketpair()
+        a = BufferedStream(Socket(a, Socket.STATE_CONNECTED))
+        b = BufferedStream(Socket(b, Socket.STATE_CONNECTED))
+        default_pool = BufferedStream.buffer_pool
+        pool = BufferedStream.buffer_pool = BufferPool()
+        try:
+            b.writer.write_bytes('hello\n')
+            b.writer.flush()
+            self.assertEquals('hello', a.reader.read_line())
+            b.writer.write_bytes('more\n')
+            b.writer.flush()
+            a.writer.write_bytes('world\n')
+            #unflushed data, writer buffer is kept
+            a.wait_readable()
+            self.assertEquals(8192, pool.statistics()['free_bytes'])
+            self.assertEquals('more', a.reader.read_line())
+            a.writer.flush()
+            self.assertEquals('world', b.reader.read_line())
+            def later():
+                Tasklet.sleep(0.1)
+                b.writer.write_bytes('again\n')
+                b.writer.flush()
+            Tasklet.new(later)()
+            #now both buffers are given back while waiting
+            a.wait_readable()
+            self.assertEquals(2 * 8192, pool.statistics()['free_bytes'])
+            self.assertEquals('again', a.reader.read_line())
+            self.assertEquals(2, pool.statistics()['hits'])
+        finally:
+            BufferedStream.buffer_pool = default_pool
+            a.close()
+            b.close()
+
+    def testStreamKeepsViewedBuffer(self):
+        a, b = _socket.socketpair()
+        a = BufferedStream(Socket(a, Socket.STATE_CONNECTED))
+        b = BufferedStream(Socket(b, Socket.STATE_CONNECTED))
+        default_pool = BufferedStream.buffer_pool
+        pool = BufferedStream.buffer_pool = BufferPool()
+        try:
+            b.writer.write_bytes('hello')
+            b.writer.flush()
+            view = a.reader.read_view(5)
+            self.assertTrue(a.reader.buffer.shared)
+            def later():
+                Tasklet.sleep(0.1)
+                #would reuse the read buffer of a if it was given back to the pool
+                other = pool.get(8192)
+                other.clear()
+                other.write_bytes('xxxxxxxxxx')
+                b.writer.write_bytes('world')
+                b.writer.flush()
+            Tasklet.new(later)()
+            #view is alive, so the read buffer is not given back while waiting
+            a.wait_readable()
+            self.assertEquals(0, pool.statistics()['free_bytes'])
+            self.assertEquals('hello', view.read_bytes())
+            del view
+            self.assertFalse(a.reader.buffer.shared)
+            self.assertEquals('world', a.reader.read_bytes(5))
+        finally:
+            BufferedStream.buffer_pool = default_pool
+            a.close()
+            b.close()
+
+    def testReadLongLine(self):
+        for chunk_size in [1, 3, 16, 64]:
+            line = 'x' * 99 + 'y'
+            reader = BufferedReader(TestStream('short\n' + line + '\r\n' + line + '\n' + 'after\r\n', chunk_size = chunk_size), Buffer(16))
+            self.assertEquals('short', reader.read_line())
+            self.assertEquals(line, reader.read_line())
+            self.assertEquals(line + '\n', reader.read_line(True))
+            self.assertEquals('after', reader.read_line())
+
+        #\r at the end of one segment, \n at the start of the next
+        reader = BufferedReader(TestStream('a' * 31 + '\r\nb\n', chunk_size = 16), Buffer(16))
+        self.assertEquals('a' * 31, reader.read_line())
+        self.assertEquals('b', reader.read_line())
+
+        reader = BufferedReader(TestStream('z' * 100 + '\n', chunk_size = 16), Buffer(16), max_line_length = 64)
+        try:
+            reader.read_line()
+            self.fail("expected BufferOverflowError")
+        except BufferOverflowError:
+            pass
+
+    def testReadBytes(self):
+        for buffer_size in [4, 16, 1024]:
+            for chunk_size in [1, 3, 16]:
+                s = ''.join([chr(i % 256) for i in range(300)])
+                reader = BufferedReader(TestStream(s + 'tail\n', chunk_size = chunk_size), Buffer(buffer_size))
+                self.assertEquals(s[:2], reader.read_bytes(2))
+                self.assertEquals(s[2:200], reader.read_bytes(198))
+                self.assertEquals(s[200:], reader.read_bytes(100))
+                self.assertEquals('tail', reader.read_line())
+
+    def testIntShort(self):
+        stream = TestWriteStream()
+        writer = BufferedWriter(stream, Buffer(7))
+        for i in range(10):
+            writer.write_int(0x01020304 + i)
+            writer.write_short(0xfffe - i)
+            writer.write_byte(i)
+        writer.flush()
+        for chunk_size in [1, 3, 16]:
+            reader = BufferedReader(TestStream(stream.data(), chunk_size = chunk_size), Buffer(8))
+            for i in range(10):
+                self.assertEquals(0x01020304 + i, reader.read_int())
+                self.assertEquals(0xfffe - i, reader.read_short())
+                self.assertEquals(chr(i), reader.read_bytes(1))
+
+    def testForwardViews(self):
+        for chunk_size in [3, 16, 64]:
+            s = ''.join([chr(i % 256) for i in range(300)])
+            reader = BufferedReader(TestStream(s, chunk_size = chunk_size), Buffer(64))
+            stream = TestWriteStream()
+            writer = BufferedWriter(stream, Buffer(32))
+            writer.write_buffer(reader.read_view(10))
+            writer.write_buffer(reader.read_view(40))
+            writer.flush()
+            #does not fit the reader's buffer, read into its own buffer
+            view = reader.read_view(250)
+            self.assertEquals(250, view.remaining)
+            writer.write_buffer(view)
+            writer.flush()
+            self.assertEquals(s, stream.data())
+
+    def testDeferredFlush(self):
+        a, b = _socket.socketpair()
+        a = BufferedStream(Socket(a, Socket.STATE_CONNECTED), defer_flush = True)
+        b = Socket(b, Socket.STATE_CONNECTED)
+        try:
+            def write(s):
+                a.writer.write_bytes(s)
+                a.writer.flush()
+            for s in ['one', 'two', 'three']:
+                Tasklet.new(write)(s)
+            write('four')
+            #nothing is written until all tasks are blocked, then all flushes are written together
+            self.assertTrue(a.writer.pending)
+            self.assertTrue(a.writer.deferred)
+            buffer = Buffer(1024)
+            b.read(buffer)
+            buffer.flip()
+            self.assertEquals('fouronetwothree', buffer.read_bytes(-1))
+            self.assertFalse(a.writer.pending)
+            self.assertFalse(a.writer.deferred)
+            #close does a final flush
+            a.writer.write_bytes('last')
+            a.writer.flush()
+            a.close()
+            buffer.clear()
+            b.read(buffer)
+            buffer.flip()
+            self.assertEquals('last', buffer.read_bytes(-1))
+        finally:
+            b.close()
+
+    def testDeferredFlushPartial(self):
+        a, b = _socket.socketpair()
+        a = BufferedStream(Socket(a, Socket.STATE_CONNECTED), defer_flush = True)
+        b = BufferedStream(Socket(b, Socket.STATE_CONNECTED))
+        try:
+            #much more than fits in the socket send buffer
+            parts = [chr(ord('a') + i) * (1024 * 256 + i) for i in range(8)]
+            for part in parts:
+                a.writer.write_bytes(part[:10])
+                a.writer.write_bytes(part[10:])
+                a.writer.flush()
+                Tasklet.sleep(0.01) #let the dispatcher write what it can
+            self.assertTrue(a.writer.deferred)
+            for part in parts:
+                self.assertEquals(part, b.reader.read_bytes(len(part)))
+            #the rest was written when the socket became writable again
+            self.assertFalse(a.writer.pending)
+        finally:
+            a.close()
+            b.close()
+
+    def testDeferredFlushForced(self):
+        #a forced flush that blocks takes over the deferred flush, the dispatcher must not write the same data again
+        a, b = _socket.socketpair()
+        a.setsockopt(_socket.SOL_SOCKET, _socket.SO_SNDBUF, 1024)
+        a = BufferedStream(Socket(a, Socket.STATE_CONNECTED), defer_flush = True)
+        b = BufferedStream(Socket(b, Socket.STATE_CONNECTED))
+        received = []
+        def drain():
+            try:
+                while True:
+                    received.append(b.reader.read_bytes_available())
+            except EOFError:
+                pass
+        try:
+            Tasklet.new(drain)()
+            a.writer.write_bytes('a' * 100)
+            a.writer.flush()
+            a.writer.write_bytes('b' * 8000)
+            a.writer.flush(True)
+            self.assertFalse(a.writer.deferred)
+            a.close()
+            Tasklet.sleep(0.1)
+            data = ''.join(received)
+            self.assertEquals(8100, len(data))
+            self.assertEquals('a' * 100 + 'b' * 8000, data)
+        finally:
+            b.close()
+
+    def testDeferredFlushNoFd(self):
+        #a stream without fd can not be flushed by the dispatcher, so it is flushed right away
+        stream = TestWriteStream()
+        writer = BufferedWriter(stream, Buffer(1024))
+        writer.defer_flush = True
+        writer.write_bytes('hello')
+        writer.flush()
+        self.assertFalse(writer.deferred)
+        self.assertEquals('hello', stream.data())
+
+    def testDeferredFlushError(self):
+        class BrokenStream(object):
+            fd = -1 #no is_closed, so its deferred flush fails
+        broken = BufferedWriter(BrokenStream(), Buffer(1024))
+        broken.defer_flush = True
+        a, b = _socket.socketpair()
+        a = BufferedStream(Socket(a, Socket.STATE_CONNECTED), defer_flush = True)
+        b = Socket(b, Socket.STATE_CONNECTED)
+        try:
+            broken.write_bytes('lost')
+            broken.flush()
+            a.writer.write_bytes('hello')
+            a.writer.flush()
+            #the writers after the failing one are still flushed
+            buffer = Buffer(1024)
+            b.read(buffer, 1.0)
+            buffer.flip()
+            self.assertEquals('hello', buffer.read_bytes(-1))
+            self.assertFalse(a.writer.deferred)
+            self.assertFalse(broken.deferred)
+            self.assertTrue(broken.pending)
+        finally:
+            a.close()
+            b.close()
+
+    def testDeferredFlushClosed(self):
+        a, b = _socket.socketpair()
+        socket = Socket(a, Socket.STATE_CONNECTED)
+        a = BufferedStream(socket, defer_flush = True)
+        b.close()
+        a.writer.write_bytes('lost')
+        a.writer.flush()
+        #the socket is closed underneath the stream, its fd is reused by a new connection
+        socket.close()
+        c, d = _socket.socketpair()
+        try:
+            Tasklet.sleep(0.1)
+            self.assertFalse(a.writer.deferred)
+            self.assertFalse(a.writer.pending)
+            d.setblocking(0)
+            try:
+                d.recv(1024)
+                self.fail('expected nothing to be written to the new connection')
+            except _socket.error:
+                pass
+        finally:
+            c.close()
+            d.close()
+
+        #the final flush fails, close still takes the writer out of the dispatcher's list
+        a, b = _socket.socketpair()
+        a = BufferedStream(Socket(a, Socket.STATE_CONNECTED), defer_flush = True)
+        b.close()
+        a.writer.write_bytes('lost')
+        a.writer.flush()
+        writer = a.writer
+        try:
+            a.close()
+            self.fail('expected write error')
+        except IOError:
+            pass
+        self.assertFalse(writer.deferred)
+        Tasklet.sleep(0.1)
+
     def testCompatibleReadLines(self):
         
         for chunk_size in [4, 8, 16, 32, 64, 128]:
@@ -82,7 +408,95 @@ class TestBuffered(unittest.TestCase):
                     self.assertEquals(i.read(), f.read())
 
     
+class RepeatStream(IOStream):
+    """endless stream repeating *s*, and discarding what is written to it"""
+    def __init__(self, s, size):
+        self.data = s * (size / len(s) + 1)
+
+    def read(self, buffer, timeout = -1.0):
+        n = buffer.remaining
+        buffer.write_bytes(self.data[:n])
+        return n
+
+    def write(self, buffer, timeout = -1.0):
+        n = buffer.remaining
+        buffer.position = buffer.limit
+        return n
+
+    def writev(self, parts, timeout = -1.0):
+        return sum([len(p) if type(p) == str else p.remaining for p in parts])
+
+class TestBufferedPerformance(unittest.TestCase):
+    N = 1000000
+    SIZE = 1024 * 8
+
+    def reader(self, s):
+        return BufferedReader(RepeatStream(s, self.SIZE), Buffer(self.SIZE))
+
+    def writer(self):
+        return BufferedWriter(RepeatStream('x', self.SIZE), Buffer(self.SIZE))
+
+    def testReaderPerformance(self):
+        N = self.N
+        reader = self.reader('\x01\x02\x03\x04')
+        with unittest.timer() as tmr:
+            for i in xrange(N):
+                reader.read_int()
+        print 'read_int /sec', tmr.sec(N)
+        with unittest.timer() as tmr:
+            for i in xrange(N):
+                reader.read_short()
+        print 'read_short /sec', tmr.sec(N)
+        for n in [4, 64, 1024]:
+            reader = self.reader('x' * n)
+            with unittest.timer() as tmr:
+                for i in xrange(N):
+                    reader.read_bytes(n)
+            print 'read_bytes(%d) /sec' % n, tmr.sec(N)
+        for n in [16, 128]:
+            reader = self.reader('x' * (n - 2) + '\r\n')
+            with unittest.timer() as tmr:
+                for i in xrange(N):
+                    reader.read_line()
+            print 'read_line(%d) /sec' % n, tmr.sec(N)
+
+    def testWriterPerformance(self):
+        N = self.N
+        writer = self.writer()
+        R = range(100) #flush every 100 writes
+        with unittest.timer() as tmr:
+            for i in xrange(N / 100):
+                for j in R:
+                    writer.write_byte(1)
+                writer.flush()
+        print 'write_byte /sec', tmr.sec(N)
+        with unittest.timer() as tmr:
+            for i in xrange(N / 100):
+                for j in R:
+                    writer.write_short(1)
+                writer.flush()
+        print 'write_short /sec', tmr.sec(N)
+        with unittest.timer() as tmr:
+            for i in xrange(N / 100):
+                for j in R:
+                    writer.write_int(1)
+                writer.flush()
+        print 'write_int /sec', tmr.sec(N)
+        for n in [4, 64, 1024]:
+            s = 'x' * n
+            with unittest.timer() as tmr:
+                for i in xrange(N / 100):
+                    for j in R:
+                        writer.write_bytes(s)
+                    writer.flush()
+            print 'write_bytes(%d) /sec' % n, tmr.sec(N)
+        with unittest.timer() as tmr:
+            for i in xrange(N):
+                writer.write_bytes('x')
+                writer.flush()
+        print 'write_bytes(1) + flush /sec', tmr.sec(N)
+
 if __name__ == '__main__':
-    unittest.main(timeout = 10)
+    unittest.main(timeout = 60)
 
 
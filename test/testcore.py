@@ -3,7 +3,7 @@ import logging
 import time
 import sys
 
-from concurrence import unittest, Tasklet, Channel, TimeoutError, TaskletError, JoinError, Message, TIMEOUT_NEVER
+from concurrence import unittest, Tasklet, Channel, Deque, TimeoutError, TaskletError, JoinError, Message, TIMEOUT_NEVER, call_before_wait
 
 class TestTasklet(unittest.TestCase):
     def testSleep(self):
@@ -247,6 +247,19 @@ class TestTasklet(unittest.TestCase):
         #we would expect that both task alternate
         self.assertEquals([(1, 0), (2, 0), (1, 1), (2, 1), (1, 2), (2, 2), (1, 3), (2, 3), (1, 4), (2, 4)], l)
 
+    def testCallBeforeWait(self):
+        calls = []
+        def before_wait():
+            calls.append(1)
+        call_before_wait(before_wait)
+        call_before_wait(before_wait)
+        self.assertEquals([], calls) #not yet, we are still running
+        Tasklet.sleep(0.1) #blocks, so now the callbacks run
+        self.assertEquals([1, 1], calls)
+        #they are called only once
+        Tasklet.sleep(0.1)
+        self.assertEquals([1, 1], calls)
+
     def testMessageSend(self):
 
         class MSG_PONG(Message): pass
@@ -404,6 +417,43 @@ class TestChannel(unittest.TestCase):
             tl.kill()
 
 
+    def testRecvTimeoutOrder(self):
+        """timeouts must expire in deadline order, cancelled timeouts must not expire"""
+        expired = []
+        def sleeper(i, timeout):
+            try:
+                Channel().receive(timeout)
+            except TimeoutError:
+                expired.append(i)
+
+        def receiver(channel):
+            channel.receive(0.5)
+
+        for i, timeout in enumerate([0.8, 0.2, 0.6, 0.4]):
+            Tasklet.new(sleeper)(i, timeout)
+
+        test_channel = Channel()
+        r = Tasklet.new(receiver)(test_channel)
+        Tasklet.sleep(0.1)
+        test_channel.send(True) #cancels the 0.5 timeout of receiver
+
+        Tasklet.sleep(1.0)
+        self.assertEquals([1, 3, 2, 0], expired)
+        self.assertFalse(r.alive)
+
+    def testRecvTimeoutPerformance(self):
+        test_channel = Channel()
+        N = 100000
+        def sender():
+            for i in range(N):
+                test_channel.send(i)
+
+        Tasklet.new(sender)()
+        with unittest.timer() as tmr:
+            for i in range(N):
+                test_channel.receive(10.0)
+        print 'receive with timeout, receives/sec', tmr.sec(N)
+
     def testHasReceiver(self):
 
         test_channel = Channel()
@@ -0,0 +1,64 @@
+import os
+
+from concurrence import unittest, _event
+
+class TestEvent(unittest.TestCase):
+    def _trigger(self, n):
+        """creates *n* read events on the same readable pipe, they will all trigger on the next loop"""
+        r, w = os.pipe()
+        os.write(w, 'x')
+        triggered = []
+        events = [_event.event(r, _event.EV_READ, triggered.append) for i in range(n)]
+        return r, w, events, triggered
+
+    def _loop(self, events):
+        for e in events:
+            e.add()
+        _event.loop()
+
+    def _close(self, r, w, events):
+        for e in events:
+            e.delete()
+        os.close(r)
+        os.close(w)
+
+    def testDrain(self):
+        r, w, events, triggered = self._trigger(10)
+        try:
+            self._loop(events)
+            drained = _event.drain()
+            self.assertFalse(_event.has_next())
+            self.assertEquals([], _event.drain())
+            for e in events:
+                self.assertTrue(e in drained)
+            for e in drained:
+                e.data(e.flags)
+            self.assertEquals(10, triggered.count(_event.EV_READ))
+            self.assertEquals(set([r]), set([e.fd for e in events]))
+        finally:
+            self._close(r, w, events)
+
+    def testDrainPerformance(self):
+        N = 10000
+        R = 20
+        r, w, events, triggered = self._trigger(N)
+        try:
+            with unittest.timer() as tmr:
+                for i in range(R):
+                    self._loop(events)
+                    while _event.has_next():
+                        e, event_type, fd = _event.next()
+                        e.data(event_type)
+            print 'has_next/next events/sec', tmr.sec(N * R)
+
+            with unittest.timer() as tmr:
+                for i in range(R):
+                    self._loop(events)
+                    for e in _event.drain():
+                        e.data(e.flags)
+            print 'drain events/sec', tmr.sec(N * R)
+        finally:
+            self._close(r, w, events)
+
+if __name__ == '__main__':
+    unittest.main(timeout = 60.0)
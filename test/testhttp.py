@@ -1,11 +1,17 @@
-
+import os
+import random
+import shutil
+import tempfile
 import logging
 import time
 
 from concurrence import Tasklet, TimeoutError, unittest
 from concurrence.http import HTTPError, WSGIServer, HTTPConnection
-from concurrence.wsgi import WSGISimpleRouter, WSGISimpleMessage
-from concurrence.io import Buffer, Socket
+from concurrence.wsgi import WSGISimpleRouter, WSGISimpleMessage, WSGISimpleStatic
+from concurrence.io import Buffer, Socket, BufferedReader, BufferedStream, BufferUnderflowError
+from concurrence.timer import Timeout
+from concurrence.http.server import WSGIRequest
+from concurrence.http._http import parse_request
 
 SERVER_PORT = 9090
 
@@ -33,6 +39,31 @@ class TestHTTP(unittest.TestCase):
         application.map('/sleep', WSGISleeper('zzz...'))
         application.map('/post', self.saver)
 
+        def generator(environ, start_response):
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            for part in ['gen', '', 'erated', 'x' * 10000]:
+                yield part
+
+        def generator_with_length(environ, start_response):
+            start_response('200 OK', [('Content-type', 'text/plain'), ('Content-Length', '9')])
+            for part in ['gen', 'erated']:
+                yield part
+
+        def wrong_length(environ, start_response):
+            start_response('200 OK', [('Content-type', 'text/plain'), ('Content-Length', environ['QUERY_STRING'])])
+            for part in ['gen', 'erated']:
+                yield part
+
+        def parts(environ, start_response):
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            return ['pa', 'rts', 'y' * 100000]
+
+        application.map('/generator', generator)
+        application.map('/length_generator', generator_with_length)
+        application.map('/wrong_length', wrong_length)
+        application.map('/parts', parts)
+
+        self.application = application
         self.server = WSGIServer(application)
         self.socket_server = self.server.serve(('0.0.0.0', SERVER_PORT))
 
@@ -200,6 +231,243 @@ class TestHTTP(unittest.TestCase):
         finally:
             cnn.close()        
 
+    def testSerialUnreadBody(self):
+        cnn = HTTPConnection()
+        cnn.connect(('localhost', SERVER_PORT))
+        try:
+            #application does not read the body, server should skip it before reading the next request
+            for i in range(3):
+                response = cnn.perform(cnn.post('/hello/1', 'x' * 20000, host = 'testhost.nl'))
+                self.assertEquals('Hello World 1', response.body)
+            response = cnn.perform(cnn.get('/hello/2'))
+            self.assertEquals('Hello World 2', response.body)
+        finally:
+            cnn.close()
+
+    def testPipelinedOnly(self):
+        self.server.serial = False
+        cnn = HTTPConnection()
+        cnn.connect(('localhost', SERVER_PORT))
+        try:
+            for i in range(3):
+                response = cnn.perform(cnn.get('/hello/%d' % i))
+                self.assertEquals('Hello World %d' % i, response.body)
+            cnn.send(cnn.get('/hello/1'))
+            cnn.send(cnn.get('/hello/2'))
+            self.assertEquals('Hello World 1', cnn.receive().body)
+            self.assertEquals('Hello World 2', cnn.receive().body)
+        finally:
+            cnn.close()
+
+    def testLargeRequestHeader(self):
+        cnn = HTTPConnection()
+        cnn.connect(('localhost', SERVER_PORT))
+        try:
+            #header block does not fit in the read buffer of the server
+            request = cnn.post('/post', 'large', host = 'testhost.nl')
+            for i in range(10):
+                request.add_header('X-Large-%d' % i, 'x' * 1000)
+            response = cnn.perform(request)
+            self.assertEquals('ok', response.body)
+            for i in range(10):
+                self.assertEquals('x' * 1000, self.saver.environ['HTTP_X_LARGE_%d' % i])
+            self.assertEquals('large', self.saver.body)
+            #next one is normal again
+            response = cnn.perform(cnn.get('/hello/1'))
+            self.assertEquals('Hello World 1', response.body)
+        finally:
+            cnn.close()
+
+    def testLongRequestHeaderLine(self):
+        cnn = HTTPConnection()
+        cnn.connect(('localhost', SERVER_PORT))
+        try:
+            #a single header line does not fit in the read buffer of the server
+            request = cnn.post('/post', 'long', host = 'testhost.nl')
+            request.add_header('X-Long', 'y' * 20000)
+            response = cnn.perform(request)
+            self.assertEquals('ok', response.body)
+            self.assertEquals('long', self.saver.body)
+            self.assertEquals('y' * 20000, self.saver.environ['HTTP_X_LONG'])
+        finally:
+            cnn.close()
+
+    def testResponseEncoding(self):
+        cnn = HTTPConnection()
+        cnn.connect(('localhost', SERVER_PORT))
+        try:
+            #unknown length, chunked
+            response = cnn.perform(cnn.get('/generator'))
+            self.assertEquals(200, response.status_code)
+            self.assertEquals('chunked', response.get_header('Transfer-Encoding'))
+            self.assertEquals(None, response.get_header('Content-Length'))
+            self.assertEquals('generated' + 'x' * 10000, response.body)
+
+            #length given by app, not chunked
+            response = cnn.perform(cnn.get('/length_generator'))
+            self.assertEquals(200, response.status_code)
+            self.assertEquals(None, response.get_header('Transfer-Encoding'))
+            self.assertEquals('9', response.get_header('Content-Length'))
+            self.assertEquals('generated', response.body)
+
+            #list of strings, length determined by server
+            response = cnn.perform(cnn.get('/parts'))
+            self.assertEquals(None, response.get_header('Transfer-Encoding'))
+            self.assertEquals(str(100005), response.get_header('Content-Length'))
+            self.assertEquals('parts' + 'y' * 100000, response.body)
+        finally:
+            cnn.close()
+
+    def testWrongContentLength(self):
+        #the body is never longer than announced and the connection is closed, so that the client is not confused
+        for length, body in [(5, 'gener'), (20, 'generated')]:
+            for i in range(2): #serial and pipelined
+                stream = BufferedStream(Socket.connect(('localhost', SERVER_PORT)))
+                try:
+                    request = 'GET /wrong_length?%d HTTP/1.1\r\nHost: localhost\r\n\r\n' % length
+                    stream.writer.write_bytes(request * (i + 1))
+                    stream.writer.flush()
+                    data = []
+                    with Timeout.push(2.0):
+                        try:
+                            while True:
+                                data.append(stream.reader.read_bytes_available())
+                        except EOFError:
+                            pass
+                    data = ''.join(data)
+                    self.assertEquals(1, data.count('HTTP/1.1 200'))
+                    self.assertTrue(data.endswith('\r\n\r\n' + body))
+                finally:
+                    stream.close()
+
+    def testStatic(self):
+        root = tempfile.mkdtemp()
+        try:
+            files = {'/small.txt': 'hello static', '/big.bin': os.urandom(1024 * 1024 * 4)}
+            for path, content in files.items():
+                f = open(root + path, 'wb')
+                f.write(content)
+                f.close()
+
+            self.application.map('/preload', WSGISimpleStatic(root, '/preload'))
+            self.application.map('/index', WSGISimpleStatic(root, '/index', preload = False))
+
+            cnn = HTTPConnection()
+            cnn.connect(('localhost', SERVER_PORT))
+            try:
+                for prefix in ['/preload', '/index']:
+                    for path, content in files.items():
+                        response = cnn.perform(cnn.get(prefix + path))
+                        self.assertEquals(200, response.status_code)
+                        self.assertEquals(content, response.body)
+                    response = cnn.perform(cnn.get(prefix + '/small.txt'))
+                    self.assertEquals('text/plain', response.get_header('Content-Type'))
+                    self.assertEquals('hello static', response.body)
+                    self.assertEquals(404, cnn.perform(cnn.get(prefix + '/notfound')).status_code)
+                response = cnn.perform(cnn.get('/index/small.txt'))
+                self.assertEquals(None, response.get_header('Transfer-Encoding')) #sent using sendfile
+                self.assertEquals('12', response.get_header('Content-Length'))
+                self.assertTrue(response.get_header('ETag'))
+                self.assertEquals('hello static', response.body)
+            finally:
+                cnn.close()
+        finally:
+            shutil.rmtree(root)
+
+class TestRequestParser(unittest.TestCase):
+    def _buffer(self, s):
+        buffer = Buffer(len(s) + 16)
+        buffer.write_bytes(s)
+        buffer.flip()
+        return buffer
+
+    def _parse(self, s):
+        environ = {}
+        buffer = self._buffer(s)
+        result = parse_request(buffer, environ)
+        return result, environ, buffer.position
+
+    def _parse_lines(self, s):
+        request = WSGIRequest(None)
+        reader = BufferedReader(None, self._buffer(s))
+        reader.buffer.limit = len(s)
+        result = request._parse_request_lines(reader)
+        return result, request.environ, reader.buffer.position
+
+    def testParse(self):
+        request = 'GET /a/b;x?q=1&r=2#frag HTTP/1.1\r\nHost: localhost:8080\r\nContent-Type:text/plain  \r\n' \
+                  'X-Folded: first\r\n  second\r\nAccept: a\r\naccept: b\r\nReferer: http://x: y\r\n\r\nbody'
+        (method, uri, version), environ, position = self._parse('\r\n' + request)
+        self.assertEquals(('GET', '/a/b;x?q=1&r=2#frag', 'HTTP/1.1'), (method, uri, version))
+        self.assertEquals('GET', environ['REQUEST_METHOD'])
+        self.assertEquals('/a/b', environ['PATH_INFO'])
+        self.assertEquals('q=1&r=2', environ['QUERY_STRING'])
+        self.assertEquals('localhost:8080', environ['HTTP_HOST'])
+        self.assertEquals('text/plain', environ['HTTP_CONTENT_TYPE'])
+        self.assertEquals('first second', environ['HTTP_X_FOLDED'])
+        self.assertEquals('a,b', environ['HTTP_ACCEPT'])
+        self.assertEquals('http://x: y', environ['HTTP_REFERER'])
+        self.assertEquals(len(request) + 2 - len('body'), position)
+        #the python parser for large header blocks accepts the same headers
+        self.assertEquals(self._parse('\r\n' + request), self._parse_lines('\r\n' + request))
+
+        (_, uri, _), environ, _ = self._parse('GET http://host:80?x=1 HTTP/1.1\r\n\r\n')
+        self.assertEquals('', environ['PATH_INFO'])
+        self.assertEquals('x=1', environ['QUERY_STRING'])
+
+        #incomplete header block, position must not change
+        buffer = self._buffer('GET / HTTP/1.1\r\nHost: local')
+        try:
+            parse_request(buffer, {})
+            self.fail('expected underflow')
+        except BufferUnderflowError:
+            pass
+        self.assertEquals(0, buffer.position)
+
+        for invalid in ['GET\r\n\r\n', 'GET /\r\n\r\n', 'GET / HTTP/1.1\r\nHost\r\n\r\n', 'GET / HTTP/1.1\r\n folded\r\n\r\n']:
+            for parse in [self._parse, self._parse_lines]:
+                try:
+                    parse(invalid)
+                    self.fail('expected http error')
+                except HTTPError:
+                    pass
+
+    def testCompatible(self):
+        #compares results with those of the line based python parser for random requests
+        rnd = random.Random(1)
+        def token(chars, n):
+            return ''.join([rnd.choice(chars) for i in range(rnd.randint(1, n))])
+        path_chars = 'abcXYZ019-_.%~;=/?&#'
+        name_chars = 'abcdefXYZ-'
+        value_chars = 'abcXYZ019 -_.,;:=/?&#()'
+        for i in range(2000):
+            uri = '/' + token(path_chars.replace('/', ''), 1) + token(path_chars, 40) #urlparse would take //x as netloc
+            if rnd.random() < 0.1:
+                uri = 'http://' + token('abc.019:', 10) + uri
+            request = ['%s %s HTTP/1.%d' % (rnd.choice(['GET', 'POST']), uri, rnd.randint(0, 1))]
+            names = [token(name_chars, 12) for i in range(rnd.randint(0, 5))]
+            for j in range(rnd.randint(0, 10)):
+                if names and rnd.random() < 0.3:
+                    name = rnd.choice(names) #duplicate header
+                else:
+                    name = token(name_chars, 12)
+                request.append('%s%s%s' % (name, rnd.choice([': ', ':', ':  ']), token(value_chars, 30).strip()))
+            request = '\r\n'.join(request) + '\r\n\r\n' + token(value_chars, 10)
+            self.assertEquals(self._parse_lines(request), self._parse(request))
+
+    def testParsePerformance(self):
+        request = 'GET /hello/world?a=1 HTTP/1.1\r\nHost: localhost:8080\r\nUser-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n' \
+                  'Accept: text/html,application/xhtml+xml\r\nAccept-Encoding: gzip, deflate\r\nConnection: keep-alive\r\n\r\n'
+        N = 20000
+        with unittest.timer() as tmr:
+            for i in range(N):
+                self._parse_lines(request)
+        print 'python parser requests/sec', tmr.sec(N)
+        with unittest.timer() as tmr:
+            for i in range(N):
+                self._parse(request)
+        print 'c parser requests/sec', tmr.sec(N)
+
 if __name__ == '__main__':
     unittest.main(timeout = 100.0)
 
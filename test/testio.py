@@ -1,7 +1,12 @@
 
-from concurrence import unittest, dispatch, TimeoutError, Tasklet
+import _socket
+
+from concurrence import unittest, dispatch, TimeoutError, Tasklet, TaskletPool, TIMEOUT_CURRENT
 from concurrence.core import FileDescriptorEvent
-from concurrence.io import Socket
+from concurrence.timer import Timeout
+from concurrence.io import Socket, SocketServer, Buffer, IOStream, BufferedWriter
+
+SERVER_PORT = 8083
 
 
 class TestIO(unittest.TestCase):
@@ -17,5 +22,254 @@ class TestIO(unittest.TestCase):
 
         #TODO test why is socket.readable event not deallocated immediatly?
 
+    def _socket_pair(self, persistent_events):
+        a, b = _socket.socketpair()
+        return (Socket(a, Socket.STATE_CONNECTED, persistent_events),
+                Socket(b, Socket.STATE_CONNECTED, persistent_events))
+
+    def testPersistentEvents(self):
+        for persistent_events in [False, True]:
+            a, b = self._socket_pair(persistent_events)
+            buffer = Buffer(1024)
+
+            #nothing to read, must timeout, and be able to wait again afterwards
+            try:
+                a.read(buffer, 0.5)
+                self.fail('expected timeout')
+            except TimeoutError:
+                pass
+
+            def writer():
+                Tasklet.sleep(0.5)
+                buffer = Buffer(1024)
+                buffer.write_bytes('hello')
+                buffer.flip()
+                b.write(buffer)
+            Tasklet.new(writer)()
+            self.assertEquals(5, a.read(buffer, 2.0))
+
+            #data arrives while nobody is waiting, then is read optimistically, readiness is stale by now
+            buffer.clear()
+            buffer.write_bytes('world')
+            buffer.flip()
+            b.write(buffer)
+            Tasklet.sleep(0.5)
+            buffer.clear()
+            self.assertEquals(5, a.read(buffer, 2.0))
+            buffer.clear()
+            try:
+                a.read(buffer, 0.5)
+                self.fail('expected timeout')
+            except TimeoutError:
+                pass
+
+            a.close()
+            b.close()
+
+    def testPersistentEventsPerformance(self):
+        """ping pong of a single byte between 2 sockets. every read needs to wait for the fd to become readable.
+        run under 'strace -c -f -e trace=epoll_ctl' to see the number of epoll_ctl calls saved by persistent events"""
+        N = 20000
+        for persistent_events in [False, True]:
+            a, b = self._socket_pair(persistent_events)
+            def echo():
+                buffer = Buffer(16)
+                for i in range(N):
+                    buffer.clear()
+                    b.read(buffer)
+                    buffer.flip()
+                    b.write(buffer)
+            Tasklet.new(echo)()
+            buffer = Buffer(16)
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    buffer.clear()
+                    buffer.write_byte(i & 0xFF)
+                    buffer.flip()
+                    a.write(buffer)
+                    buffer.clear()
+                    a.read(buffer)
+            print 'persistent_events: %s, round trips/sec' % persistent_events, tmr.sec(N)
+            a.close()
+            b.close()
+
+    def testAdaptiveReadiness(self):
+        a, b = self._socket_pair(False)
+        stats = Socket.statistics()['read']
+        def counts():
+            return [stats[k].count for k in ['eagain', 'wait_avoided', 'wait']]
+        buffer = Buffer(16)
+        buffer.write_bytes('abcdef')
+        buffer.flip()
+        b.write(buffer)
+
+        #first read is optimistic and fills up the buffer, so the next one is optimistic as well
+        start = counts()
+        rbuffer = Buffer(4)
+        self.assertEquals(4, a.read(rbuffer))
+        rbuffer.clear()
+        self.assertEquals(2, a.read(rbuffer))
+        self.assertEquals([0, 2, 0], [x - y for x, y in zip(counts(), start)])
+
+        #last read did not fill the buffer, so the next one should wait without doing a wasted recv
+        def writer():
+            Tasklet.sleep(0.2)
+            buffer.clear()
+            buffer.write_bytes('gh')
+            buffer.flip()
+            b.write(buffer)
+        Tasklet.new(writer)()
+        start = counts()
+        rbuffer.clear()
+        self.assertEquals(2, a.read(rbuffer, 2.0))
+        self.assertEquals([0, 0, 1], [x - y for x, y in zip(counts(), start)])
+        a.close()
+        b.close()
+
+    def testWritev(self):
+        a, b = self._socket_pair(False)
+        header = Buffer(16)
+        header.write_bytes('header\r\n')
+        header.flip()
+        body = ''.join([chr(i % 256) for i in range(1024)]) * 1024 #larger than the socket buffer, needs partial writes
+        parts = [header, body, 'trailer']
+        expected = 'header\r\n' + body + 'trailer'
+        def reader():
+            data = []
+            buffer = Buffer(64 * 1024)
+            n = 0
+            while n < len(expected):
+                buffer.clear()
+                n += a.read(buffer)
+                buffer.flip()
+                data.append(buffer.read_bytes(-1))
+            return ''.join(data)
+        reader = Tasklet.new(reader)()
+        self.assertEquals(len(expected), b.writev(parts))
+        self.assertEquals(expected, Tasklet.join(reader))
+        self.assertEquals(0, header.position) #position of buffer parts is not updated
+        self.assertEquals(0, b.writev([]))
+        a.close()
+        b.close()
+
+    def testSendfileLarge(self):
+        #counts above 2GB are sent in several calls, here the file ends long before that
+        import tempfile
+        f = tempfile.TemporaryFile()
+        f.write('hello world')
+        f.flush()
+        a, b = self._socket_pair(False)
+        self.assertEquals(11, b.sendfile(f.fileno(), 0, 3 * 2 ** 31))
+        buffer = Buffer(1024)
+        a.read(buffer)
+        buffer.flip()
+        self.assertEquals('hello world', buffer.read_bytes(-1))
+        f.close()
+        a.close()
+        b.close()
+
+    def testWritevPerformance(self):
+        class CopyingStream(IOStream):
+            """hides writev of socket, so that BufferedWriter copies and flushes in parts"""
+            def __init__(self, socket):
+                self.socket = socket
+            def write(self, buffer, timeout = TIMEOUT_CURRENT, assume_writable = True):
+                return self.socket.write(buffer, timeout, assume_writable)
+
+        N = 100
+        body = 'x' * (1024 * 1024)
+        for writev in [False, True]:
+            a, b = self._socket_pair(False)
+            def reader():
+                buffer = Buffer(64 * 1024)
+                n = N * (len(body) + 5)
+                while n > 0:
+                    buffer.clear()
+                    n -= a.read(buffer)
+            reader = Tasklet.new(reader)()
+            if writev:
+                writer = BufferedWriter(b, Buffer(8 * 1024))
+            else:
+                writer = BufferedWriter(CopyingStream(b), Buffer(8 * 1024))
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    writer.write_bytes('head\n')
+                    writer.write_bytes(body)
+                    writer.flush()
+                Tasklet.join(reader)
+            print 'writev: %s, MB/sec' % writev, tmr.sec(N)
+            a.close()
+            b.close()
+
+    def testAcceptMany(self):
+        server = Socket.server(('localhost', SERVER_PORT))
+        clients = []
+        for i in range(10):
+            client = _socket.socket(_socket.AF_INET, _socket.SOCK_STREAM)
+            client.connect(('localhost', SERVER_PORT))
+            clients.append(client)
+        accepted = server.accept_many(4)
+        self.assertEquals(4, len(accepted))
+        accepted.extend(server.accept_many(100))
+        self.assertEquals(10, len(accepted))
+        for s in accepted:
+            self.assertEquals(Socket.STATE_CONNECTED, s.state)
+            s.close()
+        for client in clients:
+            client.close()
+        server.close()
+
+    def testAcceptPending(self):
+        #more than 1 connection pending on a listening socket with persistent (edge triggered) events
+        for persistent_events in [False, True]:
+            server = Socket.server(('localhost', SERVER_PORT), persistent_events = persistent_events)
+            clients = []
+            for i in range(5):
+                client = _socket.socket(_socket.AF_INET, _socket.SOCK_STREAM)
+                client.connect(('localhost', SERVER_PORT))
+                clients.append(client)
+            accepted = []
+            with Timeout.push(1.0):
+                accepted.append(server.accept())
+                accepted.append(server.accept())
+                accepted.extend(server.accept_many(2))
+                accepted.extend(server.accept_many(2))
+            self.assertEquals(5, len(accepted))
+            #backlog is drained now
+            try:
+                with Timeout.push(0.5):
+                    server.accept()
+                self.fail('expected timeout')
+            except TimeoutError:
+                pass
+            for s in accepted:
+                s.close()
+            for client in clients:
+                client.close()
+            server.close()
+
+    def testAcceptPerformance(self):
+        N = 2000
+        C = 50
+        def handler(socket):
+            socket.close()
+            return True
+        def client(n):
+            buffer = Buffer(16)
+            for i in range(n):
+                s = Socket.connect(('localhost', SERVER_PORT))
+                try:
+                    s.read(buffer)
+                except EOFError:
+                    pass
+                s.close()
+        for accept_batch, handler_pool in [(1, None), (SocketServer.ACCEPT_BATCH, None), (SocketServer.ACCEPT_BATCH, TaskletPool(C))]:
+            server = SocketServer(('localhost', SERVER_PORT), handler, accept_batch = accept_batch, handler_pool = handler_pool)
+            server.serve()
+            with unittest.timer() as tmr:
+                Tasklet.join_all([Tasklet.new(client)(N / C) for i in range(C)])
+            print 'accept_batch: %d, handler_pool: %s, accepts/sec' % (accept_batch, handler_pool is not None), tmr.sec(N)
+            server.close()
+
 if __name__ == '__main__':
     unittest.main(timeout = 10.0)
@@ -5,7 +5,7 @@ import time
 import logging
 
 from concurrence import unittest, Tasklet, Channel, Timeout
-from concurrence.memcache import MemcacheResult, Memcache, MemcacheProtocol, MemcacheConnection, MemcacheConnectionManager, MemcacheError, MemcacheBehaviour, MemcacheCodec
+from concurrence.memcache import MemcacheResult, Memcache, MemcacheProtocol, MemcacheConnection, MemcacheConnectionManager, MemcacheError, MemcacheBehaviour, MemcacheCodec, MemcacheLocalCache
 
 MEMCACHE_IP = '127.0.0.1'
 
@@ -268,6 +268,81 @@ class TestMemcache(unittest.TestCase):
 
         self.sharedTestBasic(mc)
 
+    def testBasicBinary(self):
+
+        mc = Memcache(protocol = "binary")
+        mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+
+        self.sharedTestBasic(mc)
+
+    def sharedTestNoreply(self, mc):
+
+        self.assertEquals(None, mc.set('noreply1', 'hello', noreply = True))
+        self.assertEquals('hello', mc.get('noreply1')) #same connection, so the set was done before the get
+        self.assertEquals(None, mc.add('noreply1', 'world', noreply = True)) #fails, but we don't hear about it
+        self.assertEquals('hello', mc.get('noreply1'))
+        self.assertEquals(None, mc.append('noreply1', ' world', noreply = True))
+        self.assertEquals('hello world', mc.get('noreply1'))
+        self.assertEquals(None, mc.delete('noreply1', noreply = True))
+        self.assertEquals(None, mc.get('noreply1'))
+
+        mapping = dict(('noreply_multi%d' % i, i) for i in range(100))
+        results = mc.set_multi(mapping)
+        self.assertEquals(100, len(results))
+        self.assertEquals(set([MemcacheResult.STORED]), set(results.values()))
+        self.assertEquals((MemcacheResult.OK, mapping), mc.get_multi(mapping.keys()))
+
+        results = mc.delete_multi(mapping.keys() + ['noreply_missing'])
+        self.assertEquals(MemcacheResult.DELETED, results['noreply_multi0'])
+        self.assertEquals(MemcacheResult.NOT_FOUND, results['noreply_missing'])
+
+        self.assertEquals(None, mc.set_multi(mapping, noreply = True))
+        self.assertEquals((MemcacheResult.OK, mapping), mc.get_multi(mapping.keys()))
+        self.assertEquals(None, mc.delete_multi(mapping.keys(), noreply = True))
+        self.assertEquals((MemcacheResult.OK, {}), mc.get_multi(mapping.keys()))
+
+    def testNoreply(self):
+        for protocol in ["text", "binary"]:
+            self.sharedTestNoreply(MemcacheConnection((MEMCACHE_IP, 11211), protocol))
+            mc = Memcache(protocol = protocol)
+            mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+            self.sharedTestNoreply(mc)
+
+    def testFillRate(self):
+
+        N = 20000
+        B = 100
+        keys = ['test%d' % i for i in range(N)]
+
+        for protocol in ["text", "binary"]:
+            mc = Memcache(protocol = protocol)
+            mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    mc.set(keys[i], 'hello world %d' % i)
+            print protocol, 'fill rate set keys/sec', tmr.sec(N)
+
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    mc.set(keys[i], 'hello world %d' % i, noreply = True)
+                    if i % B == 0:
+                        Tasklet.yield_() #let the writer catch up
+                self.assertEquals('hello world %d' % (N - 1), mc.get(keys[N - 1])) #all sets are done when this returns
+            print protocol, 'fill rate set noreply keys/sec', tmr.sec(N)
+
+            with unittest.timer() as tmr:
+                for i in range(0, N, B):
+                    mc.set_multi(dict((key, 'hello world') for key in keys[i:i+B]))
+            print protocol, 'fill rate set_multi (%d) keys/sec' % B, tmr.sec(N)
+
+            with unittest.timer() as tmr:
+                for i in range(0, N, B):
+                    mc.set_multi(dict((key, 'hello world') for key in keys[i:i+B]), noreply = True)
+                    Tasklet.yield_()
+                self.assertEquals('hello world', mc.get(keys[N - 1]))
+            print protocol, 'fill rate set_multi (%d) noreply keys/sec' % B, tmr.sec(N)
+
     def testMemcache(self):
 
         mc = Memcache()
@@ -300,9 +375,9 @@ class TestMemcache(unittest.TestCase):
 
         Tasklet.sleep(4.0)
 
-    def testMemcacheMultiServer(self):
+    def sharedTestMultiServer(self, protocol):
 
-        mc = Memcache()
+        mc = Memcache(protocol = protocol)
         mc.set_servers([((MEMCACHE_IP, 11211), 100),
                         ((MEMCACHE_IP, 11212), 100),
                         ((MEMCACHE_IP, 11213), 100),
@@ -314,12 +389,12 @@ class TestMemcache(unittest.TestCase):
         with unittest.timer() as tmr:
             for i in range(N):
                 self.assertEquals(MemcacheResult.STORED, mc.set(keys[i], 'hello world %d' % i))
-        print 'multi server single set keys/sec', tmr.sec(N)
+        print protocol, 'multi server single set keys/sec', tmr.sec(N)
 
         with unittest.timer() as tmr:
             for i in range(N):
                 self.assertEquals('hello world %d' % i, mc.get(keys[i]))
-        print 'multi server single get keys/sec', tmr.sec(N)
+        print protocol, 'multi server single get keys/sec', tmr.sec(N)
 
         N = 10000
         for stride in [10,20,40]:
@@ -328,7 +403,13 @@ class TestMemcache(unittest.TestCase):
                     result, values = mc.get_multi(keys[i:i+stride])
                     self.assertEquals(MemcacheResult.OK, result)
                     self.assertEquals(stride, len(values))
-            print 'multi server multi get (%d) keys/sec' % stride, tmr.sec(N)
+            print protocol, 'multi server multi get (%d) keys/sec' % stride, tmr.sec(N)
+
+    def testMemcacheMultiServer(self):
+        self.sharedTestMultiServer("text")
+
+    def testMemcacheMultiServerBinary(self):
+        self.sharedTestMultiServer("binary")
 
     def testMultiClientMultiServer(self):
 
@@ -427,6 +508,322 @@ class TestMemcache(unittest.TestCase):
         result2 = protocol.read_get(reader)
         self.assertEquals(result1, result2)
 
+        #get with the size of the encoded values
+        protocol.write_get_sized(writer, ['hello', 'missing'])
+        writer.flush()
+        self.assertEquals((MemcacheResult.OK, {'hello': ('world', 5)}), protocol.read_get_sized(reader))
+
+    def testBinaryProtocol(self):
+        from concurrence.io import Socket, BufferedStream
+        from concurrence.memcache.protocol import MemcacheProtocol, MemcacheBinaryProtocol
+
+        socket = Socket.connect((MEMCACHE_IP, 11211))
+        stream = BufferedStream(socket)
+        writer = stream.writer
+        reader = stream.reader
+
+        protocol = MemcacheProtocol.create("binary")
+        self.assertTrue(isinstance(protocol, MemcacheBinaryProtocol))
+        self.assertTrue(protocol is MemcacheProtocol.create(protocol))
+
+        protocol.set_codec("raw")
+
+        protocol.write_version(writer)
+        writer.flush()
+        result, version = protocol.read_version(reader)
+        self.assertEquals(MemcacheResult.OK, result)
+        self.assertTrue(len(version) > 1)
+
+        protocol.write_set(writer, 'hello', 'world', 0, 0)
+        writer.flush()
+        self.assertEquals((MemcacheResult.STORED, None), protocol.read_set(reader))
+
+        #quiet sets are not answered
+        N = 100
+        for i in range(N):
+            protocol.write_set(writer, 'test%d' % i, 'hello world %d' % i, 0, 0, noreply = True)
+        writer.flush()
+
+        #pipelined multi get, misses are not answered
+        for i in range(0, N, 10):
+            keys = ['test%d' % x for x in range(i, i + 10)] + ['missing%d' % i]
+            protocol.write_get(writer, keys)
+        writer.flush()
+        for i in range(0, N, 10):
+            result, values = protocol.read_get(reader)
+            self.assertEquals(MemcacheResult.OK, result)
+            self.assertEquals(10, len(values))
+            self.assertEquals('hello world %d' % i, values['test%d' % i])
+
+        protocol.write_get_sized(writer, ['test1', 'missing'])
+        writer.flush()
+        self.assertEquals((MemcacheResult.OK, {'test1': ('hello world 1', 13)}), protocol.read_get_sized(reader))
+
+        #an empty get is answered by the noop only
+        protocol.write_get(writer, [])
+        writer.flush()
+        self.assertEquals((MemcacheResult.OK, {}), protocol.read_get(reader))
+
+        #the error of a failed quiet command is skipped by the next read
+        protocol.write_add(writer, 'hello', 'world', 0, 0, noreply = True)
+        protocol.write_delete(writer, 'hello', 0)
+        writer.flush()
+        self.assertEquals((MemcacheResult.DELETED, None), protocol.read_delete(reader))
+
+        protocol.write_gets(writer, ['test1'])
+        writer.flush()
+        result, values = protocol.read_gets(reader)
+        value, cas_unique = values['test1']
+        self.assertEquals('hello world 1', value)
+        protocol.write_cas(writer, 'test1', 'blaat', 0, 0, cas_unique)
+        protocol.write_cas(writer, 'test1', 'blaat', 0, 0, cas_unique)
+        writer.flush()
+        self.assertEquals((MemcacheResult.STORED, None), protocol.read_cas(reader))
+        self.assertEquals((MemcacheResult.EXISTS, None), protocol.read_cas(reader))
+
+        protocol.write_incr(writer, 'test1', 1)
+        writer.flush()
+        result, _ = protocol.read_incr(reader)
+        self.assertEquals(MemcacheResult("CLIENT_ERROR"), result) #not a number
+
+    def testDeadServer(self):
+
+        cm = MemcacheConnectionManager(max_failures = 2, retry_delay = 0.2, max_retry_delay = 0.5)
+        try:
+            dead = (MEMCACHE_IP, 11219) #nothing listens here yet
+            servers = [((MEMCACHE_IP, 11211), 100), (dead, 100)]
+
+            mc = Memcache(connection_manager = cm, eject_dead_servers = True)
+            mc.set_servers(servers)
+
+            keys = ['test%d' % i for i in range(100)]
+            dead_keys = [key for key in keys if mc.connection_for_key(key)._address == dead]
+            self.assertTrue(dead_keys)
+
+            #marked dead after 2 failures
+            self.assertEquals(MemcacheResult.ERROR, mc.set(dead_keys[0], 'hello'))
+            self.assertTrue(cm.is_alive(dead))
+            self.assertEquals(MemcacheResult.ERROR, mc.set(dead_keys[0], 'hello'))
+            self.assertFalse(cm.is_alive(dead))
+
+            statistics = mc.__statistics__()['servers']['%s:%d' % dead]
+            self.assertEquals(False, statistics['alive'])
+            self.assertEquals(2, statistics['failed'].count)
+            self.assertEquals(1, statistics['dead'].count)
+
+            #ejected from the continuum, so all keys go to the live server
+            for key in keys:
+                self.assertEquals(MemcacheResult.STORED, mc.set(key, 'hello'))
+
+            #without ejection commands for the dead server fail right away
+            mc2 = Memcache(connection_manager = cm)
+            mc2.set_servers(servers)
+            with Timeout.push(0.1):
+                self.assertEquals(MemcacheResult.ERROR, mc2.set(dead_keys[0], 'hello'))
+
+            #when it comes back it is added again
+            os.system('%s -m 10 -p %d -u nobody -l 127.0.0.1&' % (MEMCACHED_BIN, dead[1]))
+            Tasklet.sleep(2.0)
+            self.assertTrue(cm.is_alive(dead))
+            self.assertEquals(dead, mc.connection_for_key(dead_keys[0])._address)
+            self.assertEquals(MemcacheResult.STORED, mc.set(dead_keys[0], 'back'))
+            self.assertEquals('back', mc2.get(dead_keys[0]))
+            self.assertEquals(True, mc.__statistics__()['servers']['%s:%d' % dead]['alive'])
+        finally:
+            cm.close_all()
+
+    def testCoalesceGets(self):
+
+        N = 100
+        keys = ['test%d' % i for i in range(N)]
+
+        mc = Memcache(coalesce_gets = True)
+        mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+
+        for i in range(N):
+            self.assertEquals(MemcacheResult.STORED, mc.set(keys[i], 'hello world %d' % i))
+
+        #count the gets that are actually written
+        connection = mc.connection_for_key(keys[0])
+        written = []
+        def _defer_command(cmd, args, result_channel, error_value = None):
+            written.append(args[0])
+            MemcacheConnection._defer_command(connection, cmd, args, result_channel, error_value)
+        connection._defer_command = _defer_command
+
+        try:
+            results = {}
+            def getter(i):
+                key = keys[i % (N / 2)] #every key is asked for twice
+                results[i] = (key, mc.get(key), mc.gets(key))
+            for i in range(N):
+                Tasklet.new(getter)(i)
+            Tasklet.join_children()
+
+            self.assertEquals(N, len(results))
+            for key, value, (result, value2, cas_unique) in results.values():
+                self.assertEquals('hello world %d' % keys.index(key), value)
+                self.assertEquals(MemcacheResult.OK, result)
+                self.assertEquals(value, value2)
+                self.assertTrue(cas_unique is not None)
+            #1 get and 1 gets, each for the 50 different keys
+            self.assertEquals(2, len(written))
+            self.assertEquals([N / 2, N / 2], [len(_keys) for _keys in written])
+
+            #missing keys get the default
+            self.assertEquals('blaat', mc.get('missing', 'blaat'))
+            self.assertEquals((MemcacheResult.OK, None), mc.getr('missing'))
+        finally:
+            del connection._defer_command
+
+        #benchmark concurrent single gets with and without coalescing
+        M = 10000
+        for coalesce_gets in [False, True]:
+            mc = Memcache(coalesce_gets = coalesce_gets)
+            mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+            def fetcher():
+                for i in range(M / 100):
+                    self.assertEquals('hello world %d' % i, mc.get(keys[i]))
+            with unittest.timer() as tmr:
+                for i in range(100):
+                    Tasklet.new(fetcher)()
+                Tasklet.join_children()
+            print 'multi client (100), single get, coalesce gets %s keys/sec' % coalesce_gets, tmr.sec(M)
+
+    def testLocalCache(self):
+
+        cache = MemcacheLocalCache(max_size = 30, ttl = 0.5)
+        cache.put('a', '1234567890') #size 11
+        cache.put('b', '1234567890')
+        self.assertEquals(22, cache.size)
+        self.assertEquals('1234567890', cache.get('a')) #a is now most recently used
+        cache.put('c', '1234567890') #evicts b
+        self.assertEquals(22, cache.size)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals('blaat', cache.get('b', 'blaat'))
+
+        cache.put('d', 'x' * 30) #too big to cache
+        self.assertFalse('d' in cache)
+        cache.put('d', {'x': 1}, size = 30) #size of encoded value given
+        self.assertFalse('d' in cache)
+
+        #values fetched before an invalidate are not put
+        generation = cache.generation
+        cache.invalidate('a')
+        cache.put('a', 'stale', generation)
+        self.assertFalse('a' in cache)
+        cache.put('a', 'fresh', cache.generation)
+        self.assertEquals('fresh', cache.get('a'))
+
+        #invalidating other keys does not matter
+        recent = MemcacheLocalCache(max_invalidated = 2)
+        generation = recent.generation
+        recent.invalidate('x')
+        recent.invalidate('y')
+        recent.put('a', 'fetched', generation)
+        self.assertTrue('a' in recent)
+        recent.put('x', 'stale', generation)
+        self.assertFalse('x' in recent)
+        #unless they were invalidated too long ago to be remembered
+        recent.invalidate('z')
+        recent.put('b', 'fetched', generation)
+        self.assertFalse('b' in recent)
+        recent.put('b', 'fetched', recent.generation)
+        self.assertTrue('b' in recent)
+
+        Tasklet.sleep(0.6)
+        self.assertEquals(None, cache.get('a')) #expired
+        cache.put('a', 'long', ttl = 10.0)
+        self.assertEquals('long', cache.get('a'))
+
+        statistics = cache.__statistics__()
+        self.assertEquals(3, statistics['hits'].count)
+        self.assertEquals(3, statistics['misses'].count)
+        self.assertEquals(1, statistics['evictions'].count)
+        self.assertEquals(1, statistics['expired'].count)
+        self.assertEquals(2, statistics['entries']) #c has expired, but was not looked up again
+
+        local_cache = MemcacheLocalCache(ttl = 1.0)
+        mc = Memcache(local_cache = local_cache)
+        mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+
+        self.sharedTestBasic(mc)
+
+        #values changed by other clients are only seen after the ttl
+        mc2 = Memcache()
+        mc2.set_servers([((MEMCACHE_IP, 11211), 100)])
+
+        self.assertEquals(MemcacheResult.STORED, mc.set('local1', 'hello'))
+        self.assertEquals(MemcacheResult.STORED, mc.set('local2', 'world'))
+        self.assertEquals('hello', mc.get('local1'))
+        self.assertEquals(MemcacheResult.STORED, mc2.set('local1', 'changed'))
+        self.assertEquals('hello', mc.get('local1'))
+        self.assertEquals((MemcacheResult.OK, {'local1': 'hello', 'local2': 'world'}), mc.get_multi(['local1', 'local2', 'local3']))
+        Tasklet.sleep(1.1)
+        self.assertEquals('changed', mc.get('local1'))
+
+        #but changes made by the same client are seen right away
+        self.assertEquals(MemcacheResult.STORED, mc.set('local1', 'hello again'))
+        self.assertEquals('hello again', mc.get('local1'))
+        self.assertEquals(MemcacheResult.DELETED, mc.delete('local1'))
+        self.assertEquals(None, mc.get('local1'))
+        mc.set_multi({'local1': 'a', 'local2': 'b'})
+        self.assertEquals((MemcacheResult.OK, {'local1': 'a', 'local2': 'b'}), mc.get_multi(['local1', 'local2']))
+
+        #a get started while a write is in progress can be answered before the write is done,
+        #its value is not kept afterwards, also when the write is noreply
+        generations = []
+        invalidate = local_cache.invalidate
+        def record_invalidate(key):
+            invalidate(key)
+            generations.append(local_cache.generation)
+        local_cache.invalidate = record_invalidate
+        try:
+            for noreply in [False, True]:
+                for write in [lambda: mc.set('local3', 'new', noreply = noreply),
+                              lambda: mc.set_multi({'local3': 'new'}, noreply = noreply)]:
+                    del generations[:]
+                    write()
+                    Tasklet.sleep(0.1) #written
+                    local_cache.put('local3', 'old', generations[0])
+                    self.assertFalse('local3' in local_cache)
+                    self.assertEquals('new', mc.get('local3'))
+        finally:
+            del local_cache.invalidate
+
+        self.assertTrue(mc.__statistics__()['local_cache']['hits'].count > 0)
+
+        #values read from memcached are not encoded again to get their size
+        class CountingCodec(MemcacheCodec):
+            def __init__(self):
+                self.default = MemcacheCodec.create("default")
+                self.encoded = 0
+            def decode(self, flags, encoded_value):
+                return self.default.decode(flags, encoded_value)
+            def encode(self, value, flags):
+                self.encoded += 1
+                return self.default.encode(value, flags)
+        codec = CountingCodec()
+        mc = Memcache(local_cache = MemcacheLocalCache(codec = codec))
+        mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+        mc.set_multi({'local5': {'a': 1}, 'local6': 12345})
+        self.assertEquals({'a': 1}, mc.get('local5'))
+        self.assertEquals((MemcacheResult.OK, {'local5': {'a': 1}, 'local6': 12345}), mc.get_multi(['local5', 'local6']))
+        self.assertEquals(0, codec.encoded)
+        self.assertEquals(2, len(mc._local_cache))
+
+        #benchmark a hot key with and without local cache
+        N = 10000
+        for local_cache in [None, MemcacheLocalCache()]:
+            mc = Memcache(local_cache = local_cache)
+            mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+            with unittest.timer() as tmr:
+                for i in range(N):
+                    self.assertEquals('a', mc.get('local1'))
+            print 'single get hot key, local cache %s keys/sec' % (local_cache is not None), tmr.sec(N)
+
     def testCodec(self):
 
         try:
@@ -465,6 +862,47 @@ class TestMemcache(unittest.TestCase):
         finally:
             cm.close_all()
 
+    def testMultipleConnections(self):
+
+        N = 10000
+        keys = ['test%d' % i for i in range(100)]
+        big = 'x' * (512 * 1024)
+
+        def fetcher(mc):
+            for i in range(N / 10):
+                self.assertEquals('hello world', mc.get(keys[i % len(keys)]))
+
+        def big_fetcher(mc):
+            for i in range(10):
+                self.assertEquals(big, mc.get('big'))
+
+        for connections_per_server in [1, 4]:
+            cm = MemcacheConnectionManager(connections_per_server = connections_per_server, queue_threshold = 2)
+            try:
+                mc = Memcache(connection_manager = cm)
+                mc.set_servers([((MEMCACHE_IP, 11211), 100)])
+
+                for key in keys:
+                    self.assertEquals(MemcacheResult.STORED, mc.set(key, 'hello world'))
+                self.assertEquals(MemcacheResult.STORED, mc.set('big', big))
+
+                with unittest.timer() as tmr:
+                    Tasklet.new(big_fetcher)(mc)
+                    for i in range(10):
+                        Tasklet.new(fetcher)(mc)
+                    Tasklet.join_children()
+                print 'multi client (10) with large values, %d connection(s) single get keys/sec' % connections_per_server, tmr.sec(N)
+
+                statistics = mc.__statistics__()['servers']['%s:%d' % (MEMCACHE_IP, 11211)]['connections']
+                if connections_per_server == 1:
+                    self.assertEquals(1, len(statistics))
+                else:
+                    self.assertTrue(1 < len(statistics) <= connections_per_server)
+                for connection_statistics in statistics:
+                    self.assertEquals(0, connection_statistics['outstanding'].count)
+            finally:
+                cm.close_all()
+
 from concurrence.memcache.ketama import TestKetama
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+import os
+import sys
+import signal
+import subprocess
+
+from concurrence import unittest, Tasklet
+from concurrence.http import WSGIServer, HTTPConnection
+from concurrence.io import Socket, SocketServer, Buffer
+from concurrence.io.prefork import Prefork
+
+SERVER_PORT = 8082
+WORKERS = 2
+
+def pid_application(environ, start_response):
+    start_response("200 OK", [])
+    return [str(os.getpid())]
+
+def main(socket):
+    return WSGIServer(pid_application).serve(socket)
+
+def accept_main(socket):
+    #just accepts and closes the connection
+    def handler(client_socket):
+        client_socket.close()
+        return True
+    server = SocketServer(socket, handler)
+    server.serve()
+    return server
+
+class TestPrefork(unittest.TestCase):
+    def _start(self, workers = WORKERS, reuse_port = False, mode = 'serve'):
+        self.process = subprocess.Popen([sys.executable, __file__, mode, str(workers), str(int(reuse_port))])
+        Tasklet.sleep(1.0)
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+    def _pids(self, n = 20):
+        pids = set()
+        for i in range(n):
+            cnn = HTTPConnection()
+            cnn.connect(('localhost', SERVER_PORT))
+            try:
+                response = cnn.perform(cnn.get('/'))
+                self.assertEquals(200, response.status_code)
+                pids.add(int(response.body))
+            finally:
+                cnn.close()
+        return pids
+
+    def _testPrefork(self, reuse_port):
+        self._start(reuse_port = reuse_port)
+
+        pids = self._pids()
+        self.assertTrue(0 < len(pids) <= WORKERS)
+        self.assertFalse(self.process.pid in pids)
+
+        #a worker that dies is restarted
+        os.kill(list(pids)[0], signal.SIGKILL)
+        Tasklet.sleep(2.0)
+        self.assertTrue(len(self._pids()) > 0)
+
+        #graceful reload starts new workers
+        os.kill(self.process.pid, signal.SIGHUP)
+        Tasklet.sleep(1.0)
+        reloaded = self._pids()
+        self.assertTrue(0 < len(reloaded) <= WORKERS)
+        self.assertEquals(set(), pids & reloaded)
+
+        #graceful stop
+        os.kill(self.process.pid, signal.SIGTERM)
+        for i in range(50):
+            if self.process.poll() is not None:
+                break
+            Tasklet.sleep(0.1)
+        self.assertEquals(0, self.process.poll())
+
+    def testPrefork(self):
+        self._testPrefork(False)
+
+    def testPreforkReusePort(self):
+        self._testPrefork(True)
+
+    def testAcceptPerformance(self):
+        N = 4000
+        C = 20
+        def client(n):
+            buffer = Buffer(16)
+            for i in range(n):
+                s = Socket.connect(('localhost', SERVER_PORT))
+                try:
+                    s.read(buffer)
+                except EOFError:
+                    pass
+                s.close()
+        for reuse_port in [False, True]:
+            for workers in [1, 4, 8]:
+                self._start(workers, reuse_port, 'accept')
+                try:
+                    with unittest.timer() as tmr:
+                        Tasklet.join_all([Tasklet.new(client)(N / C) for i in range(C)])
+                    print 'reuse_port: %s, workers: %d, accepts/sec: %d' % (reuse_port, workers, tmr.sec(N))
+                finally:
+                    os.kill(self.process.pid, signal.SIGTERM)
+                    self.process.wait()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] in [['serve'], ['accept']]:
+        Prefork(('localhost', SERVER_PORT), {'serve': main, 'accept': accept_main}[sys.argv[1]],
+                workers = int(sys.argv[2]), reuse_port = bool(int(sys.argv[3])), graceful_timeout = 1.0).run()
+    else:
+        unittest.main(timeout = 120.0)